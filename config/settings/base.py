@@ -323,3 +323,78 @@ REST_FRAMEWORK = {
 CORS_URLS_REGEX = r"^/api/.*$"
 # Your stuff...
 # ------------------------------------------------------------------------------
+# Rocket.Chat clients
+# ------------------------------------------------------------------------------
+# seconds a client logged in with username and password is reused before a new login
+ROCKETCHAT_CLIENT_LOGIN_MAX_AGE = env.int(
+    "ROCKETCHAT_CLIENT_LOGIN_MAX_AGE", default=60 * 60
+)
+# connections kept alive per Rocket.Chat server
+ROCKETCHAT_CLIENT_POOL_SIZE = env.int("ROCKETCHAT_CLIENT_POOL_SIZE", default=20)
+# ------------------------------------------------------------------------------
+# Connector sessions
+# ------------------------------------------------------------------------------
+# connections kept alive per connector provider
+CONNECTOR_SESSION_POOL_SIZE = env.int("CONNECTOR_SESSION_POOL_SIZE", default=10)
+# seconds to connect, and to read a response, from a connector provider
+CONNECTOR_SESSION_TIMEOUT = (
+    env.float("CONNECTOR_SESSION_CONNECT_TIMEOUT", default=5),
+    env.float("CONNECTOR_SESSION_READ_TIMEOUT", default=60),
+)
+# retries of connection errors, and of idempotent requests failing with 502/503/504
+CONNECTOR_SESSION_RETRIES = env.int("CONNECTOR_SESSION_RETRIES", default=3)
+# seconds a number lookup is cached, when the number was found, and when it was not
+NUMBER_CACHE_TIMEOUT = env.int("NUMBER_CACHE_TIMEOUT", default=60 * 60 * 24)
+NUMBER_CACHE_NEGATIVE_TIMEOUT = env.int(
+    "NUMBER_CACHE_NEGATIVE_TIMEOUT", default=60 * 60
+)
+# ------------------------------------------------------------------------------
+# Live chat rooms
+# ------------------------------------------------------------------------------
+# seconds a room is kept in the cache after its last change
+ROOM_CACHE_TIMEOUT = env.int("ROOM_CACHE_TIMEOUT", default=60 * 60 * 24)
+# seconds the state of a room in Rocket.Chat is trusted before checking it again
+ROOM_STATE_CACHE_TIMEOUT = env.int("ROOM_STATE_CACHE_TIMEOUT", default=30)
+# seconds the departments of a server are kept, see Server.get_departments
+DEPARTMENT_CACHE_TIMEOUT = env.int("DEPARTMENT_CACHE_TIMEOUT", default=60 * 10)
+# seconds between two refreshes of the departments caused by an unknown id
+DEPARTMENT_MISS_REFRESH_INTERVAL = env.int(
+    "DEPARTMENT_MISS_REFRESH_INTERVAL", default=60
+)
+# ------------------------------------------------------------------------------
+# Outbound rate limit
+# ------------------------------------------------------------------------------
+# seconds a deferred message waits in a worker for a slot of the connector rate,
+# before its delivery is queued again
+OUTBOUND_MAX_WAIT = env.int("OUTBOUND_MAX_WAIT", default=5)
+# ------------------------------------------------------------------------------
+# Message archive
+# ------------------------------------------------------------------------------
+# delivered messages older than this many days are archived. Empty to keep them
+MESSAGE_RETENTION_DAYS = env.int("MESSAGE_RETENTION_DAYS", default=None)
+# where the archived messages are kept. Not served, as the media files are
+MESSAGE_ARCHIVE_ROOT = env("MESSAGE_ARCHIVE_ROOT", default=str(ROOT_DIR / "archive"))
+# ------------------------------------------------------------------------------
+# Message media store
+# ------------------------------------------------------------------------------
+# where the files received inside the messages are kept, by their sha256
+MESSAGE_MEDIA_ROOT = env("MESSAGE_MEDIA_ROOT", default=str(ROOT_DIR / "media_store"))
+# ------------------------------------------------------------------------------
+# Message redelivery
+# ------------------------------------------------------------------------------
+# workers redelivering the undelivered messages of a connector at the same time
+REDELIVERY_CONCURRENCY = env.int("REDELIVERY_CONCURRENCY", default=4)
+# ------------------------------------------------------------------------------
+# Live monitor
+# ------------------------------------------------------------------------------
+# seconds the shared snapshot of the open rooms lives without being rebuilt
+MONITOR_SNAPSHOT_TIMEOUT = env.int("MONITOR_SNAPSHOT_TIMEOUT", default=300)
+# at most one rebuild of a stale snapshot in this many seconds
+MONITOR_MIN_REFRESH = env.int("MONITOR_MIN_REFRESH", default=5)
+# seconds between the checks for changes of each websocket viewer
+MONITOR_POLL_INTERVAL = env.int("MONITOR_POLL_INTERVAL", default=1)
+# ------------------------------------------------------------------------------
+# Alerts
+# ------------------------------------------------------------------------------
+# seconds the direct message room with a user is cached, for the alerts
+DM_ROOM_CACHE_TIMEOUT = env.int("DM_ROOM_CACHE_TIMEOUT", default=24 * 60 * 60)
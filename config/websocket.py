@@ -1,4 +1,21 @@
+import asyncio
+import re
+from http.cookies import SimpleCookie
+from importlib import import_module
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+MONITOR_PATH = re.compile(r"^/ws/server/(?P<server_id>\w+)/monitor/?$")
+
+
 async def websocket_application(scope, receive, send):
+    match = MONITOR_PATH.match(scope["path"])
+    if match:
+        await monitor_application(scope, receive, send, match["server_id"])
+        return
+
     while True:
         event = await receive()
 
@@ -11,3 +28,69 @@ async def websocket_application(scope, receive, send):
         if event["type"] == "websocket.receive":
             if event["text"] == "ping":
                 await send({"type": "websocket.send", "text": "pong!"})
+
+
+def get_user_id(scope):
+    """
+    the logged user, from the session cookie
+    """
+    cookies = SimpleCookie()
+    for name, value in scope.get("headers", []):
+        if name == b"cookie":
+            cookies.load(value.decode("latin1"))
+    session_cookie = cookies.get(settings.SESSION_COOKIE_NAME)
+    if not session_cookie:
+        return None
+    engine = import_module(settings.SESSION_ENGINE)
+    session = engine.SessionStore(session_cookie.value)
+    return session.get("_auth_user_id")
+
+
+def get_monitor_server(scope, server_id):
+    from instance import monitor
+
+    user_id = get_user_id(scope)
+    if not user_id:
+        return None
+    return monitor.get_watched_server(user_id, server_id)
+
+
+async def monitor_application(scope, receive, send, server_id):
+    """
+    push the open rooms of a server to its owners, as rendered html,
+    whenever the shared snapshot changes. The snapshot, read from the
+    cache and rebuilt from Rocket.Chat, is handled off the shared sync
+    thread, so a slow rebuild does not hold the other requests
+    """
+    from instance import monitor
+
+    event = await receive()
+    if event["type"] != "websocket.connect":
+        return
+    server = await sync_to_async(get_monitor_server)(scope, server_id)
+    if not server:
+        await send({"type": "websocket.close", "code": 4403})
+        return
+    await send({"type": "websocket.accept"})
+    order = parse_qs(scope["query_string"].decode()).get("order", ["agent"])[0]
+    version = None
+    while True:
+        try:
+            event = await asyncio.wait_for(
+                receive(), timeout=settings.MONITOR_POLL_INTERVAL
+            )
+        except asyncio.TimeoutError:
+            event = None
+        if event and event["type"] == "websocket.disconnect":
+            break
+        if await sync_to_async(monitor.needs_refresh, thread_sensitive=False)(server):
+            await sync_to_async(monitor.get_snapshot, thread_sensitive=False)(server)
+        current = await sync_to_async(monitor.get_version, thread_sensitive=False)(
+            server.id
+        )
+        if current != version:
+            version = current
+            html = await sync_to_async(monitor.render_rooms, thread_sensitive=False)(
+                server, order
+            )
+            await send({"type": "websocket.send", "text": html})
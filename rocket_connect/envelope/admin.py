@@ -1,6 +1,16 @@
 from django.contrib import admin
+from envelope import stats
 
-from .models import LiveChatRoom, Message
+from .models import (
+    Campaign,
+    CampaignRecipient,
+    ConnectorStats,
+    DeliveryAttempt,
+    IntakeEvent,
+    LiveChatRoom,
+    Message,
+    ProviderMessage,
+)
 
 
 @admin.register(LiveChatRoom)
@@ -17,8 +27,26 @@ class LiveChatRoomAdmin(admin.ModelAdmin):
     search_fields = "room_id", "token"
 
 
+class DeliveryAttemptInline(admin.TabularInline):
+    model = DeliveryAttempt
+    extra = 0
+    can_delete = False
+    readonly_fields = (
+        "direction",
+        "delivered",
+        "status_code",
+        "payload",
+        "response",
+        "created",
+    )
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
+    inlines = [DeliveryAttemptInline]
     search_fields = ("envelope_id", "room__room_id", "room__token")
     list_display = (
         "id",
@@ -38,3 +66,75 @@ class MessageAdmin(admin.ModelAdmin):
         if obj.room:
             return obj.room.room_id
         return None
+
+
+@admin.register(IntakeEvent)
+class IntakeEventAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "connector",
+        "lane",
+        "attempts",
+        "dispatched",
+        "claimed",
+        "created",
+    )
+    list_filter = ("connector", "attempts", "created")
+    search_fields = ("lane",)
+    ordering = ("-created",)
+    date_hierarchy = "created"
+
+
+@admin.register(ProviderMessage)
+class ProviderMessageAdmin(admin.ModelAdmin):
+    list_display = ("provider_message_id", "message", "room", "connector", "created")
+    list_filter = ("connector", "created")
+    search_fields = ("provider_message_id", "message__envelope_id")
+    raw_id_fields = ("message", "room")
+
+
+@admin.register(Campaign)
+class CampaignAdmin(admin.ModelAdmin):
+    list_display = ("name", "connector", "department", "status", "created", "updated")
+    list_filter = ("status", "connector", "created")
+    search_fields = ("name",)
+    ordering = ("-created",)
+    date_hierarchy = "created"
+    actions = ["run_campaigns", "cancel_campaigns"]
+
+    @admin.action(description="Run the selected campaigns")
+    def run_campaigns(self, request, queryset):
+        for campaign in queryset.exclude(status__in=["done", "canceled"]):
+            campaign.dispatch()
+
+    @admin.action(description="Cancel the selected campaigns")
+    def cancel_campaigns(self, request, queryset):
+        queryset.exclude(status="done").update(status="canceled")
+
+
+@admin.register(CampaignRecipient)
+class CampaignRecipientAdmin(admin.ModelAdmin):
+    list_display = ("number", "campaign", "status", "room", "updated")
+    list_filter = ("status", "campaign")
+    search_fields = ("number", "error")
+    raw_id_fields = ("campaign", "room")
+
+
+@admin.register(ConnectorStats)
+class ConnectorStatsAdmin(admin.ModelAdmin):
+    list_display = (
+        "connector",
+        "total_messages",
+        "undelivered_messages",
+        "open_rooms",
+        "total_rooms",
+        "total_visitors",
+        "last_message",
+        "updated",
+    )
+    actions = ["rebuild_stats"]
+
+    @admin.action(description="Count the selected stats again")
+    def rebuild_stats(self, request, queryset):
+        for connector_stats in queryset:
+            stats.rebuild(connector_stats.connector_id)
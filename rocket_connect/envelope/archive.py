@@ -0,0 +1,162 @@
+"""
+Cold archive of the delivered messages.
+
+Messages older than the retention are streamed, per connector, into gzipped
+JSON Lines files (one object per line, in the Django serialization format),
+and then deleted from the database in small chunks. The delivery attempts and
+provider message ids of the messages, deleted with them, are archived along,
+right after their messages. Each file is named after the first and last day
+it holds, so a date range can be restored without reading every file.
+"""
+import datetime
+import gzip
+import os
+import tempfile
+
+from django.conf import settings
+from django.core import serializers
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.utils import timezone
+from envelope import stats
+from envelope.models import DeliveryAttempt, Message, ProviderMessage
+
+DELETE_CHUNK_SIZE = 1000
+SERIALIZE_CHUNK_SIZE = 2000
+# the rows deleted in cascade with the messages
+RELATED_MODELS = [DeliveryAttempt, ProviderMessage]
+
+
+def get_storage():
+    return FileSystemStorage(location=settings.MESSAGE_ARCHIVE_ROOT)
+
+
+def archive_messages(connector, days, batch_size=50000, dry_run=False):
+    """
+    archive and delete the delivered messages of the connector older than
+    some days. return the archived files, with their message count
+    """
+    cutoff = timezone.now() - datetime.timedelta(days=days)
+    messages = Message.objects.filter(
+        connector=connector, delivered=True, created__lt=cutoff
+    ).order_by("id")
+    if dry_run:
+        return {"messages": messages.count()}
+    storage = get_storage()
+    archived = {}
+    last_id = 0
+    while True:
+        batch = messages.filter(id__gt=last_id)[:batch_size]
+        ids = []
+        days_range = []
+
+        def track(queryset):
+            chunk = []
+            for message in queryset:
+                ids.append(message.id)
+                days_range.append(timezone.localdate(message.created))
+                chunk.append(message.id)
+                yield message
+                if len(chunk) == SERIALIZE_CHUNK_SIZE:
+                    yield from related(chunk)
+                    chunk = []
+            yield from related(chunk)
+
+        def related(message_ids):
+            for model in RELATED_MODELS:
+                yield from model.objects.filter(message_id__in=message_ids).order_by(
+                    "id"
+                )
+
+        with tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024) as tmp:
+            with gzip.GzipFile(fileobj=tmp, mode="wb") as archive:
+                # the jsonl serializer writes text
+                stream = _TextWriter(archive)
+                serializers.serialize(
+                    "jsonl",
+                    track(batch.iterator(chunk_size=SERIALIZE_CHUNK_SIZE)),
+                    stream=stream,
+                )
+            if not ids:
+                break
+            tmp.seek(0)
+            name = "{}/{:%Y%m%d}-{:%Y%m%d}-{}-{}.jsonl.gz".format(
+                connector.external_token,
+                min(days_range),
+                max(days_range),
+                ids[0],
+                ids[-1],
+            )
+            name = storage.save(name, File(tmp))
+        # only delete what is safely archived
+        for start in range(0, len(ids), DELETE_CHUNK_SIZE):
+            end = start + DELETE_CHUNK_SIZE
+            with transaction.atomic():
+                deleted, by_model = Message.objects.filter(
+                    id__in=ids[start:end]
+                ).delete()
+                stats.add(
+                    connector.id,
+                    total_messages=-by_model.get(Message._meta.label, 0),
+                )
+        archived[name] = len(ids)
+        last_id = ids[-1]
+    return archived
+
+
+def restore_messages(connector, date_from, date_to):
+    """
+    restore the archived messages of the connector created between two
+    dates (inclusive), with their delivery attempts and provider message
+    ids. The connector stats are counted again, and the undelivered days
+    restored are rolled up again. return the restored messages count
+    """
+    storage = get_storage()
+    if not storage.exists(connector.external_token):
+        return 0
+    restored = 0
+    # the undelivered messages restored, by day
+    restored_days = {}
+    directories, files = storage.listdir(connector.external_token)
+    for filename in sorted(files):
+        try:
+            first, last = filename.split("-")[:2]
+            first = datetime.datetime.strptime(first, "%Y%m%d").date()
+            last = datetime.datetime.strptime(last, "%Y%m%d").date()
+        except ValueError:
+            continue
+        if last < date_from or first > date_to:
+            continue
+        path = os.path.join(connector.external_token, filename)
+        with storage.open(path, "rb") as f, gzip.open(f, "rt") as archive:
+            with transaction.atomic():
+                restored_ids = set()
+                for deserialized in serializers.deserialize("jsonl", archive):
+                    obj = deserialized.object
+                    if isinstance(obj, Message):
+                        created = timezone.localdate(obj.created)
+                        if date_from <= created <= date_to:
+                            deserialized.save()
+                            restored_ids.add(obj.id)
+                            if not obj.delivered:
+                                restored_days[created] = obj.created
+                    elif obj.message_id in restored_ids:
+                        deserialized.save()
+                restored += len(restored_ids)
+    if restored:
+        stats.rebuild(connector.id)
+        for created in restored_days.values():
+            stats.mark_undelivered_day(connector.id, created)
+    return restored
+
+
+class _TextWriter:
+    def __init__(self, binary):
+        self.binary = binary
+
+    def write(self, text):
+        self.binary.write(text.encode("utf-8"))
+
+    def flush(self):
+        pass
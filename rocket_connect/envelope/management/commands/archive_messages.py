@@ -0,0 +1,64 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from envelope import archive
+from instance.models import Connector
+
+
+class Command(BaseCommand):
+    help = "Archive the old delivered messages to compressed files, or restore them."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.MESSAGE_RETENTION_DAYS,
+            help="archive the delivered messages older than this",
+        )
+        parser.add_argument(
+            "--connector",
+            action="append",
+            help="connector external token. All connectors if not informed",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=50000, help="messages per archive file"
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true", help="only count the messages"
+        )
+        parser.add_argument(
+            "--restore",
+            nargs=2,
+            metavar=("FROM", "TO"),
+            help="restore the messages created between two dates, as YYYY-MM-DD",
+        )
+
+    def handle(self, *args, **options):
+        connectors = Connector.objects.all()
+        if options["connector"]:
+            connectors = connectors.filter(external_token__in=options["connector"])
+
+        if options["restore"]:
+            try:
+                date_from, date_to = [
+                    datetime.datetime.strptime(d, "%Y-%m-%d").date()
+                    for d in options["restore"]
+                ]
+            except ValueError:
+                raise CommandError("dates must be informed as YYYY-MM-DD")
+            for connector in connectors:
+                restored = archive.restore_messages(connector, date_from, date_to)
+                self.stdout.write(f"{connector}: {restored} messages restored")
+            return
+
+        if not options["days"]:
+            raise CommandError("inform the retention --days")
+        for connector in connectors:
+            archived = archive.archive_messages(
+                connector,
+                options["days"],
+                batch_size=options["batch_size"],
+                dry_run=options["dry_run"],
+            )
+            self.stdout.write(f"{connector}: {archived}")
@@ -0,0 +1,109 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from envelope.models import LiveChatRoom
+from instance.models import Server
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Measure the room lookups of the message hot path as the room history grows."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rooms",
+            type=int,
+            default=1000000,
+            help="historical (closed) rooms to create, in total",
+        )
+        parser.add_argument(
+            "--steps", type=int, default=5, help="measure after each of these steps"
+        )
+        parser.add_argument(
+            "--lookups", type=int, default=500, help="lookups measured on each step"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=10000, help="rooms created per insert"
+        )
+
+    def handle(self, *args, **options):
+        # everything is created inside a transaction that is rolled back
+        try:
+            with transaction.atomic():
+                self.benchmark(**options)
+                raise Rollback
+        except Rollback:
+            self.stdout.write("benchmark data rolled back")
+
+    def benchmark(self, rooms, steps, lookups, batch_size, **options):
+        server = Server.objects.create(name=f"benchmark-{uuid.uuid4().hex[:8]}")
+        connector = server.connectors.create(
+            name="benchmark", connector_type="wppconnect"
+        )
+        # the rooms that will be looked up stay open
+        tokens = [f"benchmark:{i}" for i in range(lookups)]
+        LiveChatRoom.objects.bulk_create(
+            [
+                LiveChatRoom(
+                    connector=connector,
+                    token=token,
+                    room_id=uuid.uuid4().hex,
+                    open=True,
+                )
+                for token in tokens
+            ]
+        )
+        room_ids = list(
+            connector.rooms.filter(open=True).values_list("room_id", flat=True)
+        )
+        created = 0
+        per_step = max(rooms // steps, 1)
+        self.stdout.write("rooms\tby token (ms)\tby room_id (ms)")
+        for step in range(steps + 1):
+            if step:
+                target = min(created + per_step, rooms)
+                while created < target:
+                    size = min(batch_size, target - created)
+                    # past rooms of the same visitors, all closed
+                    LiveChatRoom.objects.bulk_create(
+                        [
+                            LiveChatRoom(
+                                connector=connector,
+                                token=tokens[(created + i) % lookups],
+                                room_id=uuid.uuid4().hex,
+                                open=False,
+                            )
+                            for i in range(size)
+                        ]
+                    )
+                    created += size
+            by_token = self.measure(
+                lambda i: LiveChatRoom.objects.get(
+                    connector=connector, token=tokens[i], open=True
+                ),
+                lookups,
+            )
+            by_room_id = self.measure(
+                lambda i: LiveChatRoom.objects.filter(room_id=room_ids[i]).first(),
+                lookups,
+            )
+            self.stdout.write(f"{created}\t{by_token:.3f}\t{by_room_id:.3f}")
+
+        self.stdout.write("query plans:")
+        self.stdout.write(
+            LiveChatRoom.objects.filter(
+                connector=connector, token=tokens[0], open=True
+            ).explain()
+        )
+        self.stdout.write(LiveChatRoom.objects.filter(room_id=room_ids[0]).explain())
+
+    def measure(self, lookup, lookups):
+        start = time.perf_counter()
+        for i in range(lookups):
+            lookup(i)
+        return (time.perf_counter() - start) * 1000 / lookups
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from instance.models import Connector
+
+
+class Command(BaseCommand):
+    help = "Move the files embedded in the stored messages to the media store."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--connector",
+            action="append",
+            help="connector external token. All connectors if not informed",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=100, help="messages read at a time"
+        )
+
+    def handle(self, *args, **options):
+        connectors = Connector.objects.all()
+        if options["connector"]:
+            connectors = connectors.filter(external_token__in=options["connector"])
+
+        for connector in connectors:
+            c = connector.get_connector_class()(connector, {}, "incoming")
+            messages = connector.messages.filter(type="incoming").only(
+                "id", "raw_message"
+            )
+            batch_size = options["batch_size"]
+            extracted = 0
+            last_id = 0
+            while True:
+                batch = list(
+                    messages.filter(id__gt=last_id).order_by("id")[:batch_size]
+                )
+                if not batch:
+                    break
+                for message in batch:
+                    if isinstance(message.raw_message, dict) and c.extract_media(
+                        message.raw_message
+                    ):
+                        message.save(update_fields=["raw_message"])
+                        extracted += 1
+                last_id = batch[-1].id
+            self.stdout.write(f"{connector}: {extracted} messages extracted")
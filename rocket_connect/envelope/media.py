@@ -0,0 +1,115 @@
+"""
+Content addressed store of the media received with the messages.
+
+Some providers (eg. WPPConnect) send the whole file base64 encoded inside the
+message. The file is saved once, named after its sha256, and the message only
+keeps a reference to it, like "sha256:<hex>". The same file received many
+times is stored only once.
+"""
+import base64
+import binascii
+import hashlib
+import itertools
+import tempfile
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+
+REFERENCE_PREFIX = "sha256:"
+DATA_URL_MARKER = b";base64,"
+
+
+def get_storage():
+    return FileSystemStorage(location=settings.MESSAGE_MEDIA_ROOT)
+
+
+def is_reference(value):
+    return isinstance(value, str) and value.startswith(REFERENCE_PREFIX)
+
+
+def get_name(reference):
+    digest = reference.split(":", 1)[1]
+    return f"{digest[:2]}/{digest[2:4]}/{digest}"
+
+
+def store(data):
+    """
+    save the bytes, if not already stored, and return their reference
+    """
+    reference = REFERENCE_PREFIX + hashlib.sha256(data).hexdigest()
+    storage = get_storage()
+    name = get_name(reference)
+    if not storage.exists(name):
+        storage.save(name, ContentFile(data))
+    return reference
+
+
+def store_base64(base64_data):
+    """
+    store a base64 encoded file. return None if it is not valid base64
+    """
+    try:
+        data = base64.b64decode(base64_data, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    if not data:
+        return None
+    return store(data)
+
+
+def exists(reference):
+    return get_storage().exists(get_name(reference))
+
+
+def open_media(reference):
+    """
+    the stored file, opened for reading
+    """
+    return get_storage().open(get_name(reference), "rb")
+
+
+def decode_data_url(chunks, spool_size=5 * 1024 * 1024):
+    """
+    decode the first base64 data url of a JSON document, read in chunks, as
+    the chunks arrive. The file is spooled: memory up to spool_size, disk for
+    larger ones. return the file, at its start, or None
+    """
+    chunks = iter(chunks)
+    # the marker may be split between two chunks
+    keep = len(DATA_URL_MARKER) - 1
+    head = b""
+    for chunk in chunks:
+        head += chunk
+        if DATA_URL_MARKER in head:
+            break
+        head = head[-keep:]
+    else:
+        return None
+    output = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    pending = b""
+    try:
+        first = head.partition(DATA_URL_MARKER)[2]
+        for chunk in itertools.chain([first], chunks):
+            chunk, quote, _ = chunk.partition(b'"')
+            # JSON may escape the slashes
+            data = pending + chunk.replace(b"\\", b"")
+            usable = len(data) - len(data) % 4
+            output.write(base64.b64decode(data[:usable], validate=True))
+            pending = data[usable:]
+            if quote:
+                break
+        else:
+            # the document ended inside the data url
+            output.close()
+            return None
+        if pending:
+            output.write(base64.b64decode(pending + b"=" * (-len(pending) % 4)))
+    except (binascii.Error, ValueError):
+        output.close()
+        return None
+    if not output.tell():
+        output.close()
+        return None
+    output.seek(0)
+    return output
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.13 on 2026-10-18 15:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instance', '0020_alter_connector_config'),
+        ('envelope', '0008_message_ack'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IntakeEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('body', models.TextField()),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('connector', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='intake_events', to='instance.connector')),
+            ],
+            options={
+                'verbose_name': 'Intake Event',
+                'verbose_name_plural': 'Intake Events',
+                'ordering': ('id',),
+            },
+        ),
+    ]
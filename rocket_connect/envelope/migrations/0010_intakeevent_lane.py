@@ -0,0 +1,27 @@
+# Generated by Django 3.2.13 on 2026-10-18 15:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('envelope', '0009_intakeevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='intakeevent',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='intakeevent',
+            name='lane',
+            field=models.CharField(blank=True, help_text='the visitor token. Events from the same lane are processed in order', max_length=100, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='intakeevent',
+            index=models.Index(fields=['connector', 'lane', 'id'], name='envelope_in_connect_a29d14_idx'),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 3.2.13 on 2026-10-18 15:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_provider_messages(apps, schema_editor):
+    """
+    register the provider ids already stored in the message responses
+    """
+    Message = apps.get_model("envelope", "Message")
+    ProviderMessage = apps.get_model("envelope", "ProviderMessage")
+    messages = Message.objects.filter(
+        models.Q(response__has_key="id") | models.Q(response__has_key="messages")
+    ).only("id", "connector_id", "room_id", "response")
+    batch = []
+    for message in messages.iterator(chunk_size=2000):
+        if not isinstance(message.response, dict):
+            continue
+        provider_ids = list(message.response.get("id") or [])
+        for sent in message.response.get("messages") or []:
+            if isinstance(sent, dict) and sent.get("id"):
+                provider_ids.append(sent["id"])
+        for provider_id in provider_ids:
+            if isinstance(provider_id, str):
+                batch.append(
+                    ProviderMessage(
+                        connector_id=message.connector_id,
+                        provider_message_id=provider_id,
+                        message_id=message.id,
+                        room_id=message.room_id,
+                    )
+                )
+        if len(batch) >= 2000:
+            ProviderMessage.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    ProviderMessage.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instance', '0020_alter_connector_config'),
+        ('envelope', '0010_intakeevent_lane'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProviderMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('provider_message_id', models.CharField(max_length=200)),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('connector', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='provider_messages', to='instance.connector')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='provider_messages', to='envelope.message')),
+                ('room', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='provider_messages', to='envelope.livechatroom')),
+            ],
+            options={
+                'verbose_name': 'Provider Message',
+                'verbose_name_plural': 'Provider Messages',
+                'unique_together': {('connector', 'provider_message_id')},
+            },
+        ),
+        migrations.RunPython(backfill_provider_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.2.13 on 2026-10-18 15:13
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def close_duplicated_open_rooms(apps, schema_editor):
+    """
+    keep only the latest open room per connector and token
+    """
+    LiveChatRoom = apps.get_model("envelope", "LiveChatRoom")
+    duplicated = (
+        LiveChatRoom.objects.filter(open=True)
+        .values("connector", "token")
+        .annotate(total=Count("id"))
+        .filter(total__gt=1)
+    )
+    for duplicate in duplicated:
+        rooms = LiveChatRoom.objects.filter(
+            open=True, connector=duplicate["connector"], token=duplicate["token"]
+        ).order_by("-created", "-id")
+        LiveChatRoom.objects.filter(
+            id__in=list(rooms.values_list("id", flat=True)[1:])
+        ).update(open=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('envelope', '0011_providermessage'),
+    ]
+
+    operations = [
+        migrations.RunPython(close_duplicated_open_rooms, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='livechatroom',
+            index=models.Index(fields=['room_id'], name='envelope_li_room_id_212b7c_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='livechatroom',
+            constraint=models.UniqueConstraint(condition=models.Q(('open', True)), fields=('connector', 'token'), name='unique_open_room_per_token'),
+        ),
+    ]
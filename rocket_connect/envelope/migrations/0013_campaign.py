@@ -0,0 +1,146 @@
+# Generated by Django 3.2.13 on 2026-10-18 15:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("instance", "0020_alter_connector_config"),
+        ("envelope", "0012_livechatroom_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Campaign",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=100)),
+                (
+                    "template",
+                    models.TextField(
+                        help_text="the message sent, as a template with {{number}} available"
+                    ),
+                ),
+                ("department", models.CharField(blank=True, max_length=100, null=True)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ["pending", "Pending"],
+                            ["running", "Running"],
+                            ["done", "Done"],
+                            ["canceled", "Canceled"],
+                        ],
+                        default="pending",
+                        max_length=20,
+                    ),
+                ),
+                (
+                    "origin_room_id",
+                    models.CharField(blank=True, max_length=50, null=True),
+                ),
+                (
+                    "origin_message_id",
+                    models.CharField(blank=True, max_length=50, null=True),
+                ),
+                ("origin_text", models.TextField(blank=True, null=True)),
+                (
+                    "created",
+                    models.DateTimeField(auto_now_add=True, verbose_name="Created"),
+                ),
+                (
+                    "updated",
+                    models.DateTimeField(auto_now=True, verbose_name="Updated"),
+                ),
+                (
+                    "connector",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="campaigns",
+                        to="instance.connector",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Campaign",
+                "verbose_name_plural": "Campaigns",
+                "ordering": ("-created",),
+            },
+        ),
+        migrations.CreateModel(
+            name="CampaignRecipient",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("number", models.CharField(max_length=50)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ["pending", "Pending"],
+                            ["valid", "Valid"],
+                            ["invalid", "Invalid"],
+                            ["sent", "Sent"],
+                            ["failed", "Failed"],
+                        ],
+                        default="pending",
+                        max_length=20,
+                    ),
+                ),
+                ("error", models.TextField(blank=True, null=True)),
+                (
+                    "updated",
+                    models.DateTimeField(auto_now=True, verbose_name="Updated"),
+                ),
+                (
+                    "campaign",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="recipients",
+                        to="envelope.campaign",
+                    ),
+                ),
+                (
+                    "room",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="campaign_recipients",
+                        to="envelope.livechatroom",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Campaign Recipient",
+                "verbose_name_plural": "Campaign Recipients",
+            },
+        ),
+        migrations.AddIndex(
+            model_name="campaignrecipient",
+            index=models.Index(
+                fields=["campaign", "status"], name="envelope_ca_campaig_b73e30_idx"
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="campaignrecipient",
+            unique_together={("campaign", "number")},
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.13 on 2026-10-18 15:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('envelope', '0013_campaign'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeliveryAttempt',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('direction', models.CharField(choices=[['outcome', 'To Rocket.Chat'], ['outgo', 'To the Provider']], max_length=20)),
+                ('delivered', models.BooleanField(default=False)),
+                ('status_code', models.IntegerField(blank=True, null=True)),
+                ('payload', models.JSONField(blank=True, null=True)),
+                ('response', models.JSONField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='delivery_attempts', to='envelope.message')),
+            ],
+            options={
+                'verbose_name': 'Delivery Attempt',
+                'verbose_name_plural': 'Delivery Attempts',
+                'ordering': ('id',),
+            },
+        ),
+    ]
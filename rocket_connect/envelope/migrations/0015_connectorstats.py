@@ -0,0 +1,51 @@
+# Generated by Django 3.2.13 on 2026-10-18 15:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("instance", "0020_alter_connector_config"),
+        ("envelope", "0014_deliveryattempt"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ConnectorStats",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("total_messages", models.IntegerField(default=0)),
+                ("undelivered_messages", models.IntegerField(default=0)),
+                ("total_rooms", models.IntegerField(default=0)),
+                ("open_rooms", models.IntegerField(default=0)),
+                ("total_visitors", models.IntegerField(default=0)),
+                ("last_message", models.DateTimeField(blank=True, null=True)),
+                (
+                    "updated",
+                    models.DateTimeField(auto_now=True, verbose_name="Updated"),
+                ),
+                (
+                    "connector",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="stats",
+                        to="instance.connector",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Connector Stats",
+                "verbose_name_plural": "Connector Stats",
+            },
+        ),
+    ]
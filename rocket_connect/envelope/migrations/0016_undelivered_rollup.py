@@ -0,0 +1,63 @@
+# Generated by Django 3.2.13 on 2026-10-18 15:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("instance", "0020_alter_connector_config"),
+        ("envelope", "0015_connectorstats"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UndeliveredDay",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField()),
+                ("messages_count", models.IntegerField(default=0)),
+                ("rooms_count", models.IntegerField(default=0)),
+                ("dirty", models.BooleanField(default=False)),
+                (
+                    "updated",
+                    models.DateTimeField(auto_now=True, verbose_name="Updated"),
+                ),
+            ],
+            options={
+                "verbose_name": "Undelivered Day",
+                "verbose_name_plural": "Undelivered Days",
+                "ordering": ("-date",),
+            },
+        ),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                condition=models.Q(("delivered", False)),
+                fields=["connector", "created"],
+                name="undelivered_message_idx",
+            ),
+        ),
+        migrations.AddField(
+            model_name="undeliveredday",
+            name="connector",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="undelivered_days",
+                to="instance.connector",
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="undeliveredday",
+            unique_together={("connector", "date")},
+        ),
+    ]
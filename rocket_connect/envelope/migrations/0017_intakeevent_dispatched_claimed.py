@@ -0,0 +1,23 @@
+# Generated by Django 3.2.13 on 2026-10-18 15:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('envelope', '0016_undelivered_rollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='intakeevent',
+            name='claimed',
+            field=models.DateTimeField(blank=True, help_text='when a worker took it', null=True),
+        ),
+        migrations.AddField(
+            model_name='intakeevent',
+            name='dispatched',
+            field=models.DateTimeField(blank=True, help_text='last time it was sent to the workers', null=True),
+        ),
+    ]
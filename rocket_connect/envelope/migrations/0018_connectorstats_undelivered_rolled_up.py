@@ -0,0 +1,18 @@
+# Generated by Django 3.2.13 on 2026-10-18 15:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('envelope', '0017_intakeevent_dispatched_claimed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='connectorstats',
+            name='undelivered_rolled_up',
+            field=models.DateField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.13 on 2026-10-18 16:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('envelope', '0018_connectorstats_undelivered_rolled_up'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='campaign',
+            name='template',
+            field=models.TextField(help_text='the message sent, with {{number}} replaced by the number'),
+        ),
+    ]
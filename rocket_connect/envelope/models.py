@@ -1,13 +1,31 @@
+import datetime
 import json
+import re
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
+
+# replaced by the number in the campaign text
+NUMBER_PLACEHOLDER = re.compile(r"\{\{\s*number\s*\}\}")
 
 
 class LiveChatRoom(models.Model):
     class Meta:
         verbose_name = "Live Chat Room"
         verbose_name_plural = "Live Chat Rooms"
+        constraints = [
+            # only one open room per visitor, and the index for get_room
+            models.UniqueConstraint(
+                fields=["connector", "token"],
+                condition=models.Q(open=True),
+                name="unique_open_room_per_token",
+            )
+        ]
+        indexes = [models.Index(fields=["room_id"])]
 
     def __str__(self):
         return f"{self.token} at {self.room_id}"
@@ -32,6 +50,14 @@ class Message(models.Model):
         verbose_name_plural = "Messages"
         ordering = ("created",)
         unique_together = [("envelope_id", "type")]
+        indexes = [
+            # only the undelivered messages, a small part of the table
+            models.Index(
+                fields=["connector", "created"],
+                condition=models.Q(delivered=False),
+                name="undelivered_message_idx",
+            )
+        ]
 
     # STAGE TYPE CHOICES
     STAGE_CHOICES = [
@@ -40,13 +66,14 @@ class Message(models.Model):
         ["active_chat", "Active Chat"],
     ]
 
-    def get_connector(self):
-        Connector = self.connector.get_connector_class()
+    def get_connector(self, Connector=None):
+        if not Connector:
+            Connector = self.connector.get_connector_class()
         message = json.dumps(self.raw_message)
         return Connector(self.connector, message, self.type)
 
-    def force_delivery(self):
-        c = self.get_connector()
+    def force_delivery(self, Connector=None):
+        c = self.get_connector(Connector)
         if c.type == "incoming":
             c.incoming()
         elif c.type == "active_chat":
@@ -55,6 +82,17 @@ class Message(models.Model):
             c.ingoing()
         return c.message_object.delivered
 
+    def get_outgoing_text(self):
+        """
+        the text of the Rocket.Chat message sent out, as received at
+        the ingoing webhook. None if not available
+        """
+        if isinstance(self.raw_message, dict):
+            for message in self.raw_message.get("messages") or []:
+                if message.get("_id") == self.envelope_id:
+                    return message.get("msg")
+        return None
+
     uuid = models.UUIDField(default=uuid.uuid4, editable=False)
     type = models.CharField(max_length=50, choices=STAGE_CHOICES, default="incoming")
     envelope_id = models.CharField(max_length=100)
@@ -85,3 +123,439 @@ class Message(models.Model):
         blank=True, auto_now_add=True, verbose_name="Created"
     )
     updated = models.DateTimeField(blank=True, auto_now=True, verbose_name="Updated")
+
+
+class DeliveryAttempt(models.Model):
+    """
+    an attempt to deliver a message to Rocket.Chat (outcome) or to the
+    provider (outgo). Attempts are only appended, so the message row
+    is not rewritten on every attempt
+    """
+
+    class Meta:
+        verbose_name = "Delivery Attempt"
+        verbose_name_plural = "Delivery Attempts"
+        ordering = ("id",)
+
+    DIRECTION_CHOICES = [
+        ["outcome", "To Rocket.Chat"],
+        ["outgo", "To the Provider"],
+    ]
+
+    # strings longer than this are cut, eg. base64 files
+    MAX_STRING_LENGTH = 1000
+
+    def __str__(self):
+        return f"{self.direction} attempt of {self.message}"
+
+    @classmethod
+    def summarize(cls, data):
+        if isinstance(data, dict):
+            return {key: cls.summarize(value) for key, value in data.items()}
+        if isinstance(data, list):
+            return [cls.summarize(value) for value in data]
+        if isinstance(data, str) and len(data) > cls.MAX_STRING_LENGTH:
+            return data[: cls.MAX_STRING_LENGTH] + "..."
+        return data
+
+    message = models.ForeignKey(
+        Message, on_delete=models.CASCADE, related_name="delivery_attempts"
+    )
+    direction = models.CharField(max_length=20, choices=DIRECTION_CHOICES)
+    delivered = models.BooleanField(default=False)
+    status_code = models.IntegerField(blank=True, null=True)
+    payload = models.JSONField(blank=True, null=True)
+    response = models.JSONField(blank=True, null=True)
+    # meta
+    created = models.DateTimeField(
+        blank=True, auto_now_add=True, verbose_name="Created"
+    )
+
+
+class ProviderMessage(models.Model):
+    """
+    the id given by the provider (eg. WhatsApp) to a message sent out,
+    so the ack receipts can find the message and room with a single lookup
+    """
+
+    class Meta:
+        verbose_name = "Provider Message"
+        verbose_name_plural = "Provider Messages"
+        unique_together = [("connector", "provider_message_id")]
+
+    def __str__(self):
+        return f"{self.provider_message_id} for {self.message}"
+
+    connector = models.ForeignKey(
+        "instance.Connector", on_delete=models.CASCADE, related_name="provider_messages"
+    )
+    provider_message_id = models.CharField(max_length=200)
+    message = models.ForeignKey(
+        Message, on_delete=models.CASCADE, related_name="provider_messages"
+    )
+    room = models.ForeignKey(
+        LiveChatRoom,
+        on_delete=models.CASCADE,
+        related_name="provider_messages",
+        blank=True,
+        null=True,
+    )
+    # meta
+    created = models.DateTimeField(
+        blank=True, auto_now_add=True, verbose_name="Created"
+    )
+
+
+class IntakeEvent(models.Model):
+    """
+    raw incoming payload persisted for the asynchronous intake,
+    waiting to be processed by the intake workers
+    """
+
+    class Meta:
+        verbose_name = "Intake Event"
+        verbose_name_plural = "Intake Events"
+        ordering = ("id",)
+        indexes = [models.Index(fields=["connector", "lane", "id"])]
+
+    # after this many attempts, the event stops blocking its lane
+    MAX_ATTEMPTS = 3
+
+    def __str__(self):
+        return f"Intake Event #{self.id} for {self.connector}"
+
+    def dispatch(self):
+        """
+        send the event to the intake workers. Events with a lane are
+        drained in order by a single worker at a time
+        """
+        from instance import tasks
+
+        IntakeEvent.objects.filter(id=self.id).update(dispatched=timezone.now())
+        if self.lane:
+            tasks.intake_lane.delay(self.connector_id, self.lane)
+        else:
+            tasks.intake_event.delay(self.id)
+
+    def claim(self):
+        """
+        take the event for a worker. return False if another worker has it.
+        a claim older than the task time limit belongs to a lost worker
+        """
+        now = timezone.now()
+        lost = now - datetime.timedelta(seconds=settings.CELERY_TASK_TIME_LIMIT)
+        return bool(
+            IntakeEvent.objects.filter(
+                models.Q(claimed__isnull=True) | models.Q(claimed__lte=lost),
+                id=self.id,
+            ).update(claimed=now)
+        )
+
+    def process(self):
+        """
+        run the regular intake with the persisted body.
+        the event is removed once processed
+        """
+        IntakeEvent.objects.filter(id=self.id).update(
+            attempts=models.F("attempts") + 1, claimed=timezone.now()
+        )
+        try:
+            response = self.connector.intake(body=self.body)
+        except Exception:
+            # release it, so it can be retried
+            IntakeEvent.objects.filter(id=self.id).update(claimed=None)
+            raise
+        self.delete()
+        return response
+
+    connector = models.ForeignKey(
+        "instance.Connector", on_delete=models.CASCADE, related_name="intake_events"
+    )
+    body = models.TextField()
+    lane = models.CharField(
+        max_length=100,
+        blank=True,
+        null=True,
+        help_text="the visitor token. Events from the same lane are processed in order",
+    )
+    attempts = models.IntegerField(default=0)
+    dispatched = models.DateTimeField(
+        blank=True, null=True, help_text="last time it was sent to the workers"
+    )
+    claimed = models.DateTimeField(
+        blank=True, null=True, help_text="when a worker took it"
+    )
+    # meta
+    created = models.DateTimeField(
+        blank=True, auto_now_add=True, verbose_name="Created"
+    )
+
+
+class Campaign(models.Model):
+    """
+    an active message sent to many numbers, each one in its own room
+    """
+
+    class Meta:
+        verbose_name = "Campaign"
+        verbose_name_plural = "Campaigns"
+        ordering = ("-created",)
+
+    STATUS_CHOICES = [
+        ["pending", "Pending"],
+        ["running", "Running"],
+        ["done", "Done"],
+        ["canceled", "Canceled"],
+    ]
+
+    def __str__(self):
+        return f"Campaign {self.name} for {self.connector}"
+
+    def dispatch(self, countdown=None):
+        from instance import tasks
+
+        tasks.run_campaign.apply_async(args=[self.id], countdown=countdown)
+
+    def get_progress(self):
+        progress = {status: 0 for status, label in CampaignRecipient.STATUS_CHOICES}
+        for status in self.recipients.values("status").annotate(
+            total=models.Count("id")
+        ):
+            progress[status["status"]] = status["total"]
+        progress["total"] = sum(progress.values())
+        return progress
+
+    def report_progress(self):
+        """
+        show the progress at the Rocket.Chat message that started the campaign
+        """
+        if not self.origin_room_id or not self.origin_message_id:
+            return None
+        progress = self.get_progress()
+        icon = {"done": ":white_check_mark:", "canceled": ":stop_sign:"}.get(
+            self.status, ":hourglass:"
+        )
+        text = "{}\n{} CAMPAIGN {}: {} sent, {} invalid, {} failed of {}".format(
+            self.origin_text or "",
+            icon,
+            self.status.upper(),
+            progress["sent"],
+            progress["invalid"],
+            progress["failed"],
+            progress["total"],
+        )
+        rocket = self.connector.server.get_rocket_client()
+        return rocket.chat_update(
+            room_id=self.origin_room_id, msg_id=self.origin_message_id, text=text
+        )
+
+    def send(self, recipient):
+        """
+        send the campaign to a recipient, in its own connector instance
+        """
+        from django.db import connection
+
+        try:
+            Connector = self.connector.get_connector_class()
+            connector = Connector(self.connector, {}, "active_chat")
+            # a literal placeholder, the text is typed by the agents
+            text = NUMBER_PLACEHOLDER.sub(lambda match: recipient.number, self.template)
+            sent = connector.send_active_message(
+                recipient.number,
+                text,
+                department=self.department,
+                message_id=f"campaign-{self.id}-{recipient.id}",
+            )
+            recipient.status = "sent" if sent.get("success") else "failed"
+            recipient.room = sent.get("room")
+            recipient.error = None if sent.get("success") else sent.get("message")
+        except Exception as e:
+            recipient.status = "failed"
+            recipient.error = str(e)
+        recipient.save()
+        # threads get their own database connection
+        connection.close()
+        return recipient.status
+
+    def run(self, time_budget=None):
+        """
+        validate and send the pending recipients, with bounded concurrency
+        and paced to the connector send rate, for at most time_budget seconds.
+        return True when there is nothing left to send
+        """
+        if time_budget is None:
+            time_budget = settings.CELERY_TASK_SOFT_TIME_LIMIT * 0.75
+        started = time.monotonic()
+        self.refresh_from_db(fields=["status"])
+        if self.status in ["done", "canceled"]:
+            return True
+        if self.status == "pending":
+            self.status = "running"
+            self.save(update_fields=["status", "updated"])
+
+        Connector = self.connector.get_connector_class()
+        connector = Connector(self.connector, {}, "active_chat")
+        # validate the numbers in bulk
+        pending = self.recipients.filter(status="pending")
+        # the lookup failed (eg. the gateway is down), checked on the next run
+        unknown = []
+        numbers = list(pending.values_list("number", flat=True)[:500])
+        while numbers and time.monotonic() - started < time_budget:
+            validated = connector.validate_numbers(numbers)
+            valid = [number for number in numbers if validated.get(number)]
+            invalid = [number for number in numbers if validated.get(number) is False]
+            pending.filter(number__in=valid).update(status="valid")
+            pending.filter(number__in=invalid).update(status="invalid")
+            unknown += [number for number in numbers if validated.get(number) is None]
+            remaining = pending.exclude(number__in=unknown)
+            numbers = list(remaining.values_list("number", flat=True)[:500])
+
+        # send, paced to the connector rate
+        config = self.connector.config
+        concurrency = config.get("campaign_concurrency") or 3
+        interval = 60 / (config.get("campaign_messages_per_minute") or 20)
+        remaining = time_budget - (time.monotonic() - started)
+        batch = max(int(remaining / interval), 1)
+        recipients = list(self.recipients.filter(status="valid").order_by("id")[:batch])
+        last_report = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for recipient in recipients:
+                if time.monotonic() - started > time_budget:
+                    break
+                executor.submit(self.send, recipient)
+                if time.monotonic() - last_report > 10:
+                    last_report = time.monotonic()
+                    self.refresh_from_db(fields=["status"])
+                    if self.status == "canceled":
+                        break
+                    self.report_progress()
+                time.sleep(interval)
+
+        done = not self.recipients.filter(status__in=["pending", "valid"]).exists()
+        self.refresh_from_db(fields=["status"])
+        if done and self.status == "running":
+            self.status = "done"
+            self.save(update_fields=["status", "updated"])
+        self.report_progress()
+        return done or self.status == "canceled"
+
+    connector = models.ForeignKey(
+        "instance.Connector", on_delete=models.CASCADE, related_name="campaigns"
+    )
+    name = models.CharField(max_length=100)
+    template = models.TextField(
+        help_text="the message sent, with {{number}} replaced by the number"
+    )
+    department = models.CharField(max_length=100, blank=True, null=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    # the Rocket.Chat message that started the campaign
+    origin_room_id = models.CharField(max_length=50, blank=True, null=True)
+    origin_message_id = models.CharField(max_length=50, blank=True, null=True)
+    origin_text = models.TextField(blank=True, null=True)
+    # meta
+    created = models.DateTimeField(
+        blank=True, auto_now_add=True, verbose_name="Created"
+    )
+    updated = models.DateTimeField(blank=True, auto_now=True, verbose_name="Updated")
+
+
+class CampaignRecipient(models.Model):
+    class Meta:
+        verbose_name = "Campaign Recipient"
+        verbose_name_plural = "Campaign Recipients"
+        unique_together = [("campaign", "number")]
+        indexes = [models.Index(fields=["campaign", "status"])]
+
+    STATUS_CHOICES = [
+        ["pending", "Pending"],
+        ["valid", "Valid"],
+        ["invalid", "Invalid"],
+        ["sent", "Sent"],
+        ["failed", "Failed"],
+    ]
+
+    def __str__(self):
+        return f"{self.number} at {self.campaign}"
+
+    campaign = models.ForeignKey(
+        Campaign, on_delete=models.CASCADE, related_name="recipients"
+    )
+    number = models.CharField(max_length=50)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    room = models.ForeignKey(
+        LiveChatRoom,
+        on_delete=models.SET_NULL,
+        related_name="campaign_recipients",
+        blank=True,
+        null=True,
+    )
+    error = models.TextField(blank=True, null=True)
+    # meta
+    updated = models.DateTimeField(blank=True, auto_now=True, verbose_name="Updated")
+
+
+class ConnectorStats(models.Model):
+    """
+    counters of the messages and rooms of a connector, kept up to date
+    as they are written, so the status pages do not aggregate them
+    """
+
+    class Meta:
+        verbose_name = "Connector Stats"
+        verbose_name_plural = "Connector Stats"
+
+    COUNTERS = [
+        "total_messages",
+        "undelivered_messages",
+        "total_rooms",
+        "open_rooms",
+        "total_visitors",
+    ]
+
+    def __str__(self):
+        return f"Stats of {self.connector}"
+
+    def as_dict(self):
+        status = {counter: getattr(self, counter) for counter in self.COUNTERS}
+        status["last_message"] = self.last_message
+        return status
+
+    connector = models.OneToOneField(
+        "instance.Connector", on_delete=models.CASCADE, related_name="stats"
+    )
+    total_messages = models.IntegerField(default=0)
+    undelivered_messages = models.IntegerField(default=0)
+    total_rooms = models.IntegerField(default=0)
+    open_rooms = models.IntegerField(default=0)
+    total_visitors = models.IntegerField(default=0)
+    last_message = models.DateTimeField(blank=True, null=True)
+    # the undelivered days are rolled up through this date
+    undelivered_rolled_up = models.DateField(blank=True, null=True)
+    # meta
+    updated = models.DateTimeField(blank=True, auto_now=True, verbose_name="Updated")
+
+
+class UndeliveredDay(models.Model):
+    """
+    rollup of the undelivered messages of a connector per day
+    """
+
+    class Meta:
+        verbose_name = "Undelivered Day"
+        verbose_name_plural = "Undelivered Days"
+        unique_together = [("connector", "date")]
+        ordering = ("-date",)
+
+    def __str__(self):
+        return f"{self.messages_count} undelivered at {self.date} for {self.connector}"
+
+    connector = models.ForeignKey(
+        "instance.Connector", on_delete=models.CASCADE, related_name="undelivered_days"
+    )
+    date = models.DateField()
+    messages_count = models.IntegerField(default=0)
+    rooms_count = models.IntegerField(default=0)
+    # the day changed and must be counted again
+    dirty = models.BooleanField(default=False)
+    # meta
+    updated = models.DateTimeField(blank=True, auto_now=True, verbose_name="Updated")
@@ -0,0 +1,202 @@
+"""
+Bulk redelivery of the undelivered messages of a connector.
+
+The messages are split in buckets by room, so each room is delivered in order
+by a single worker while the buckets run in parallel. Each bucket keeps, in the
+cache, the last message it handled, so a run that stops (a worker crash, a
+deploy) resumes from there when started again. Messages Rocket.Chat already
+has under the same _id are only marked as delivered, and messages the rate
+limiter deferred to the workers are counted apart from the failed ones.
+"""
+import datetime
+import logging
+import time
+
+from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.functions import Coalesce, Mod
+from django.utils import timezone
+from envelope import stats
+from envelope.models import Message
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 100
+COUNTERS = ["delivered", "skipped", "deferred", "failed", "finished_buckets"]
+
+
+def progress_key(connector_id):
+    return f"redelivery:{connector_id}"
+
+
+def counter_key(connector_id, counter):
+    return f"redelivery:{connector_id}:{counter}"
+
+
+def checkpoint_key(connector_id, bucket):
+    return f"redelivery:{connector_id}:bucket:{bucket}"
+
+
+def finished_key(connector_id, bucket):
+    return f"redelivery:{connector_id}:bucket:{bucket}:finished"
+
+
+def get_progress(connector_id):
+    """
+    the progress of the last redelivery run of the connector, or None
+    """
+    progress = cache.get(progress_key(connector_id))
+    if not progress:
+        return None
+    for counter in COUNTERS:
+        progress[counter] = cache.get(counter_key(connector_id, counter)) or 0
+    progress["heartbeat"] = cache.get(counter_key(connector_id, "heartbeat"))
+    if progress["finished_buckets"] >= progress["buckets"]:
+        progress["status"] = "done"
+    elif time.time() - (progress["heartbeat"] or 0) > settings.CELERY_TASK_TIME_LIMIT:
+        # no bucket reported for too long, the workers were lost
+        progress["status"] = "stalled"
+    else:
+        progress["status"] = "running"
+    progress["handled"] = sum(
+        progress[counter] for counter in ["delivered", "skipped", "deferred", "failed"]
+    )
+    return progress
+
+
+def get_messages(connector, date=None):
+    if date:
+        date = datetime.date.fromisoformat(date)
+    return stats.get_undelivered_messages(connector.id, date)
+
+
+def start(connector, date=None):
+    """
+    start the redelivery of the undelivered messages of the connector,
+    optionally of a single day. A stalled run is resumed instead.
+    return the progress
+    """
+    from instance import tasks
+
+    date = date.isoformat() if date else None
+    progress = get_progress(connector.id)
+    if progress and progress["status"] == "running":
+        return progress
+    if not progress or progress["status"] != "stalled" or progress["date"] != date:
+        buckets = settings.REDELIVERY_CONCURRENCY
+        keys = [counter_key(connector.id, counter) for counter in COUNTERS]
+        for bucket in range(buckets):
+            keys += [
+                checkpoint_key(connector.id, bucket),
+                finished_key(connector.id, bucket),
+            ]
+        cache.delete_many(keys)
+        progress = {
+            "date": date,
+            "buckets": buckets,
+            "total": get_messages(connector, date).count(),
+            "started": timezone.now().isoformat(),
+        }
+        cache.set(progress_key(connector.id), progress, timeout=None)
+    cache.set(counter_key(connector.id, "heartbeat"), time.time(), timeout=None)
+    for bucket in range(progress["buckets"]):
+        if not cache.get(finished_key(connector.id, bucket)):
+            tasks.redeliver_messages.delay(connector.id, bucket)
+    return get_progress(connector.id)
+
+
+def _count(connector_id, counter, value=1):
+    key = counter_key(connector_id, counter)
+    cache.add(key, 0, timeout=None)
+    cache.incr(key, value)
+
+
+def get_delivered_ids(connector, messages):
+    """
+    the ids, among the messages sent to Rocket.Chat, that it already has.
+    one request per room
+    """
+    since = {}
+    for message in messages:
+        if message.type == "incoming" and message.room:
+            room_id = message.room.room_id
+            since[room_id] = min(since.get(room_id, message.created), message.created)
+    if not since:
+        return set()
+    rocket = connector.server.get_rocket_client()
+    delivered_ids = set()
+    for room_id, created in since.items():
+        last_update = created - datetime.timedelta(seconds=1)
+        try:
+            response = rocket.call_api_get(
+                "chat.syncMessages",
+                roomId=room_id,
+                lastUpdate=last_update.isoformat(),
+            )
+        except Exception:
+            logger.exception(f"could not sync the messages of room {room_id}")
+            continue
+        if response.ok:
+            for message in response.json().get("result", {}).get("updated", []):
+                delivered_ids.add(message["_id"])
+    return delivered_ids
+
+
+def run_bucket(connector, bucket, time_budget=50):
+    """
+    redeliver, in order, the messages of a bucket for up to time_budget
+    seconds. return True when the bucket is done
+    """
+    from instance import ratelimit
+
+    progress = cache.get(progress_key(connector.id))
+    if not progress:
+        return True
+    messages = (
+        get_messages(connector, progress["date"])
+        .annotate(bucket=Mod(Coalesce("room_id", 0), progress["buckets"]))
+        .filter(bucket=bucket)
+        .select_related("connector__server", "room")
+        .order_by("id")
+    )
+    # the plugin class is looked up once for all the messages
+    Connector = connector.get_connector_class()
+    checkpoint = checkpoint_key(connector.id, bucket)
+    last_id = cache.get(checkpoint) or 0
+    started = time.monotonic()
+    while time.monotonic() - started < time_budget:
+        chunk = list(messages.filter(id__gt=last_id)[:CHUNK_SIZE])
+        if not chunk:
+            if cache.add(finished_key(connector.id, bucket), True, timeout=None):
+                _count(connector.id, "finished_buckets")
+            return True
+        delivered_ids = get_delivered_ids(connector, chunk)
+        for message in chunk:
+            if message.envelope_id in delivered_ids:
+                Message.objects.filter(id=message.id).update(delivered=True)
+                stats.add(connector.id, undelivered_messages=-1)
+                stats.mark_undelivered_day(connector.id, message.created)
+                _count(connector.id, "skipped")
+            else:
+                try:
+                    delivered = message.force_delivery(Connector)
+                except SoftTimeLimitExceeded:
+                    # the task must stop, the checkpoint resumes it
+                    raise
+                except Exception:
+                    logger.exception(f"could not redeliver message {message.id}")
+                    delivered = False
+                if delivered:
+                    _count(connector.id, "delivered")
+                elif ratelimit.is_deferred(message.id):
+                    # the workers will deliver it
+                    _count(connector.id, "deferred")
+                else:
+                    _count(connector.id, "failed")
+            last_id = message.id
+            cache.set(checkpoint, last_id, timeout=None)
+            cache.set(counter_key(connector.id, "heartbeat"), time.time(), timeout=None)
+            if time.monotonic() - started > time_budget:
+                break
+    return False
@@ -0,0 +1,154 @@
+"""
+Shared cache of the live chat rooms, used by the message path to resolve
+the open room of a visitor, and the room of a Rocket.Chat webhook,
+without a database round-trip.
+
+Rooms are written through on save (see envelope.signals). Bulk updates do
+not send signals, so rooms must be closed with close_rooms.
+"""
+import collections
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+
+
+def open_room_key(connector_id, token):
+    return f"open_room:{connector_id}:{token}"
+
+
+def room_key(room_id):
+    return f"room:{room_id}"
+
+
+def room_state_key(room_id):
+    """
+    the room state in Rocket.Chat, see Connector.is_room_open_in_rocketchat
+    """
+    return f"room_state:{room_id}"
+
+
+def set_room_state(room_id, open):
+    cache.set(room_state_key(room_id), open, timeout=settings.ROOM_STATE_CACHE_TIMEOUT)
+
+
+def _dump(room):
+    return {
+        field.attname: getattr(room, field.attname)
+        for field in room._meta.concrete_fields
+    }
+
+
+def _load(entry):
+    LiveChatRoom = apps.get_model(app_label="envelope", model_name="LiveChatRoom")
+    return LiveChatRoom.from_db("default", list(entry.keys()), list(entry.values()))
+
+
+def cache_room(room):
+    """
+    write the room state to the cache
+    """
+    entry = _dump(room)
+    entries = {room_key(room.room_id): entry}
+    if room.open:
+        entries[open_room_key(room.connector_id, room.token)] = entry
+    else:
+        forget_open_room(room.connector_id, room.token, room.room_id)
+        cache.delete(room_state_key(room.room_id))
+    cache.set_many(entries, timeout=settings.ROOM_CACHE_TIMEOUT)
+
+
+def forget_open_room(connector_id, token, room_id):
+    key = open_room_key(connector_id, token)
+    entry = cache.get(key)
+    # a newer open room may already be cached
+    if entry and entry["room_id"] == room_id:
+        cache.delete(key)
+
+
+def forget_room(room):
+    cache.delete(room_key(room.room_id))
+    forget_open_room(room.connector_id, room.token, room.room_id)
+
+
+def get_open_room(connector, token):
+    """
+    return the open room of the visitor,
+    or raise LiveChatRoom.DoesNotExist
+    """
+    entry = cache.get(open_room_key(connector.id, token))
+    if entry:
+        return _load(entry)
+    LiveChatRoom = apps.get_model(app_label="envelope", model_name="LiveChatRoom")
+    room = LiveChatRoom.objects.get(connector=connector, token=token, open=True)
+    cache_room(room)
+    return room
+
+
+def get_room(room_id):
+    """
+    return the room by its Rocket.Chat id, or None
+    """
+    entry = cache.get(room_key(room_id))
+    if entry:
+        return _load(entry)
+    LiveChatRoom = apps.get_model(app_label="envelope", model_name="LiveChatRoom")
+    room = LiveChatRoom.objects.filter(room_id=room_id).order_by("-open", "-id").first()
+    if room:
+        cache_room(room)
+    return room
+
+
+def close_rooms(rooms):
+    """
+    close the rooms of a queryset and drop them from the cache.
+    return the number of closed rooms
+    """
+    closing = list(
+        rooms.filter(open=True).values_list("connector_id", "token", "room_id")
+    )
+    closed = rooms.filter(open=True).update(open=False)
+    cache.delete_many(
+        [room_key(room_id) for connector_id, token, room_id in closing]
+        + [room_state_key(room_id) for connector_id, token, room_id in closing]
+    )
+    for connector_id, token, room_id in closing:
+        forget_open_room(connector_id, token, room_id)
+    from envelope import stats
+
+    # the update skips the signals
+    closed_by_connector = collections.Counter(
+        connector_id for connector_id, token, room_id in closing
+    )
+    for connector_id, total in closed_by_connector.items():
+        stats.add(connector_id, open_rooms=-total)
+    return closed
+
+
+def reconcile(local_rooms, open_rooms_id, execute=False, is_open=None):
+    """
+    compare the open rooms of a queryset with the rooms open in Rocket.Chat,
+    and optionally close the ones that are not open there anymore.
+
+    open_rooms_id is read page by page while rooms open and close, so a room
+    can be missed. Before closing, each room is checked again with is_open
+    """
+    local_open_rooms_id = set(
+        local_rooms.filter(open=True).values_list("room_id", flat=True)
+    )
+    close_rooms_id = sorted(local_open_rooms_id - set(open_rooms_id))
+    response = {
+        "total": len(close_rooms_id),
+        "close_rooms_id": close_rooms_id,
+        "open_rooms_total": len(open_rooms_id),
+        "local_open_rooms_total": len(local_open_rooms_id),
+    }
+    if execute and close_rooms_id:
+        if is_open:
+            still_open = [room_id for room_id in close_rooms_id if is_open(room_id)]
+            close_rooms_id = [i for i in close_rooms_id if i not in still_open]
+            response["still_open_rooms_id"] = still_open
+        response["executed"] = close_rooms(
+            local_rooms.filter(room_id__in=close_rooms_id)
+        )
+    return response
@@ -0,0 +1,37 @@
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+from envelope import rooms, stats
+from envelope.models import LiveChatRoom, Message
+
+
+@receiver(post_save, sender=LiveChatRoom)
+def cache_room(sender, instance, **kwargs):
+    rooms.cache_room(instance)
+
+
+@receiver(post_delete, sender=LiveChatRoom)
+def forget_room(sender, instance, **kwargs):
+    rooms.forget_room(instance)
+
+
+@receiver(post_init, sender=LiveChatRoom)
+def track_room_open(sender, instance, **kwargs):
+    # not loaded when deferred
+    instance._stats_open = instance.__dict__.get("open")
+
+
+@receiver(post_save, sender=LiveChatRoom)
+def count_room(sender, instance, created, update_fields=None, **kwargs):
+    stats.room_saved(instance, created, update_fields)
+
+
+@receiver(post_init, sender=Message)
+def track_message_delivered(sender, instance, **kwargs):
+    instance._stats_delivered = instance.__dict__.get("delivered")
+
+
+@receiver(post_save, sender=Message)
+def count_message(sender, instance, created, update_fields=None, raw=False, **kwargs):
+    # the restored messages are counted at once, by the restore
+    if not raw:
+        stats.message_saved(instance, created, update_fields)
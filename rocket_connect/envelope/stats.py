@@ -0,0 +1,253 @@
+"""
+Incremental counters of the messages and rooms of each connector.
+
+The counters are moved with atomic updates as messages and rooms are saved
+(see envelope.signals). Bulk updates that skip the signals must call add()
+themselves. A missing or drifted row is rebuilt with a full count.
+
+The rooms are counted from the LiveChatRoom table: every room of the connector,
+not only the rooms reached through its messages as the old aggregate did, so a
+room opened without messages (eg. by an active chat) is counted too.
+
+The undelivered messages are also rolled up per day. Every day since the last
+rollup, and always today and yesterday, are counted again with a single grouped
+query, using the partial index of the undelivered messages. Older days are only
+counted again when marked dirty.
+"""
+import datetime
+
+from django.db import IntegrityError, models, transaction
+from django.db.models.functions import Coalesce, Greatest, TruncDate
+from django.utils import timezone
+from envelope.models import ConnectorStats, LiveChatRoom, Message, UndeliveredDay
+
+
+def count(connector_id):
+    """
+    count everything again, with the aggregates the counters replace
+    """
+    messages = Message.objects.filter(connector_id=connector_id).aggregate(
+        total_messages=models.Count("id"),
+        undelivered_messages=models.Count(
+            "id", models.Q(delivered=False) | models.Q(delivered=None)
+        ),
+        last_message=models.Max("created"),
+    )
+    rooms = LiveChatRoom.objects.filter(connector_id=connector_id).aggregate(
+        total_rooms=models.Count("id"),
+        open_rooms=models.Count("id", models.Q(open=True)),
+        total_visitors=models.Count("token", distinct=True),
+    )
+    return {**messages, **rooms}
+
+
+def create(connector_id):
+    """
+    the row of a connector, counted from scratch.
+    return None if another write created it first
+    """
+    try:
+        with transaction.atomic():
+            return ConnectorStats.objects.create(
+                connector_id=connector_id, **count(connector_id)
+            )
+    except IntegrityError:
+        return None
+
+
+def rebuild(connector_id):
+    """
+    count everything again. The row is locked while counting, so the
+    changes of concurrent writes are applied after it instead of lost
+    """
+    with transaction.atomic():
+        stats = (
+            ConnectorStats.objects.select_for_update()
+            .filter(connector_id=connector_id)
+            .first()
+        )
+        if stats:
+            counted = count(connector_id)
+            for counter, value in counted.items():
+                setattr(stats, counter, value)
+            stats.save(update_fields=[*counted, "updated"])
+            return stats
+    return create(connector_id) or rebuild(connector_id)
+
+
+def get_stats(connector_id):
+    try:
+        return ConnectorStats.objects.get(connector_id=connector_id)
+    except ConnectorStats.DoesNotExist:
+        return rebuild(connector_id)
+
+
+def add(connector_id, last_message=None, **counters):
+    """
+    move the counters of a connector by the given amounts
+    """
+    changes = {
+        counter: models.F(counter) + value
+        for counter, value in counters.items()
+        if value
+    }
+    if last_message:
+        changes["last_message"] = Greatest(
+            Coalesce(models.F("last_message"), last_message), last_message
+        )
+    if not changes:
+        return
+    stats = ConnectorStats.objects.filter(connector_id=connector_id)
+    if not stats.update(**changes) and not create(connector_id):
+        # the first change of the connector raced with another one,
+        # which counted what was there: only move it
+        stats.update(**changes)
+
+
+def message_saved(message, created, update_fields=None):
+    if update_fields and "delivered" not in update_fields:
+        return
+    if created:
+        add(
+            message.connector_id,
+            last_message=message.created,
+            total_messages=1,
+            undelivered_messages=0 if message.delivered else 1,
+        )
+    elif message._stats_delivered is None:
+        # delivered was not loaded, the change is unknown
+        pass
+    elif message.delivered != message._stats_delivered:
+        add(
+            message.connector_id,
+            undelivered_messages=-1 if message.delivered else 1,
+        )
+        mark_undelivered_day(message.connector_id, message.created)
+    message._stats_delivered = message.delivered
+
+
+def room_saved(room, created, update_fields=None):
+    if update_fields and "open" not in update_fields:
+        return
+    if created:
+        new_visitor = not (
+            LiveChatRoom.objects.filter(
+                connector_id=room.connector_id, token=room.token
+            )
+            .exclude(id=room.id)
+            .exists()
+        )
+        add(
+            room.connector_id,
+            total_rooms=1,
+            open_rooms=1 if room.open else 0,
+            total_visitors=1 if new_visitor else 0,
+        )
+    elif room._stats_open is None:
+        pass
+    elif room.open != room._stats_open:
+        add(room.connector_id, open_rooms=1 if room.open else -1)
+    room._stats_open = room.open
+
+
+def day_range(date):
+    """
+    the start and end of a local day, so the created index can be used
+    """
+    start = timezone.make_aware(datetime.datetime.combine(date, datetime.time.min))
+    return start, start + datetime.timedelta(days=1)
+
+
+def get_undelivered_messages(connector_id, date=None):
+    messages = Message.objects.filter(connector_id=connector_id, delivered=False)
+    if date:
+        start, end = day_range(date)
+        messages = messages.filter(created__gte=start, created__lt=end)
+    return messages
+
+
+def mark_undelivered_day(connector_id, created):
+    """
+    the undelivered messages of a day changed. recent days
+    are always counted again, so only older ones are marked.
+    a day without undelivered messages gets its row now
+    """
+    date = timezone.localdate(created)
+    if date < timezone.localdate() - datetime.timedelta(days=1):
+        UndeliveredDay.objects.update_or_create(
+            connector_id=connector_id, date=date, defaults={"dirty": True}
+        )
+
+
+def count_undelivered_day(connector_id, date):
+    counted = get_undelivered_messages(connector_id, date).aggregate(
+        messages_count=models.Count("id"),
+        rooms_count=models.Count("room_id", distinct=True),
+    )
+    if not counted["messages_count"]:
+        UndeliveredDay.objects.filter(connector_id=connector_id, date=date).delete()
+        return None
+    day, created = UndeliveredDay.objects.update_or_create(
+        connector_id=connector_id, date=date, defaults={**counted, "dirty": False}
+    )
+    return day
+
+
+def roll_up_undelivered_days(connector_id, since=None):
+    """
+    count the undelivered messages of every day since a date (all of
+    them without one) with a single grouped query, and replace the
+    rows of those days
+    """
+    messages = get_undelivered_messages(connector_id)
+    days = UndeliveredDay.objects.filter(connector_id=connector_id)
+    if since:
+        messages = messages.filter(created__gte=day_range(since)[0])
+        days = days.filter(date__gte=since)
+    counted = {
+        day.pop("date"): day
+        for day in messages.annotate(date=TruncDate("created"))
+        .values("date")
+        .annotate(
+            messages_count=models.Count("id"),
+            rooms_count=models.Count("room_id", distinct=True),
+        )
+        .order_by()
+    }
+    existing = {day.date: day for day in days}
+    days.exclude(date__in=list(counted)).delete()
+    changed = []
+    for date, day in existing.items():
+        if date in counted:
+            for field, value in {**counted.pop(date), "dirty": False}.items():
+                setattr(day, field, value)
+            changed.append(day)
+    UndeliveredDay.objects.bulk_update(
+        changed, ["messages_count", "rooms_count", "dirty"]
+    )
+    UndeliveredDay.objects.bulk_create(
+        [
+            UndeliveredDay(connector_id=connector_id, date=date, **day)
+            for date, day in counted.items()
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def refresh_undelivered_days(connector_id):
+    """
+    bring the rollup up to date, counting only what may have changed
+    """
+    today = timezone.localdate()
+    since = get_stats(connector_id).undelivered_rolled_up
+    if since:
+        # yesterday may have changed after it was rolled up
+        since = min(since, today - datetime.timedelta(days=1))
+    roll_up_undelivered_days(connector_id, since)
+    ConnectorStats.objects.filter(connector_id=connector_id).update(
+        undelivered_rolled_up=today
+    )
+    days = UndeliveredDay.objects.filter(connector_id=connector_id)
+    for date in days.filter(dirty=True).values_list("date", flat=True):
+        count_undelivered_day(connector_id, date)
+    return days
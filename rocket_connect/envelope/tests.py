@@ -1,3 +1,432 @@
-# from django.test import TestCase
+import base64
+import datetime
 
-# Create your tests here.
+import pytest
+from celery.exceptions import SoftTimeLimitExceeded
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.db.models import QuerySet
+from django.utils import timezone
+from envelope import archive, media, redelivery, rooms, stats
+from envelope.models import (
+    Campaign,
+    ConnectorStats,
+    DeliveryAttempt,
+    LiveChatRoom,
+    Message,
+)
+from instance import ratelimit, tasks
+from instance.models import Connector, Server
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def connector():
+    server = Server.objects.create(
+        name="server", url="http://rocketchat:3000", managers="admin"
+    )
+    return server.connectors.create(name="connector", connector_type="wppconnect")
+
+
+def test_message_outgoing_text(connector):
+    message = Message.objects.create(
+        connector=connector,
+        envelope_id="RC_MESSAGE_ID",
+        type="ingoing",
+        raw_message={
+            "type": "Message",
+            "messages": [{"_id": "RC_MESSAGE_ID", "msg": "hello visitor"}],
+        },
+    )
+    assert message.get_outgoing_text() == "hello visitor"
+
+
+def test_message_outgoing_text_not_available(connector):
+    message = Message.objects.create(
+        connector=connector, envelope_id="WA_MESSAGE_ID", raw_message={"body": "hi"}
+    )
+    assert message.get_outgoing_text() is None
+
+
+def test_delivery_attempt_summarize(connector):
+    message = Message.objects.create(connector=connector, envelope_id="RC_MESSAGE_ID")
+    attempt = message.delivery_attempts.create(
+        direction="outgo",
+        payload=DeliveryAttempt.summarize(
+            {"args": {"base64": "A" * 5000, "to": "5531@c.us"}, "ids": ["x" * 5000]}
+        ),
+    )
+    attempt.refresh_from_db()
+    assert attempt.payload["args"]["to"] == "5531@c.us"
+    assert (
+        len(attempt.payload["args"]["base64"]) == DeliveryAttempt.MAX_STRING_LENGTH + 3
+    )
+    assert len(attempt.payload["ids"][0]) == DeliveryAttempt.MAX_STRING_LENGTH + 3
+    assert message.payload == {}
+
+
+def test_one_open_room_per_token(connector):
+    connector.rooms.create(token="whatsapp:1", room_id="ROOM1", open=False)
+    connector.rooms.create(token="whatsapp:1", room_id="ROOM2", open=True)
+    with pytest.raises(IntegrityError):
+        LiveChatRoom.objects.create(
+            connector=connector, token="whatsapp:1", room_id="ROOM3", open=True
+        )
+
+
+def test_open_room_cache(connector, django_assert_num_queries):
+    cache.clear()
+    room = connector.rooms.create(token="whatsapp:1", room_id="ROOM1", open=True)
+    with django_assert_num_queries(0):
+        assert rooms.get_open_room(connector, "whatsapp:1").pk == room.pk
+        assert rooms.get_room("ROOM1").pk == room.pk
+    assert rooms.close_rooms(connector.rooms.filter(room_id="ROOM1")) == 1
+    with pytest.raises(LiveChatRoom.DoesNotExist):
+        rooms.get_open_room(connector, "whatsapp:1")
+    assert rooms.get_room("ROOM1").open is False
+    # a new room replaces the closed one
+    connector.rooms.create(token="whatsapp:1", room_id="ROOM2", open=True)
+    assert rooms.get_open_room(connector, "whatsapp:1").room_id == "ROOM2"
+
+
+def test_campaign_progress(connector):
+    campaign = Campaign.objects.create(
+        connector=connector, name="campaign", template="hello {{number}}"
+    )
+    for number, status in [
+        ("1", "sent"),
+        ("2", "sent"),
+        ("3", "invalid"),
+        ("4", "valid"),
+    ]:
+        campaign.recipients.create(number=number, status=status)
+    progress = campaign.get_progress()
+    assert progress["sent"] == 2
+    assert progress["invalid"] == 1
+    assert progress["total"] == 4
+    # canceled campaigns are not sent anymore
+    campaign.status = "canceled"
+    campaign.save()
+    assert campaign.run() is True
+    assert campaign.recipients.filter(status="valid").count() == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_campaign_send(connector, monkeypatch):
+    room = connector.rooms.create(token="whatsapp:1", room_id="ROOM1", open=True)
+    sent = []
+
+    class ActiveConnector:
+        def __init__(self, connector, message, type):
+            pass
+
+        def validate_numbers(self, numbers):
+            # 3 can not receive messages, 4 could not be checked
+            return {
+                number: None if number == "4" else number != "3" for number in numbers
+            }
+
+        def send_active_message(self, number, text, department=None, message_id=None):
+            sent.append((number, text, department, message_id))
+            if number == "2":
+                return {"success": False, "message": "COULD NOT CREATE ROOM"}
+            return {"success": True, "message": "MESSAGE SENT", "room": room}
+
+    monkeypatch.setattr(Connector, "get_connector_class", lambda self: ActiveConnector)
+    connector.config = {"campaign_concurrency": 1, "campaign_messages_per_minute": 6000}
+    connector.save()
+    campaign = Campaign.objects.create(
+        connector=connector,
+        name="campaign",
+        template="hello {{ number }} {% not a tag {{campaign.connector}}",
+        department="Sales",
+    )
+    for number in ["1", "2", "3", "4"]:
+        campaign.recipients.create(number=number)
+
+    # 4 is left for the next run
+    assert campaign.run(time_budget=10) is False
+    campaign.refresh_from_db()
+    assert campaign.status == "running"
+    recipients = {r.number: r for r in campaign.recipients.all()}
+    assert sent == [
+        (
+            "1",
+            "hello 1 {% not a tag {{campaign.connector}}",
+            "Sales",
+            f"campaign-{campaign.id}-{recipients['1'].id}",
+        ),
+        (
+            "2",
+            "hello 2 {% not a tag {{campaign.connector}}",
+            "Sales",
+            f"campaign-{campaign.id}-{recipients['2'].id}",
+        ),
+    ]
+    assert recipients["1"].status == "sent"
+    assert recipients["1"].room == room
+    assert recipients["2"].status == "failed"
+    assert recipients["2"].error == "COULD NOT CREATE ROOM"
+    assert recipients["3"].status == "invalid"
+    assert recipients["4"].status == "pending"
+
+
+def test_archive_and_restore_messages(connector, settings, tmp_path):
+    settings.MESSAGE_ARCHIVE_ROOT = str(tmp_path)
+    old = timezone.now() - datetime.timedelta(days=400)
+    for i in range(3):
+        message = Message.objects.create(
+            connector=connector,
+            envelope_id=f"OLD{i}",
+            delivered=True,
+            raw_message={"body": i},
+        )
+        Message.objects.filter(id=message.id).update(created=old)
+        message.delivery_attempts.create(direction="outgo", delivered=True)
+        message.provider_messages.create(
+            connector=connector, provider_message_id=f"PROVIDER{i}"
+        )
+    Message.objects.create(connector=connector, envelope_id="NEW", delivered=True)
+    Message.objects.create(connector=connector, envelope_id="OLD_UNDELIVERED")
+    Message.objects.filter(envelope_id="OLD_UNDELIVERED").update(created=old)
+
+    archived = archive.archive_messages(connector, days=365, batch_size=2)
+    assert sorted(archived.values()) == [1, 2]
+    assert set(Message.objects.values_list("envelope_id", flat=True)) == {
+        "NEW",
+        "OLD_UNDELIVERED",
+    }
+
+    day = timezone.localdate(old)
+    assert archive.restore_messages(connector, day, day) == 3
+    # counted back
+    assert connector.connector_status() == stats.count(connector.id)
+    assert connector.connector_status()["total_messages"] == 5
+    restored = Message.objects.get(envelope_id="OLD1")
+    assert restored.raw_message == {"body": 1}
+    # with the rows deleted along with it
+    assert restored.delivery_attempts.get().delivered
+    assert restored.provider_messages.get().provider_message_id == "PROVIDER1"
+    # the serialization keeps milliseconds
+    assert abs(restored.created - old) < datetime.timedelta(milliseconds=1)
+
+
+def test_media_store(settings, tmp_path):
+    settings.MESSAGE_MEDIA_ROOT = str(tmp_path)
+    data = base64.b64encode(b"some file").decode()
+    reference = media.store_base64(data)
+    assert media.is_reference(reference)
+    # the same file is stored once
+    assert media.store_base64(data) == reference
+    assert len(list(tmp_path.glob("*/*/*"))) == 1
+    with media.open_media(reference) as f:
+        assert f.read() == b"some file"
+    assert media.store_base64("not base64!") is None
+
+
+def test_redelivery_keeps_room_order(connector, settings, monkeypatch):
+    cache.clear()
+    settings.REDELIVERY_CONCURRENCY = 2
+    dispatched = []
+    monkeypatch.setattr(
+        tasks.redeliver_messages, "delay", lambda *args: dispatched.append(args)
+    )
+    room1 = connector.rooms.create(token="whatsapp:1", room_id="ROOM1", open=True)
+    room2 = connector.rooms.create(token="whatsapp:2", room_id="ROOM2", open=True)
+    for envelope_id, room in [
+        ("A", room1),
+        ("B", room2),
+        ("KNOWN", room1),
+        ("C", room1),
+        ("D", room2),
+        ("E", room2),
+    ]:
+        Message.objects.create(connector=connector, envelope_id=envelope_id, room=room)
+
+    delivered = []
+
+    class Plugin:
+        def __init__(self, connector, message, type):
+            self.message = message
+
+    def force_delivery(message, Connector=None):
+        delivered.append(message.envelope_id)
+        if message.envelope_id == "E":
+            # no outbound slot left
+            ratelimit.defer(connector.id, message.room.room_id, message.id)
+        message.delivered = message.envelope_id not in ["D", "E"]
+        message.save()
+        return message.delivered
+
+    monkeypatch.setattr(Connector, "get_connector_class", lambda self: Plugin)
+    monkeypatch.setattr(Message, "force_delivery", force_delivery)
+    monkeypatch.setattr(redelivery, "get_delivered_ids", lambda c, m: {"KNOWN"})
+
+    progress = redelivery.start(connector)
+    assert progress["total"] == 6
+    assert progress["status"] == "running"
+    assert len(dispatched) == 2
+    # a running redelivery is not started again
+    redelivery.start(connector)
+    assert len(dispatched) == 2
+
+    for bucket in range(2):
+        assert redelivery.run_bucket(connector, bucket) is True
+    # each room in order, whatever the bucket
+    assert [e for e in delivered if e in ["A", "C"]] == ["A", "C"]
+    assert [e for e in delivered if e in ["B", "D", "E"]] == ["B", "D", "E"]
+    progress = redelivery.get_progress(connector.id)
+    assert progress["status"] == "done"
+    assert progress["handled"] == 6
+    assert (progress["delivered"], progress["skipped"], progress["failed"]) == (3, 1, 1)
+    assert progress["deferred"] == 1
+    assert connector.messages.get(envelope_id="KNOWN").delivered
+
+
+def test_redelivery_stops_on_soft_time_limit(connector, settings, monkeypatch):
+    cache.clear()
+    settings.REDELIVERY_CONCURRENCY = 1
+    monkeypatch.setattr(tasks.redeliver_messages, "delay", lambda *args: None)
+    first = Message.objects.create(connector=connector, envelope_id="A")
+    Message.objects.create(connector=connector, envelope_id="B")
+
+    def force_delivery(message, Connector=None):
+        if message.envelope_id == "B":
+            raise SoftTimeLimitExceeded()
+        return True
+
+    monkeypatch.setattr(Connector, "get_connector_class", lambda self: None)
+    monkeypatch.setattr(Message, "force_delivery", force_delivery)
+    monkeypatch.setattr(redelivery, "get_delivered_ids", lambda c, m: set())
+    redelivery.start(connector)
+    with pytest.raises(SoftTimeLimitExceeded):
+        redelivery.run_bucket(connector, 0)
+    # resumed after the last handled message, nothing counted as failed
+    assert cache.get(redelivery.checkpoint_key(connector.id, 0)) == first.id
+    assert redelivery.get_progress(connector.id)["failed"] == 0
+
+
+def test_connector_stats_follow_the_writes(connector, django_assert_num_queries):
+    stats.rebuild(connector.id)
+    room = connector.rooms.create(token="whatsapp:1", room_id="ROOM1", open=True)
+    connector.rooms.create(token="whatsapp:1", room_id="ROOM0", open=False)
+    connector.rooms.create(token="whatsapp:2", room_id="ROOM2", open=True)
+    message = Message.objects.create(connector=connector, envelope_id="A", room=room)
+    Message.objects.create(connector=connector, envelope_id="B", delivered=True)
+    message.delivered = True
+    message.save()
+    Message.objects.create(connector=connector, envelope_id="C")
+    rooms.close_rooms(connector.rooms.filter(room_id="ROOM2"))
+    room.open = False
+    room.save()
+    with django_assert_num_queries(1):
+        status = connector.connector_status()
+    assert status == stats.count(connector.id)
+    assert status["undelivered_messages"] == 1
+    assert status["open_rooms"] == 0
+    assert status["total_visitors"] == 2
+
+
+def test_connector_stats_first_write_race(connector, monkeypatch):
+    ConnectorStats.objects.filter(connector=connector).delete()
+    ConnectorStats.objects.create(connector=connector, total_messages=5)
+    updates = []
+    update = QuerySet.update
+
+    def racing_update(queryset, **changes):
+        # the first update runs before the other write creates the row
+        updates.append(changes)
+        return 0 if len(updates) == 1 else update(queryset, **changes)
+
+    monkeypatch.setattr(QuerySet, "update", racing_update)
+    stats.add(connector.id, total_messages=1)
+    monkeypatch.undo()
+    assert len(updates) == 2
+    assert ConnectorStats.objects.get(connector=connector).total_messages == 6
+
+
+def test_undelivered_days_rollup(connector):
+    room = connector.rooms.create(token="whatsapp:1", room_id="ROOM1", open=True)
+    old = timezone.now() - datetime.timedelta(days=10)
+    for envelope_id in ["A", "B", "C"]:
+        message = Message.objects.create(
+            connector=connector, envelope_id=envelope_id, room=room
+        )
+        Message.objects.filter(id=message.id).update(created=old)
+    Message.objects.create(connector=connector, envelope_id="D")
+    days = {
+        day.date: (day.messages_count, day.rooms_count)
+        for day in stats.refresh_undelivered_days(connector.id)
+    }
+    assert days == {timezone.localdate(old): (3, 1), timezone.localdate(): (1, 0)}
+    # an old day changes only when marked
+    message = connector.messages.get(envelope_id="A")
+    message.delivered = True
+    message.save()
+    day = connector.undelivered_days.get(date=timezone.localdate(old))
+    assert day.dirty
+    stats.refresh_undelivered_days(connector.id)
+    day.refresh_from_db()
+    assert (day.messages_count, day.dirty) == (2, False)
+    assert (
+        stats.get_undelivered_messages(connector.id, timezone.localdate(old)).count()
+        == 2
+    )
+
+
+def test_undelivered_days_rollup_catches_up(connector):
+    today = timezone.localdate()
+    old = timezone.now() - datetime.timedelta(days=10)
+    message = Message.objects.create(connector=connector, envelope_id="A")
+    Message.objects.filter(id=message.id).update(created=old)
+    stats.refresh_undelivered_days(connector.id)
+    # the page is not opened for days, while messages fail to deliver
+    ConnectorStats.objects.filter(connector=connector).update(
+        undelivered_rolled_up=today - datetime.timedelta(days=10)
+    )
+    four_days_ago = timezone.now() - datetime.timedelta(days=4)
+    message = Message.objects.create(connector=connector, envelope_id="B")
+    Message.objects.filter(id=message.id).update(created=four_days_ago)
+    days = {
+        day.date: day.messages_count
+        for day in stats.refresh_undelivered_days(connector.id)
+    }
+    assert days == {
+        timezone.localdate(old): 1,
+        timezone.localdate(four_days_ago): 1,
+    }
+    assert connector.stats.undelivered_rolled_up == today
+    # an old day without a row gains an undelivered message
+    twenty_days_ago = timezone.now() - datetime.timedelta(days=20)
+    message = Message.objects.create(
+        connector=connector, envelope_id="C", delivered=True
+    )
+    Message.objects.filter(id=message.id).update(created=twenty_days_ago)
+    message = connector.messages.get(envelope_id="C")
+    message.delivered = False
+    message.save()
+    day = connector.undelivered_days.get(date=timezone.localdate(twenty_days_ago))
+    assert day.dirty
+    stats.refresh_undelivered_days(connector.id)
+    day.refresh_from_db()
+    assert (day.messages_count, day.dirty) == (1, False)
+
+
+def test_decode_data_url():
+    data = b"some media file" * 100
+    document = (
+        b'{"success": true, "response": "data:image/png;base64,'
+        + base64.b64encode(data)
+        + b'"}'
+    )
+    # any chunk size, the marker and the base64 are split anywhere
+    for size in [1, 3, 7, 64]:
+        starts = range(0, len(document), size)
+        chunks = [document[start:][:size] for start in starts]
+        with media.decode_data_url(chunks, spool_size=100) as decoded:
+            assert decoded.read() == data
+    assert media.decode_data_url([b'{"response": null}']) is None
+    assert media.decode_data_url([b'{"response": "data:a;base64,!!!!"}']) is None
+    # the document ended before the data url
+    assert media.decode_data_url([document[:60]]) is None
@@ -0,0 +1,176 @@
+"""
+Process-wide managers of Rocket.Chat clients and connector provider sessions.
+
+Clients are kept by server url, role (admin or bot) and credentials, so every
+message reuses the same logged in client and its keep-alive connections,
+instead of a new login and TCP/TLS handshake per call.
+
+Connector sessions share one connection pool per connector, used to talk to
+the provider (WPPConnect, WA-Automate, Meta Cloud...).
+"""
+import threading
+import time
+
+import requests
+from django.conf import settings
+from rocketchat_API.rocketchat import RocketChat
+from urllib3.util.retry import Retry
+
+
+class RocketChatClientManager:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._sessions = {}
+
+    def get_session(self, server_url):
+        """
+        one pooled HTTP session per Rocket.Chat server
+        """
+        with self._lock:
+            session = self._sessions.get(server_url)
+            if not session:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=settings.ROCKETCHAT_CLIENT_POOL_SIZE,
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.hooks["response"].append(self._evict_unauthorized)
+                self._sessions[server_url] = session
+            return session
+
+    def get_client(self, server, bot=False):
+        """
+        this will return a working ROCKETCHAT_API instance, reusing
+        the one already logged in for this server and role
+        """
+        if bot:
+            credentials = (
+                server.bot_user_id,
+                server.bot_user_token,
+                server.bot_user,
+                server.bot_password,
+            )
+        else:
+            credentials = (
+                server.admin_user_id,
+                server.admin_user_token,
+                server.admin_user,
+                server.admin_password,
+            )
+        key = (server.url, bot, credentials)
+        user_id, user_token, user, password = credentials
+        with self._lock:
+            client, created = self._clients.get(key, (None, None))
+        # username and password logins get a token that expires
+        if client and not (user_id and user_token):
+            if time.time() - created > settings.ROCKETCHAT_CLIENT_LOGIN_MAX_AGE:
+                client = None
+        if not client:
+            session = self.get_session(server.url)
+            if user_id and user_token:
+                client = RocketChat(
+                    auth_token=user_token,
+                    user_id=user_id,
+                    server_url=server.url,
+                    session=session,
+                )
+            else:
+                client = RocketChat(
+                    user, password, server_url=server.url, session=session
+                )
+            with self._lock:
+                self._clients[key] = (client, time.time())
+        return client
+
+    def _evict_unauthorized(self, response, *args, **kwargs):
+        """
+        drop the clients with a revoked or expired token,
+        so the next call logs in again
+        """
+        if response.status_code == 401:
+            user_id = response.request.headers.get("X-User-Id")
+            if user_id:
+                with self._lock:
+                    for key, (client, created) in list(self._clients.items()):
+                        if client.headers.get("X-User-Id") == user_id:
+                            del self._clients[key]
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+
+
+class ConnectorSession(requests.Session):
+    """
+    a session over the connector pool, with default timeouts,
+    that renews the token and repeats the request once on 401
+    """
+
+    def __init__(self, adapter, headers=None, refresh_token=None):
+        super().__init__()
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+        self.headers = headers or {}
+        self.refresh_token = refresh_token
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", settings.CONNECTOR_SESSION_TIMEOUT)
+        response = super().request(method, url, **kwargs)
+        # streamed bodies can not be sent again
+        replayable = not hasattr(kwargs.get("data"), "read")
+        if response.status_code == 401 and self.refresh_token and replayable:
+            headers = self.refresh_token()
+            if headers:
+                self.headers.update(headers)
+                response = super().request(method, url, **kwargs)
+        return response
+
+    def close(self):
+        # the pool is shared with the other sessions of the connector
+        pass
+
+
+class ConnectorSessionManager:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._adapters = {}
+
+    def get_adapter(self, connector_id):
+        """
+        one connection pool per connector, retrying connection errors
+        and the idempotent requests
+        """
+        with self._lock:
+            adapter = self._adapters.get(connector_id)
+            if not adapter:
+                retry = Retry(
+                    total=settings.CONNECTOR_SESSION_RETRIES,
+                    backoff_factor=0.5,
+                    status_forcelist=(502, 503, 504),
+                    raise_on_status=False,
+                )
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=settings.CONNECTOR_SESSION_POOL_SIZE,
+                    max_retries=retry,
+                )
+                self._adapters[connector_id] = adapter
+            return adapter
+
+    def get_session(self, connector_id, headers=None, refresh_token=None):
+        return ConnectorSession(
+            self.get_adapter(connector_id), headers=headers, refresh_token=refresh_token
+        )
+
+    def clear(self):
+        with self._lock:
+            for adapter in self._adapters.values():
+                adapter.close()
+            self._adapters.clear()
+
+
+client_manager = RocketChatClientManager()
+session_manager = ConnectorSessionManager()
@@ -27,11 +27,7 @@ class NewConnectorForm(ModelForm):
             ("instagram_direct", "Meta Cloud Instagram"),
         ]
         # get departments
-        rocket = server.get_rocket_client()
-        departments_raw = rocket.call_api_get("livechat/department").json()
-        departments_choice = [
-            (d["name"], d["name"]) for d in departments_raw["departments"]
-        ]
+        departments_choice = [(d["name"], d["name"]) for d in server.get_departments()]
         # adapt fields
         self.fields["connector_type"] = ChoiceField(
             required=False, choices=connector_choices
@@ -1,13 +1,19 @@
+import datetime
 import json
 import uuid
 
 import requests
 from django.apps import apps
 from django.conf import settings
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction
+from django.http import JsonResponse
+from django.utils import timezone
 from django_celery_beat.models import CrontabSchedule, PeriodicTask
+from envelope import redelivery, rooms, stats
+from instance import registry
+from instance.clients import client_manager
 from rocketchat_API.APIExceptions.RocketExceptions import RocketAuthenticationException
-from rocketchat_API.rocketchat import RocketChat
 
 
 def random_string(size=20):
@@ -49,33 +55,10 @@ class Server(models.Model):
 
     def get_rocket_client(self, bot=False):
         """
-        this will return a working ROCKETCHAT_API instance
+        this will return a working ROCKETCHAT_API instance,
+        shared by the whole process for this server and role
         """
-        if bot:
-            if self.bot_user_id and self.bot_user_token:
-                rocket = RocketChat(
-                    auth_token=self.bot_user_token,
-                    user_id=self.bot_user_id,
-                    server_url=self.url,
-                )
-            else:
-                rocket = RocketChat(
-                    self.bot_user, self.bot_password, server_url=self.url
-                )
-        else:
-            if self.admin_user_id and self.admin_user_token:
-                rocket = RocketChat(
-                    auth_token=self.admin_user_token,
-                    user_id=self.admin_user_id,
-                    server_url=self.url,
-                )
-
-            else:
-                rocket = RocketChat(
-                    self.admin_user, self.admin_password, server_url=self.url
-                )
-
-        return rocket
+        return client_manager.get_client(self, bot=bot)
 
     def get_managers(self, as_string=True):
         """
@@ -106,33 +89,218 @@ class Server(models.Model):
         else:
             return []
 
+    def get_departments(self, refresh=False):
+        """
+        the livechat departments of this server, cached for a few minutes
+        """
+        key = f"server_departments:{self.id}"
+        departments = None if refresh else cache.get(key)
+        if departments is None:
+            rocket = self.get_rocket_client()
+            departments = []
+            while True:
+                response = rocket.call_api_get(
+                    "livechat/department", offset=len(departments), count=100
+                )
+                if not response.ok:
+                    # keep the last catalog until the next refresh
+                    return cache.get(key) or []
+                page = response.json()
+                departments.extend(page.get("departments", []))
+                if not page.get("departments") or len(departments) >= page.get(
+                    "total", 0
+                ):
+                    break
+            cache.set(key, departments, timeout=settings.DEPARTMENT_CACHE_TIMEOUT)
+        return departments
+
+    def get_department(self, department_id):
+        """
+        the department by its id. An unknown id refreshes the catalog, at most
+        once every DEPARTMENT_MISS_REFRESH_INTERVAL seconds
+        """
+        if not department_id:
+            return None
+        for department in self.get_departments():
+            if department["_id"] == department_id:
+                return department
+        if not cache.add(
+            f"server_departments_refreshed:{self.id}",
+            True,
+            timeout=settings.DEPARTMENT_MISS_REFRESH_INTERVAL,
+        ):
+            return None
+        for department in self.get_departments(refresh=True):
+            if department["_id"] == department_id:
+                return department
+        return None
+
+    def search_departments(self, text):
+        """
+        the departments with the text in its name, as livechat/department?text=
+        """
+        return [
+            department
+            for department in self.get_departments()
+            if text.lower() in department.get("name", "").lower()
+        ]
+
+    def get_department_map(self):
+        """
+        the enabled departments ids, by name
+        """
+        return {
+            department["name"]: department["_id"]
+            for department in self.get_departments()
+            if department.get("enabled")
+        }
+
+    def get_all_open_rooms(self, page_size=100):
+        """
+        walk all the pages of open rooms in Rocket.Chat, and return them.
+        return None if any page could not be read
+        """
+        rocket = self.get_rocket_client()
+        open_rooms = []
+        while True:
+            response = rocket.livechat_rooms(
+                open="true", offset=len(open_rooms), count=page_size
+            )
+            if not response.ok:
+                return None
+            page = response.json()
+            open_rooms.extend(page.get("rooms", []))
+            if not page.get("rooms") or len(open_rooms) >= page.get("total", 0):
+                return open_rooms
+
+    def get_all_open_rooms_id(self, page_size=100):
+        """
+        the ids of all the open rooms in Rocket.Chat, or None
+        """
+        open_rooms = self.get_all_open_rooms(page_size=page_size)
+        if open_rooms is None:
+            return None
+        return [room["_id"] for room in open_rooms]
+
+    def get_room_state(self, room_id):
+        """
+        the room state in Rocket.Chat: True if open, False if closed or
+        missing, None if Rocket.Chat could not tell. cached for a few seconds
+        """
+        key = rooms.room_state_key(room_id)
+        state = cache.get(key)
+        if state is None:
+            try:
+                response = self.get_rocket_client().rooms_info(room_id=room_id)
+            except requests.ConnectionError:
+                return None
+            if response.ok:
+                state = bool(response.json().get("room", {}).get("open"))
+            elif response.status_code == 400:
+                # the room does not exist
+                state = False
+            else:
+                return None
+            rooms.set_room_state(room_id, state)
+        return state
+
+    def is_room_open(self, room_id):
+        """
+        do not close a room when Rocket.Chat can not tell its state
+        """
+        return self.get_room_state(room_id) is not False
+
+    def get_dm_room_id(self, username, refresh=False):
+        """
+        the id of the direct message room with a user, cached
+        """
+        key = f"dm_room:{self.id}:{username}"
+        room_id = None if refresh else cache.get(key)
+        if not room_id:
+            rocket = self.get_rocket_client()
+            dm = rocket.im_create(username=username)
+            if not dm.ok:
+                return None
+            room_id = dm.json()["room"]["rid"]
+            cache.set(key, room_id, timeout=settings.DM_ROOM_CACHE_TIMEOUT)
+        return room_id
+
     def room_sync(self, execute=False):
         """
         Close all open rooms not open in Rocket.Chat
         """
-        open_rooms = self.get_open_rooms()
-        if open_rooms:
-            open_rooms = open_rooms.get("rooms", [])
-        open_rooms_id = [r["_id"] for r in open_rooms]
-        # get all open rooms in connector, except the actually open ones
+        open_rooms_id = self.get_all_open_rooms_id()
+        if open_rooms_id is None:
+            return {"total": 0, "error": "could not list the open rooms"}
         LiveChatRoom = apps.get_model(app_label="envelope", model_name="LiveChatRoom")
-        close_rooms = LiveChatRoom.objects.filter(
-            connector__server=self, open=True
-        ).exclude(room_id__in=open_rooms_id)
-        total = close_rooms.count()
-        closed_rooms_id = close_rooms.values_list("room_id", flat=True)
-        response = {"total": total, "close_rooms_id": list(closed_rooms_id)}
-        if execute:
-            close_room_response = close_rooms.update(open=False)
-            response["executed"] = close_room_response
-        return response
+        return rooms.reconcile(
+            LiveChatRoom.objects.filter(connector__server=self),
+            open_rooms_id,
+            execute=execute,
+            is_open=self.is_room_open,
+        )
 
     def force_delivery(self):
         """
-        this method will force the intake of every undelivered message
+        this method will start the redelivery of every undelivered message
         """
-        for connector in self.connectors.all():
-            connector.force_delivery()
+        return {
+            connector.external_token: connector.force_delivery()
+            for connector in self.connectors.all()
+        }
+
+    def rebuild_stats(self):
+        """
+        count again the messages and rooms of every connector,
+        fixing any drift of the incremental counters
+        """
+        return {
+            connector.external_token: stats.rebuild(connector.id).as_dict()
+            for connector in self.connectors.all()
+        }
+
+    def requeue_intake_events(self, minutes=5):
+        """
+        this method will queue again the intake events not dispatched
+        for more than some minutes, and not taken by a worker (or taken by
+        a lost one). A copy of an event still waiting in a long queue is
+        harmless: only one worker can claim the event
+        """
+        IntakeEvent = apps.get_model(app_label="envelope", model_name="IntakeEvent")
+        now = timezone.now()
+        cutoff = now - datetime.timedelta(minutes=minutes)
+        lost = now - datetime.timedelta(seconds=settings.CELERY_TASK_TIME_LIMIT)
+        stale_events = IntakeEvent.objects.filter(
+            models.Q(dispatched__isnull=True) | models.Q(dispatched__lte=cutoff),
+            models.Q(claimed__isnull=True) | models.Q(claimed__lte=lost),
+            connector__server=self,
+            created__lte=cutoff,
+            attempts__lt=IntakeEvent.MAX_ATTEMPTS,
+        )
+        stale_ids = list(stale_events.values_list("id", flat=True))
+        # one dispatch per lane is enough to drain it
+        dispatched_lanes = set()
+        for event in IntakeEvent.objects.filter(id__in=stale_ids):
+            if event.lane:
+                if (event.connector_id, event.lane) in dispatched_lanes:
+                    continue
+                dispatched_lanes.add((event.connector_id, event.lane))
+            event.dispatch()
+        IntakeEvent.objects.filter(id__in=stale_ids).update(dispatched=now)
+        return len(stale_ids)
+
+    def get_dead_intake_events(self):
+        """
+        the intake events that failed too many times, and are not retried
+        """
+        IntakeEvent = apps.get_model(app_label="envelope", model_name="IntakeEvent")
+        return (
+            IntakeEvent.objects.filter(
+                connector__server=self, attempts__gte=IntakeEvent.MAX_ATTEMPTS
+            )
+            .select_related("connector")
+            .order_by("-id")
+        )
 
     def multiple_connector_admin_message(self, text):
         """
@@ -197,6 +365,7 @@ class Server(models.Model):
                         "server_token": self.external_token,
                         "seconds_last_message": 30,
                         "notification_target": "#general,{{room.servedBy.username}}",
+                        "digest": False,
                         "notification_template": ":warning: Open Omnichannel Room for "
                         + "{{room.fname}}: {{external_url}}/omnichannel/current/{{room.id}}\n*Last Message*:"
                         + " {{room.lastMessage.msg}} - {{room.lastMessage.u.name}}/{{room.lastMessage.u.username}}"
@@ -309,6 +478,26 @@ class Server(models.Model):
             )
             self.tasks.add(task)
             added_tasks.append(task)
+        #
+        # T7 rebuild_stats
+        #
+        task = PeriodicTask.objects.filter(
+            task="instance.tasks.rebuild_stats",
+            kwargs__contains=self.external_token,
+        )
+        if not task.exists():
+            crontab = CrontabSchedule.objects.first()
+            task = PeriodicTask.objects.create(
+                enabled=False,
+                name=f"Rebuild Connector Stats for {self.name} (ID {self.id})",
+                description="count again the messages and rooms of every connector, "
+                + "fixing any drift of the counters. Schedule it daily, at most",
+                crontab=crontab,
+                task="instance.tasks.rebuild_stats",
+                kwargs=json.dumps({"server_token": self.external_token}),
+            )
+            self.tasks.add(task)
+            added_tasks.append(task)
         # return added tasks
         return added_tasks
 
@@ -413,21 +602,8 @@ class Connector(models.Model):
         return self.name
 
     def get_connector_class(self):
-        connector_type = self.connector_type
-        # import the connector plugin
-        plugin_string = f"rocket_connect.plugins.{connector_type}"
-        try:
-            plugin = __import__(plugin_string, fromlist=["Connector"])
-        # no connector plugin, going base
-        except ModuleNotFoundError:
-            raise
-            # plugin = __import__(
-            #     'rocket_connect.plugins.base',
-            #     fromlist=['Connector']
-
-            # )
-        # initiate connector plugin
-        return plugin.Connector
+        # the connector plugin is imported once per process
+        return registry.get_plugin_class(self.connector_type)
 
     def get_connector_config_form(self):
         connector_type = self.connector_type
@@ -482,34 +658,53 @@ class Connector(models.Model):
         # return close session result
         return connector.close_session()
 
-    def intake(self, request):
+    def intake(self, request=None, body=None):
         """
         this method will intake the raw message, and apply the connector logic
         it will also get the secondary_connectors attached to the connector
-        and run it as well
+        and run it as well.
+        the body can be provided without a request, as for the asynchronous intake
         """
+        if body is None:
+            body = request.body
         # get connector
         Connector = self.get_connector_class()
         # initiate with raw message
-        connector = Connector(self, request.body, "incoming", request)
+        connector = Connector(self, body, "incoming", request)
         # income message
         main_incoming = connector.incoming()
         # secondary connectors
         for secondary_connector in self.secondary_connectors.all():
             SConnector = secondary_connector.get_connector_class()
-            sconnector = SConnector(
-                secondary_connector, request.body, "incoming", request
-            )
+            sconnector = SConnector(secondary_connector, body, "incoming", request)
             # log it
             connector.logger_info(
                 "RUNING SECONDARY CONNECTOR *{}* WITH BODY {}:".format(
-                    sconnector.connector, request.body
+                    sconnector.connector, body
                 )
             )
             sconnector.incoming()
         # return main incoming
         return main_incoming
 
+    def intake_async(self, request):
+        """
+        this method will persist the raw message and answer right away,
+        leaving the connector logic to the intake workers.
+        events that must be answered inline, like verification challenges,
+        are processed synchronously. The event is only sent to the workers
+        once the request transaction commits, so they can read it
+        """
+        Connector = self.get_connector_class()
+        connector = Connector(self, request.body, "incoming", request)
+        if connector.must_intake_inline():
+            return self.intake(request)
+        event = self.intake_events.create(
+            body=request.body.decode("utf-8"), lane=connector.get_intake_lane()
+        )
+        transaction.on_commit(event.dispatch)
+        return JsonResponse({"queued": True})
+
     def outtake(self, message):
         # get connector
         Connector = self.get_connector_class()
@@ -558,44 +753,31 @@ class Connector(models.Model):
             return ",".join(managers)
         return managers
 
-    def force_delivery(self):
-        messages = self.messages.filter(delivered=False)
-        for message in messages:
-            message.force_delivery()
+    def force_delivery(self, date=None):
+        """
+        start the redelivery of the undelivered messages, in the workers
+        """
+        return redelivery.start(self, date=date)
 
     def connector_status(self):
         """
         this method will return the status of the connector
         """
-        return self.messages.aggregate(
-            undelivered_messages=models.Count(
-                "id",
-                models.Q(delivered=False) | models.Q(delivered=None),
-                distinct=True,
-            ),
-            total_messages=models.Count("id", distinct=True),
-            open_rooms=models.Count(
-                "room__id", models.Q(room__open=True), distinct=True
-            ),
-            total_rooms=models.Count("room__id", distinct=True),
-            last_message=models.Max("created"),
-            total_visitors=models.Count("room__token", distinct=True),
-        )
+        return stats.get_stats(self.id).as_dict()
 
     def room_sync(self, execute=False):
         """
         Close all open rooms not open in Rocket.Chat
         """
-        rocket = self.server.get_rocket_client()
-        open_rooms = rocket.livechat_rooms(open="true").json()
-        open_rooms_id = [r["_id"] for r in open_rooms["rooms"]]
-        # get all open rooms in connector, except the actually open ones
-        close_rooms = self.rooms.filter(open=True).exclude(room_id__in=open_rooms_id)
-        total = close_rooms.count()
-        if execute:
-            close_rooms.update(open=False)
-        response = {"total": total}
-        return response
+        open_rooms_id = self.server.get_all_open_rooms_id()
+        if open_rooms_id is None:
+            return {"total": 0, "error": "could not list the open rooms"}
+        return rooms.reconcile(
+            self.rooms.all(),
+            open_rooms_id,
+            execute=execute,
+            is_open=self.server.is_room_open,
+        )
 
     uuid = models.UUIDField(default=uuid.uuid4, editable=False)
     external_token = models.CharField(max_length=50, default=random_string, unique=True)
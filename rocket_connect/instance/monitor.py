@@ -0,0 +1,216 @@
+"""
+Shared snapshot of the open rooms of a server, for the live monitor.
+
+The snapshot is built from livechat/rooms once and kept in the cache, shared by
+every viewer. The Omnichannel webhooks received at the server endpoint patch it:
+new messages update their room in place, and closed sessions drop theirs.
+Other events (taken, forwarded, queued, started) mark it stale, and it is
+rebuilt at most once every MONITOR_MIN_REFRESH seconds. Every change bumps a
+version, which the websocket viewers watch. Patches and rebuilds hold the same
+lock; a webhook that cannot get it marks the snapshot stale instead.
+"""
+import datetime
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import render_to_string
+
+EPOCH = datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc)
+
+# the fields of a room used by the monitor
+ROOM_FIELDS = [
+    "_id",
+    "fname",
+    "msgs",
+    "usersCount",
+    "source",
+    "servedBy",
+    "department",
+    "lastMessage",
+    "lm",
+    "ts",
+    "v",
+]
+
+
+def snapshot_key(server_id):
+    return f"monitor:{server_id}"
+
+
+def version_key(server_id):
+    return f"monitor:{server_id}:version"
+
+
+def stale_key(server_id):
+    return f"monitor:{server_id}:stale"
+
+
+def lock_key(server_id):
+    return f"monitor:{server_id}:lock"
+
+
+def acquire_lock(server_id, attempts=1, wait=0.01):
+    for attempt in range(attempts):
+        if attempt:
+            time.sleep(wait)
+        if cache.add(lock_key(server_id), True, timeout=30):
+            return True
+    return False
+
+
+def parse_date(value):
+    """
+    the dates of Rocket.Chat, like 2022-01-01T10:00:00.000Z
+    """
+    if isinstance(value, dict):
+        # the webhooks send them as {"$date": milliseconds}
+        return datetime.datetime.fromtimestamp(
+            value["$date"] / 1000, tz=datetime.timezone.utc
+        )
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def get_version(server_id):
+    return cache.get(version_key(server_id)) or 0
+
+
+def bump_version(server_id):
+    key = version_key(server_id)
+    cache.add(key, 0, timeout=None)
+    cache.incr(key)
+
+
+def build_snapshot(server, page_size=100):
+    """
+    every open room of the server, one livechat/rooms request per page
+    """
+    rocket = server.get_rocket_client()
+    rooms = []
+    while True:
+        response = rocket.call_api_get(
+            "livechat/rooms", open="true", offset=len(rooms), count=page_size
+        )
+        if not response.ok:
+            return None
+        page = response.json()
+        rooms.extend(
+            {field: room.get(field) for field in ROOM_FIELDS}
+            for room in page.get("rooms", [])
+        )
+        if not page.get("rooms") or len(rooms) >= page.get("total", 0):
+            break
+    return {"rooms": {room["_id"]: room for room in rooms}, "built": time.time()}
+
+
+def get_snapshot(server):
+    """
+    the shared snapshot, rebuilt when missing or stale
+    """
+    key = snapshot_key(server.id)
+    snapshot = cache.get(key)
+    if snapshot and (
+        not cache.get(stale_key(server.id))
+        or time.time() - snapshot["built"] < settings.MONITOR_MIN_REFRESH
+    ):
+        return snapshot
+    empty = {"rooms": {}, "built": 0}
+    # a single viewer rebuilds it, the others keep the last one
+    if not acquire_lock(server.id):
+        return snapshot or empty
+    try:
+        cache.delete(stale_key(server.id))
+        built = build_snapshot(server)
+        if built is None:
+            return snapshot or empty
+        cache.set(key, built, timeout=settings.MONITOR_SNAPSHOT_TIMEOUT)
+        bump_version(server.id)
+        return built
+    finally:
+        cache.delete(lock_key(server.id))
+
+
+def needs_refresh(server):
+    """
+    the snapshot expired, or was marked stale by a webhook
+    """
+    return bool(cache.get(stale_key(server.id))) or snapshot_key(server.id) not in cache
+
+
+def apply_event(server, event):
+    """
+    patch the snapshot with an Omnichannel webhook
+    """
+    key = snapshot_key(server.id)
+    if key not in cache:
+        # nobody is watching
+        return False
+    if event.get("type") not in ["Message", "LivechatSession"]:
+        cache.set(stale_key(server.id), True, timeout=None)
+        return True
+    # concurrent webhooks would overwrite each other's patch
+    if not acquire_lock(server.id, attempts=20):
+        # busy rebuilding, or too many webhooks at once
+        cache.set(stale_key(server.id), True, timeout=None)
+        return True
+    try:
+        snapshot = cache.get(key)
+        if not snapshot:
+            return False
+        room = snapshot["rooms"].get(event.get("_id"))
+        if event.get("type") == "LivechatSession":
+            # the session was closed
+            snapshot["rooms"].pop(event.get("_id"), None)
+        elif room and event.get("messages"):
+            last_message = event["messages"][-1]
+            room["lastMessage"] = last_message
+            room["lm"] = last_message.get("ts") or room["lm"]
+            room["msgs"] = (room.get("msgs") or 0) + len(event["messages"])
+        else:
+            return True
+        cache.set(key, snapshot, timeout=settings.MONITOR_SNAPSHOT_TIMEOUT)
+        bump_version(server.id)
+        return True
+    finally:
+        cache.delete(lock_key(server.id))
+
+
+def get_open_rooms(server, order="agent"):
+    """
+    the open rooms of the snapshot, sorted for the monitor
+    """
+    rooms = list(get_snapshot(server)["rooms"].values())
+    for room in rooms:
+        room["lm_datetime"] = room.get("lm") and parse_date(room["lm"])
+        room["ts_datetime"] = room.get("ts") and parse_date(room["ts"])
+    if order == "agent":
+        group = ("servedBy", "username")
+    else:
+        group = ("department", "name")
+
+    def sort_key(room):
+        return (
+            (room.get(group[0]) or {}).get(group[1]) or "",
+            room["lm_datetime"] or EPOCH,
+        )
+
+    return sorted(rooms, key=sort_key)
+
+
+def render_rooms(server, order="agent"):
+    return render_to_string(
+        "instance/server_monitor_rooms.html",
+        {"server": server, "open_rooms": get_open_rooms(server, order), "order": order},
+    )
+
+
+def get_watched_server(user_id, server_token):
+    """
+    the server, if the user owns it
+    """
+    return (
+        apps.get_model(app_label="instance", model_name="Server")
+        .objects.filter(external_token=server_token, owners__id=user_id)
+        .first()
+    )
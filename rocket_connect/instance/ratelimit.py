@@ -0,0 +1,160 @@
+"""
+Outbound rate limit per connector, shared by all the workers through the cache.
+
+Messages sent to the provider are counted in one second windows. In each
+window a single room may take at most half of the rate, so a busy room does
+not starve the others, and bulk sends (closing messages and campaigns) only
+take BULK_SHARE of it, leaving room for the agents' messages.
+
+The webhooks never wait for a slot. A message without one is deferred to the
+workers, and so is every later message of the same room while it has deferred
+ones, so a room is always delivered in order.
+"""
+import time
+
+from django.core.cache import cache
+
+BULK_SHARE = 0.7
+# the waiting and deferred gauges are dropped after this long without a change,
+# so a lost worker does not leave them off for good
+COUNTER_TIMEOUT = 60 * 10
+# a deferred message not delivered in this time is left to the redelivery
+DEFERRED_TIMEOUT = 60 * 60
+
+
+def _incr(key):
+    cache.add(key, 0, timeout=5)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # the window expired between add and incr
+        cache.add(key, 1, timeout=5)
+        return 1
+
+
+def try_acquire(connector_id, rate, room_id=None, bulk=False):
+    """
+    take a slot of the current window, without waiting
+    """
+    window = int(time.time())
+    limit = max(int(rate * BULK_SHARE), 1) if bulk else rate
+    key = f"outbound:{connector_id}:{window}"
+    if _incr(key) > limit:
+        cache.decr(key)
+        return False
+    if room_id:
+        room_key = f"outbound:{connector_id}:{window}:{room_id}"
+        if _incr(room_key) > max(rate // 2, 1):
+            # a refused attempt takes no slot
+            cache.decr(room_key)
+            cache.decr(key)
+            return False
+    return True
+
+
+def acquire(connector_id, rate, room_id=None, bulk=False, timeout=10):
+    """
+    take a slot, waiting up to timeout seconds for it. Only for the workers.
+    return False if no slot was available
+    """
+    deadline = time.time() + timeout
+    waiting_key = f"outbound_waiting:{connector_id}"
+    _incr_counter(waiting_key)
+    try:
+        while True:
+            if try_acquire(connector_id, rate, room_id=room_id, bulk=bulk):
+                return True
+            now = time.time()
+            if now >= deadline:
+                return False
+            # wait for the next window
+            time.sleep(min(int(now) + 1 - now, deadline - now))
+    finally:
+        _decr_counter(waiting_key)
+
+
+def _incr_counter(key):
+    cache.add(key, 0, timeout=COUNTER_TIMEOUT)
+    cache.incr(key)
+    cache.touch(key, COUNTER_TIMEOUT)
+
+
+def _decr_counter(key):
+    try:
+        if cache.decr(key) < 0:
+            cache.set(key, 0, timeout=COUNTER_TIMEOUT)
+        else:
+            cache.touch(key, COUNTER_TIMEOUT)
+    except ValueError:
+        pass
+
+
+def deferred_room_key(connector_id, room_id):
+    return f"outbound_deferred_room:{connector_id}:{room_id}"
+
+
+def deferred_message_key(message_id):
+    return f"outbound_deferred_message:{message_id}"
+
+
+def defer(connector_id, room_id, message_id):
+    """
+    mark a message as deferred to the workers for lack of a slot.
+    return True if the room had no deferred messages, so its delivery
+    must be started
+    """
+    _incr_counter(f"outbound_deferred:{connector_id}")
+    cache.set(deferred_message_key(message_id), True, timeout=DEFERRED_TIMEOUT)
+    return cache.add(
+        deferred_room_key(connector_id, room_id), True, timeout=DEFERRED_TIMEOUT
+    )
+
+
+def undefer(connector_id, message_id):
+    if cache.get(deferred_message_key(message_id)):
+        cache.delete(deferred_message_key(message_id))
+        _decr_counter(f"outbound_deferred:{connector_id}")
+
+
+def is_deferred(message_id):
+    return bool(cache.get(deferred_message_key(message_id)))
+
+
+def has_deferred(connector_id, room_id):
+    """
+    the room has deferred messages, the next ones must wait behind them
+    """
+    return bool(cache.get(deferred_room_key(connector_id, room_id)))
+
+
+def get_deferred_ids(message_ids):
+    """
+    the deferred ones among the message ids, in order
+    """
+    keys = {deferred_message_key(message_id): message_id for message_id in message_ids}
+    return sorted(keys[key] for key in cache.get_many(list(keys.keys())))
+
+
+def hold_room(connector_id, room_id):
+    """
+    keep the next messages of the room behind the deferred ones
+    """
+    key = deferred_room_key(connector_id, room_id)
+    if not cache.add(key, True, timeout=DEFERRED_TIMEOUT):
+        cache.touch(key, DEFERRED_TIMEOUT)
+
+
+def release_room(connector_id, room_id):
+    cache.delete(deferred_room_key(connector_id, room_id))
+
+
+def get_queue_depth(connector_id):
+    """
+    the messages waiting for a slot, and deferred to the workers
+    """
+    return {
+        "waiting": cache.get(f"outbound_waiting:{connector_id}") or 0,
+        "deferred": cache.get(f"outbound_deferred:{connector_id}") or 0,
+        "sent_this_second": cache.get(f"outbound:{connector_id}:{int(time.time())}")
+        or 0,
+    }
@@ -0,0 +1,128 @@
+"""
+In-process registry of the enabled connectors and servers, by external token,
+used by the webhook endpoints to avoid a database round-trip per request.
+
+Entries are tagged with a generation shared by all the nodes through the cache.
+Any change to a connector or a server (see instance.signals) replaces the
+generation, so every node drops its entries at the next lookup.
+
+Unknown tokens are not kept: the endpoints are public, and caching the misses
+would let random tokens grow the registry without bound.
+"""
+import copy
+import threading
+import uuid
+from functools import lru_cache
+
+from django.apps import apps
+from django.core.cache import cache
+from django.http import Http404
+
+GENERATION_KEY = "instance_registry_generation"
+
+_registry = {}
+_lock = threading.Lock()
+
+
+def get_generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # the cache was flushed, start a new generation
+        cache.add(GENERATION_KEY, uuid.uuid4().hex, timeout=None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def invalidate():
+    """
+    drop the registry entries from all the nodes
+    """
+    cache.set(GENERATION_KEY, uuid.uuid4().hex, timeout=None)
+    with _lock:
+        _registry.clear()
+
+
+@lru_cache(maxsize=None)
+def get_plugin_class(connector_type):
+    """
+    import the connector plugin only once per process
+    """
+    plugin_string = f"rocket_connect.plugins.{connector_type}"
+    plugin = __import__(plugin_string, fromlist=["Connector"])
+    return plugin.Connector
+
+
+def _lookup(key, loader):
+    generation = get_generation()
+    entry = _registry.get(key)
+    if not entry or entry[0] != generation:
+        obj = loader()
+        with _lock:
+            if obj is None:
+                _registry.pop(key, None)
+            else:
+                _registry[key] = (generation, obj)
+    else:
+        obj = entry[1]
+    # every request gets its own copy, as plugins may change it
+    return copy.deepcopy(obj)
+
+
+def get_connector(external_token):
+    """
+    return the enabled connector, with an enabled server, or None
+    """
+    Connector = apps.get_model(app_label="instance", model_name="Connector")
+
+    def loader():
+        return (
+            Connector.objects.select_related("server")
+            .filter(external_token=external_token, enabled=True, server__enabled=True)
+            .first()
+        )
+
+    return _lookup(("connector", external_token), loader)
+
+
+def get_connector_by_id(connector_id):
+    """
+    return the enabled connector, with an enabled server, or None
+    """
+    Connector = apps.get_model(app_label="instance", model_name="Connector")
+
+    def loader():
+        return (
+            Connector.objects.select_related("server")
+            .filter(id=connector_id, enabled=True, server__enabled=True)
+            .first()
+        )
+
+    return _lookup(("connector_id", connector_id), loader)
+
+
+def get_server(external_token):
+    """
+    return the enabled server, or None
+    """
+    Server = apps.get_model(app_label="instance", model_name="Server")
+
+    def loader():
+        return Server.objects.filter(
+            external_token=external_token, enabled=True
+        ).first()
+
+    return _lookup(("server", external_token), loader)
+
+
+def get_connector_or_404(external_token):
+    connector = get_connector(external_token)
+    if not connector:
+        raise Http404("No Connector matches the given query.")
+    return connector
+
+
+def get_server_or_404(external_token):
+    server = get_server(external_token)
+    if not server:
+        raise Http404("No Server matches the given query.")
+    return server
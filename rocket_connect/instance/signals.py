@@ -0,0 +1,13 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from instance import registry
+from instance.models import Connector, Server
+
+
+@receiver(post_save, sender=Connector)
+@receiver(post_delete, sender=Connector)
+@receiver(post_save, sender=Server)
+@receiver(post_delete, sender=Server)
+@receiver(m2m_changed, sender=Connector.secondary_connectors.through)
+def invalidate_registry(sender, **kwargs):
+    registry.invalidate()
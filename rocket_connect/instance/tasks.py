@@ -1,12 +1,18 @@
 import dateutil.parser
 import requests
 from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
 from django.template import Context, Template
 from django.utils import timezone
+from instance import ratelimit
 from instance.models import Server
 
 from config import celery_app
 
+# Rocket.Chat refuses messages longer than this by default
+DIGEST_MAX_LENGTH = 5000
+
 
 @celery_app.task(
     retry_kwargs={"max_retries": 7, "countdown": 5},
@@ -23,6 +29,210 @@ def intake_unread_messages(connector_id):
     return unread
 
 
+@celery_app.task(
+    retry_kwargs={"max_retries": 7, "countdown": 5},
+    autoretry_for=(requests.ConnectionError,),
+    acks_late=True,
+)
+def intake_event(event_id):
+    """Process a persisted Intake Event from the asynchronous intake"""
+    IntakeEvent = apps.get_model(app_label="envelope", model_name="IntakeEvent")
+    try:
+        event = IntakeEvent.objects.select_related("connector").get(
+            id=event_id, attempts__lt=IntakeEvent.MAX_ATTEMPTS
+        )
+    except IntakeEvent.DoesNotExist:
+        # already processed
+        return False
+    if not event.claim():
+        # a requeued copy of this task is running it
+        return False
+    response = event.process()
+    return response.status_code
+
+
+@celery_app.task(
+    retry_kwargs={"max_retries": 7, "countdown": 5},
+    autoretry_for=(requests.ConnectionError,),
+    acks_late=True,
+)
+def intake_lane(connector_id, lane):
+    """
+    Process, in arrival order, the Intake Events of a lane (a visitor)
+    only one worker drains a lane at a time, while different lanes
+    run in parallel
+    """
+    IntakeEvent = apps.get_model(app_label="envelope", model_name="IntakeEvent")
+    events = IntakeEvent.objects.filter(
+        connector_id=connector_id,
+        lane=lane,
+        attempts__lt=IntakeEvent.MAX_ATTEMPTS,
+    ).select_related("connector")
+    lock_key = f"intake_lane:{connector_id}:{lane}"
+    processed = 0
+    while events.exists():
+        # another worker is draining this lane, and will get our events
+        if not cache.add(lock_key, True, timeout=settings.CELERY_TASK_TIME_LIMIT):
+            break
+        try:
+            event = events.first()
+            while event:
+                event.process()
+                processed += 1
+                event = events.first()
+        finally:
+            cache.delete(lock_key)
+        # an event may have arrived after the last check
+        # and before the lock was released, so loop again
+    return processed
+
+
+@celery_app.task(
+    retry_kwargs={"max_retries": 7, "countdown": 5},
+    autoretry_for=(requests.ConnectionError,),
+)
+def apply_ack_receipt(message_id):
+    """Update a message sent out with the ack receipts received for it"""
+    Message = apps.get_model(app_label="envelope", model_name="Message")
+    message = Message.objects.select_related("connector__server", "room").get(
+        id=message_id
+    )
+    Connector = message.connector.get_connector_class()
+    connector = Connector(message.connector, {}, "outgoing")
+    return connector.apply_ack_receipt(message)
+
+
+@celery_app.task(
+    retry_kwargs={"max_retries": 7, "countdown": 5},
+    autoretry_for=(requests.ConnectionError,),
+)
+def deliver_message(message_id):
+    """
+    Deliver, in order, the messages of a room deferred by the connector
+    outbound rate limit, from this one on. One worker delivers a room at a time
+    """
+    Message = apps.get_model(app_label="envelope", model_name="Message")
+    message = Message.objects.select_related("connector__server", "room").get(
+        id=message_id
+    )
+    connector_id = message.connector_id
+    room_id = message.room.room_id if message.room else None
+    lock_key = f"deliver_room:{connector_id}:{room_id}"
+    if not cache.add(lock_key, True, timeout=settings.CELERY_TASK_TIME_LIMIT):
+        # another worker is delivering the room, try again after it
+        deliver_message.apply_async(args=[message_id], countdown=1)
+        return False
+    room_messages = Message.objects.filter(
+        connector_id=connector_id,
+        room=message.room,
+        type="ingoing",
+        delivered=False,
+        id__gte=message_id,
+    ).select_related("connector__server", "room")
+    delivered = 0
+    try:
+        while True:
+            deferred_ids = ratelimit.get_deferred_ids(
+                room_messages.values_list("id", flat=True)
+            )
+            if not deferred_ids:
+                # let the next messages of the room go straight, but look
+                # again for one deferred before the room was released
+                ratelimit.release_room(connector_id, room_id)
+                deferred_ids = ratelimit.get_deferred_ids(
+                    room_messages.values_list("id", flat=True)
+                )
+                if not deferred_ids:
+                    break
+            ratelimit.hold_room(connector_id, room_id)
+            next_message = room_messages.get(id=deferred_ids[0])
+            connector = next_message.get_connector()
+            if not connector.acquire_outgoing_slot(wait=True):
+                # the rate is still busy, keep the order and try again later
+                deliver_message.apply_async(args=[next_message.id], countdown=1)
+                break
+            connector.outbound_slot_taken = True
+            try:
+                connector.ingoing()
+            except Exception:
+                # the next messages of the room are still delivered
+                deliver_message.apply_async(args=[next_message.id], countdown=1)
+                raise
+            finally:
+                ratelimit.undefer(connector_id, next_message.id)
+            delivered += 1
+    finally:
+        cache.delete(lock_key)
+    return delivered
+
+
+@celery_app.task(
+    retry_kwargs={"max_retries": 7, "countdown": 5},
+    autoretry_for=(requests.ConnectionError,),
+)
+def run_campaign(campaign_id):
+    """
+    Send a slice of a Campaign, and queue the next one until it is done
+    """
+    Campaign = apps.get_model(app_label="envelope", model_name="Campaign")
+    campaign = Campaign.objects.select_related("connector__server").get(id=campaign_id)
+    lock_key = f"campaign:{campaign_id}"
+    # only one worker sends a campaign at a time
+    if not cache.add(lock_key, True, timeout=settings.CELERY_TASK_TIME_LIMIT):
+        return False
+    try:
+        done = campaign.run()
+    finally:
+        cache.delete(lock_key)
+    if not done:
+        # only numbers that could not be checked are left, wait for the gateway
+        waiting = not campaign.recipients.filter(status="valid").exists()
+        campaign.dispatch(countdown=60 if waiting else None)
+    return done
+
+
+@celery_app.task(
+    retry_kwargs={"max_retries": 7, "countdown": 5},
+    autoretry_for=(requests.ConnectionError,),
+    acks_late=True,
+)
+def redeliver_messages(connector_id, bucket):
+    """
+    Redeliver a slice of the undelivered messages of a bucket,
+    and queue the next one until it is done
+    """
+    from envelope import redelivery
+    from instance.models import Connector
+
+    connector = Connector.objects.select_related("server").get(id=connector_id)
+    lock_key = f"redelivery:{connector_id}:bucket:{bucket}:lock"
+    # only one worker delivers a bucket at a time
+    if not cache.add(lock_key, True, timeout=settings.CELERY_TASK_TIME_LIMIT):
+        return False
+    try:
+        done = redelivery.run_bucket(connector, bucket)
+    finally:
+        cache.delete(lock_key)
+    if not done:
+        redeliver_messages.delay(connector_id, bucket)
+    return done
+
+
+@celery_app.task
+def archive_messages(days=None):
+    """Archive the old delivered messages of all connectors"""
+    from envelope import archive
+    from instance.models import Connector
+
+    days = days or settings.MESSAGE_RETENTION_DAYS
+    if not days:
+        return False
+    response = {}
+    for connector in Connector.objects.all():
+        response[connector.external_token] = archive.archive_messages(connector, days)
+    return response
+
+
 # T1
 @celery_app.task(
     retry_kwargs={"max_retries": 7, "countdown": 5},
@@ -34,73 +244,124 @@ def server_maintenance(server_token):
     response = {}
     # sync room
     response["room_sync"] = server.room_sync(execute=True)
+    # requeue stale intake events
+    response["requeued_intake_events"] = server.requeue_intake_events()
+    # refresh the departments catalog
+    response["departments"] = len(server.get_departments(refresh=True))
     # return results
     return response
 
 
+@celery_app.task
+def rebuild_stats(server_token):
+    """
+    count again the connector stats of a server. A full count of
+    the messages, to be scheduled at a low frequency
+    """
+    server = Server.objects.get(external_token=server_token)
+    return server.rebuild_stats()
+
+
+@celery_app.task(
+    retry_kwargs={"max_retries": 7, "countdown": 5},
+    autoretry_for=(requests.ConnectionError,),
+)
+def refresh_departments(server_token):
+    """refresh the departments catalog of a server"""
+    server = Server.objects.get(external_token=server_token)
+    return len(server.get_departments(refresh=True))
+
+
 # T2
 @celery_app.task(
     retry_kwargs={"max_retries": 7, "countdown": 5},
     autoretry_for=(requests.ConnectionError,),
 )
 def alert_last_message_open_chat(
-    server_token, seconds_last_message, notification_target, notification_template
+    server_token,
+    seconds_last_message,
+    notification_target,
+    notification_template,
+    digest=False,
 ):
-    """alert open messages"""
+    """
+    alert open messages. in digest mode, each target gets
+    a single message with all the alerts of the run
+    """
 
     # get server
     server = Server.objects.get(external_token=server_token)
     # get rocket
     rocket = server.get_rocket_client()
-    # list all open messages
-    open_rooms = server.get_open_rooms()
+    # list all open messages, from every page
+    open_rooms = server.get_all_open_rooms() or []
     # process
     alerted_rooms = []
+    rendered_targets = []
+    digests = {}
     now = timezone.now()
+    external_url = server.get_external_url()
+    # compile the templates once per run
+    template = Template(notification_template)
+    targets = notification_target.split(",")
+    target_templates = {
+        target: Template(target) for target in targets if not target.startswith("#")
+    }
+
+    def post_message(target, message):
+        if target.startswith("#"):
+            return rocket.chat_post_message(
+                text=message, channel=target.replace("#", "")
+            )
+        room_id = server.get_dm_room_id(target)
+        if not room_id:
+            return None
+        sent = rocket.chat_post_message(text=message, room_id=room_id)
+        if not sent.ok:
+            # the cached room may be gone
+            room_id = server.get_dm_room_id(target, refresh=True)
+            if room_id:
+                sent = rocket.chat_post_message(text=message, room_id=room_id)
+        return sent
+
     # parse datetime strings to python objects
+    for room in open_rooms:
+        if not room.get("lastMessage"):
+            continue
+        last_message = room["lastMessage"]
+        ts = dateutil.parser.parse(last_message["ts"])
+        delta = now - ts
+        if delta.total_seconds() < seconds_last_message:
+            continue
+        alerted_rooms.append(room["_id"])
+        # adjust context dict
+        room["id"] = room["_id"]
+        room["lm_obj"] = dateutil.parser.parse(room["lm"])
+        room["ts_obj"] = dateutil.parser.parse(room["ts"])
+        # render notification_template
+        context = Context({"room": room, "external_url": external_url})
+        message = template.render(context)
+        for target in targets:
+            if target.startswith("#"):
+                rendered_target = target
+            else:
+                # target may contain variables
+                rendered_target = target_templates[target].render(context).strip()
+            if not rendered_target:
+                continue
+            if rendered_target not in rendered_targets:
+                rendered_targets.append(rendered_target)
+            if digest:
+                digests.setdefault(rendered_target, []).append(message)
+            else:
+                post_message(rendered_target, message)
 
-    for room in open_rooms.get("rooms", []):
-        rendered_targets = []
-        if room.get("lastMessage"):
-            last_message = room["lastMessage"]
-            ts = dateutil.parser.parse(last_message["ts"])
-            delta = now - ts
-            if delta.total_seconds() >= seconds_last_message:
-                alerted_rooms.append(room["_id"])
-                # adjust context dict
-                room["id"] = room["_id"]
-                room["lm_obj"] = dateutil.parser.parse(room["lm"])
-                room["ts_obj"] = dateutil.parser.parse(room["ts"])
-                # render notification_template
-                context_dict = {
-                    "room": room,
-                    # "open_rooms": open_rooms,
-                    "external_url": server.get_external_url(),
-                }
-                context = Context(context_dict)
-                template = Template(notification_template)
-                for target in notification_target.split(","):
-
-                    # render message
-                    message = template.render(context)
-                    if target.startswith("#"):
-                        rendered_targets.append(target)
-                        sent = rocket.chat_post_message(
-                            text=message, channel=target.replace("#", "")
-                        )
-                    else:
-
-                        # target may contain variables
-                        target_template = Template(target)
-                        rendered_target = target_template.render(context)
-                        rendered_targets.append(rendered_target)
-                        dm = rocket.im_create(username=rendered_target)
-                        if dm.ok:
-                            room_id = dm.json()["room"]["rid"]
-                            sent = rocket.chat_post_message(
-                                text=message, room_id=room_id
-                            )
-                            print("SENT! ", sent)
+    for target, alerts in digests.items():
+        header = ":warning: {} open room{} without messages for {} seconds".format(
+            len(alerts), "s" if len(alerts) > 1 else "", seconds_last_message
+        )
+        for message in split_digest([header] + alerts):
+            post_message(target, message)
 
     # return findings
     return {
@@ -109,9 +370,26 @@ def alert_last_message_open_chat(
         "seconds_last_message": seconds_last_message,
         "notification_target_unrendered": notification_target,
         "rendered_targets": rendered_targets,
+        "digest": digest,
     }
 
 
+def split_digest(parts, max_length=DIGEST_MAX_LENGTH):
+    """
+    join the parts of a digest in messages no longer than max_length
+    """
+    messages = []
+    current = ""
+    for part in parts:
+        if current and len(current) + len(part) + 2 > max_length:
+            messages.append(current)
+            current = ""
+        current = current + "\n\n" + part if current else part
+    if current:
+        messages.append(current)
+    return messages
+
+
 # T3
 @celery_app.task(
     retry_kwargs={"max_retries": 7, "countdown": 5},
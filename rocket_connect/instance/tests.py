@@ -1,3 +1,511 @@
-# from django.test import TestCase
+import asyncio
+import datetime
+import json
 
-# Create your tests here.
+import pytest
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import Http404
+from django.utils import timezone
+from envelope.models import IntakeEvent, Message
+from instance import monitor, ratelimit, registry, tasks
+from instance.clients import (
+    ConnectorSession,
+    ConnectorSessionManager,
+    RocketChatClientManager,
+)
+from instance.models import Connector, Server
+
+from config import websocket
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def server():
+    return Server.objects.create(
+        name="server",
+        url="http://rocketchat:3000",
+        managers="admin",
+        admin_user_id="admin_id",
+        admin_user_token="admin_token",
+        bot_user_id="bot_id",
+        bot_user_token="bot_token",
+    )
+
+
+@pytest.fixture
+def connector(server):
+    return server.connectors.create(name="connector", connector_type="wppconnect")
+
+
+def test_registry_caches_connector(connector, django_assert_num_queries):
+    registry.invalidate()
+    registry.get_connector(connector.external_token)
+    with django_assert_num_queries(0):
+        cached = registry.get_connector(connector.external_token)
+    assert cached.pk == connector.pk
+    assert cached.server.pk == connector.server.pk
+
+
+def test_registry_returns_copies(connector):
+    registry.invalidate()
+    first = registry.get_connector(connector.external_token)
+    first.config["changed"] = True
+    second = registry.get_connector(connector.external_token)
+    assert "changed" not in second.config
+
+
+def test_registry_invalidated_on_save(connector):
+    registry.invalidate()
+    registry.get_connector(connector.external_token)
+    connector.enabled = False
+    connector.save()
+    assert registry.get_connector(connector.external_token) is None
+    with pytest.raises(Http404):
+        registry.get_connector_or_404(connector.external_token)
+
+
+def test_registry_server_disabled(server, connector):
+    registry.invalidate()
+    assert registry.get_server(server.external_token).pk == server.pk
+    Server.objects.filter(pk=server.pk).update(enabled=False)
+    # bulk updates do not send signals
+    assert registry.get_server(server.external_token) is not None
+    registry.invalidate()
+    assert registry.get_server(server.external_token) is None
+    assert registry.get_connector(connector.external_token) is None
+    assert Connector.objects.filter(pk=connector.pk).exists()
+
+
+def test_registry_does_not_keep_unknown_tokens(connector):
+    registry.invalidate()
+    assert registry.get_connector("unknown") is None
+    assert registry.get_server("unknown") is None
+    assert registry._registry == {}
+    registry.get_connector(connector.external_token)
+    connector.enabled = False
+    connector.save()
+    assert registry.get_connector(connector.external_token) is None
+    assert registry._registry == {}
+
+
+def test_requeue_intake_events(connector, monkeypatch):
+    dispatched = []
+    monkeypatch.setattr(tasks.intake_event, "delay", dispatched.append)
+    old = timezone.now() - datetime.timedelta(minutes=10)
+    lost = connector.intake_events.create(body="{}")
+    queued = connector.intake_events.create(body="{}")
+    running = connector.intake_events.create(body="{}")
+    dead = connector.intake_events.create(body="{}", attempts=3)
+    connector.intake_events.update(created=old, dispatched=old)
+    # still waiting behind a backlog, dispatched a minute ago
+    IntakeEvent.objects.filter(id=queued.id).update(
+        dispatched=timezone.now() - datetime.timedelta(minutes=1)
+    )
+    assert running.claim()
+    assert not running.claim()
+
+    assert connector.server.requeue_intake_events() == 1
+    assert dispatched == [lost.id]
+    # dispatched again, so not requeued on the next run
+    assert connector.server.requeue_intake_events() == 0
+    assert list(connector.server.get_dead_intake_events()) == [dead]
+
+
+def test_intake_async_dispatches_on_commit(
+    connector, monkeypatch, django_capture_on_commit_callbacks
+):
+    dispatched = []
+    monkeypatch.setattr(tasks.intake_event, "delay", dispatched.append)
+
+    class Plugin:
+        def __init__(self, connector, message, type, request=None):
+            pass
+
+        def must_intake_inline(self):
+            return False
+
+        def get_intake_lane(self):
+            return None
+
+    class Request:
+        body = b'{"event": "onmessage"}'
+
+    monkeypatch.setattr(Connector, "get_connector_class", lambda self: Plugin)
+    with django_capture_on_commit_callbacks(execute=True):
+        with transaction.atomic():
+            response = connector.intake_async(Request())
+            # the workers could not read the event yet
+            assert dispatched == []
+    assert json.loads(response.content) == {"queued": True}
+    assert dispatched == [connector.intake_events.get().id]
+
+
+def test_client_manager_reuses_clients(server):
+    manager = RocketChatClientManager()
+    admin = manager.get_client(server)
+    bot = manager.get_client(server, bot=True)
+    assert manager.get_client(server) is admin
+    assert manager.get_client(server, bot=True) is bot
+    assert admin is not bot
+    # both roles share the same keep-alive session
+    assert admin.req is bot.req
+    # changing the credentials gets a new client
+    server.admin_user_token = "new_token"
+    assert manager.get_client(server) is not admin
+
+
+def test_client_manager_evicts_unauthorized(server):
+    manager = RocketChatClientManager()
+    admin = manager.get_client(server)
+    response = requests.Response()
+    response.status_code = 401
+    response.request = requests.Request(
+        "GET", "http://rocketchat:3000/api/v1/me", headers=admin.headers
+    ).prepare()
+    manager._evict_unauthorized(response)
+    assert manager.get_client(server) is not admin
+
+
+def test_room_sync_reconciles_all_pages(server, connector, monkeypatch):
+    connector.rooms.create(token="whatsapp:1", room_id="ROOM1", open=True)
+    connector.rooms.create(token="whatsapp:2", room_id="ROOM2", open=True)
+    # missed by the listing, as a room closed while it was paged
+    connector.rooms.create(token="whatsapp:3", room_id="ROOM3", open=True)
+    pages = {
+        0: {"rooms": [{"_id": "ROOM1"}], "total": 2},
+        1: {"rooms": [{"_id": "OTHER_ROOM"}], "total": 2},
+    }
+
+    class Rocket:
+        def livechat_rooms(self, offset=0, **kwargs):
+            response = requests.Response()
+            response.status_code = 200
+            response._content = json.dumps(pages[offset]).encode()
+            return response
+
+        def rooms_info(self, room_id):
+            response = requests.Response()
+            response.status_code = 200
+            response._content = json.dumps(
+                {"room": {"_id": room_id, "open": room_id == "ROOM3"}}
+            ).encode()
+            return response
+
+    monkeypatch.setattr(Server, "get_rocket_client", lambda self: Rocket())
+    assert server.get_all_open_rooms_id(page_size=1) == ["ROOM1", "OTHER_ROOM"]
+    # ROOM1 is only in the first page, and must stay open
+    monkeypatch.setattr(
+        Server, "get_all_open_rooms_id", lambda self: ["ROOM1", "OTHER_ROOM"]
+    )
+    response = server.room_sync(execute=True)
+    assert response["close_rooms_id"] == ["ROOM2", "ROOM3"]
+    assert response["still_open_rooms_id"] == ["ROOM3"]
+    assert response["executed"] == 1
+    assert response["open_rooms_total"] == 2
+    assert list(
+        connector.rooms.filter(open=True)
+        .order_by("room_id")
+        .values_list("room_id", flat=True)
+    ) == ["ROOM1", "ROOM3"]
+
+
+def test_server_departments_catalog(server, monkeypatch):
+    calls = []
+
+    class Rocket:
+        def call_api_get(self, method, offset=0, **kwargs):
+            calls.append(offset)
+            response = requests.Response()
+            response.status_code = 200
+            departments = [
+                {"_id": "DEP1", "name": "Sales", "enabled": True},
+                {"_id": "DEP2", "name": "Support", "enabled": False},
+            ]
+            response._content = json.dumps(
+                {"departments": departments[offset:][:1], "total": 2}
+            ).encode()
+            return response
+
+    monkeypatch.setattr(Server, "get_rocket_client", lambda self: Rocket())
+    cache.clear()
+    assert len(server.get_departments()) == 2
+    assert server.get_department("DEP2")["name"] == "Support"
+    assert server.search_departments("SUP")[0]["_id"] == "DEP2"
+    assert server.get_department_map() == {"Sales": "DEP1"}
+    # all read from the cache after the first two pages
+    assert calls == [0, 1]
+    assert server.get_department(None) is None
+    assert calls == [0, 1]
+    # an unknown id refreshes the catalog once in a while
+    assert server.get_department("UNKNOWN") is None
+    assert server.get_department("UNKNOWN") is None
+    assert calls == [0, 1, 0, 1]
+
+
+def test_connector_session_refreshes_token():
+    class Adapter(requests.adapters.HTTPAdapter):
+        def send(self, request, **kwargs):
+            response = requests.Response()
+            response.status_code = (
+                200 if request.headers.get("Authorization") == "Bearer new" else 401
+            )
+            response.request = request
+            self.timeouts.append(kwargs.get("timeout"))
+            return response
+
+    adapter = Adapter()
+    adapter.timeouts = []
+    session = ConnectorSession(
+        adapter,
+        headers={"Authorization": "Bearer old"},
+        refresh_token=lambda: {"Authorization": "Bearer new"},
+    )
+    assert session.get("http://wppconnect:21465/api/status-session").ok
+    assert adapter.timeouts == [settings.CONNECTOR_SESSION_TIMEOUT] * 2
+    # the connection pool is shared by the sessions of a connector
+    manager = ConnectorSessionManager()
+    pool = manager.get_session(1).adapters["http://"]
+    assert manager.get_session(1).adapters["https://"] is pool
+    assert manager.get_session(2).adapters["http://"] is not pool
+
+
+def test_outbound_rate_limit(monkeypatch):
+    cache.clear()
+    monkeypatch.setattr(ratelimit.time, "time", lambda: 1000.5)
+    # a room takes at most half of the window
+    for i in range(5):
+        assert ratelimit.try_acquire(1, 10, room_id="ROOM1")
+    assert not ratelimit.try_acquire(1, 10, room_id="ROOM1")
+    assert not ratelimit.try_acquire(1, 10, room_id="ROOM1")
+    # the refused attempts took no slot of the room
+    assert cache.get("outbound:1:1000:ROOM1") == 5
+    # bulk sends leave part of the window to the agents
+    assert ratelimit.try_acquire(1, 10, room_id="ROOM2", bulk=True)
+    assert ratelimit.try_acquire(1, 10, room_id="ROOM3", bulk=True)
+    assert not ratelimit.try_acquire(1, 10, room_id="ROOM4", bulk=True)
+    for i in range(3):
+        assert ratelimit.try_acquire(1, 10, room_id="ROOM4")
+    assert not ratelimit.try_acquire(1, 10, room_id="ROOM5")
+    # other connectors have their own rate
+    assert ratelimit.try_acquire(2, 10)
+    assert ratelimit.get_queue_depth(1)["sent_this_second"] == 10
+    # the next window is free again
+    monkeypatch.setattr(ratelimit.time, "time", lambda: 1001.5)
+    assert ratelimit.try_acquire(1, 10, room_id="ROOM1")
+
+
+def test_deferred_messages_keep_room_order(connector, monkeypatch):
+    cache.clear()
+    room = connector.rooms.create(token="whatsapp:1", room_id="ROOM1", open=True)
+    first, second, third = [
+        Message.objects.create(
+            connector=connector, room=room, envelope_id=envelope_id, type="ingoing"
+        )
+        for envelope_id in ["M1", "M2", "M3"]
+    ]
+    # the first deferred message starts the delivery of the room
+    assert ratelimit.defer(connector.id, "ROOM1", first.id)
+    # the next ones wait behind it, even with a free slot
+    assert ratelimit.has_deferred(connector.id, "ROOM1")
+    assert not ratelimit.defer(connector.id, "ROOM1", second.id)
+    assert ratelimit.get_queue_depth(connector.id)["deferred"] == 2
+
+    delivered = []
+
+    class DeferredConnector:
+        outbound_slot_taken = False
+
+        def __init__(self, message):
+            self.message = message
+
+        def acquire_outgoing_slot(self, wait=False):
+            assert wait
+            return True
+
+        def ingoing(self):
+            assert self.outbound_slot_taken
+            delivered.append(self.message.envelope_id)
+            Message.objects.filter(id=self.message.id).update(delivered=True)
+
+    monkeypatch.setattr(Message, "get_connector", lambda self: DeferredConnector(self))
+    assert tasks.deliver_message(first.id) == 2
+    # M3 was not deferred, it went straight
+    assert delivered == ["M1", "M2"]
+    assert not ratelimit.has_deferred(connector.id, "ROOM1")
+    assert ratelimit.get_queue_depth(connector.id)["deferred"] == 0
+
+
+def test_monitor_shared_snapshot(server, monkeypatch):
+    cache.clear()
+    calls = []
+    rooms = [
+        {
+            "_id": "ROOM1",
+            "servedBy": {"username": "bob"},
+            "lm": "2022-01-01T10:00:00.000Z",
+            "ts": "2022-01-01T09:00:00.000Z",
+            "msgs": 1,
+        },
+        {
+            "_id": "ROOM2",
+            "servedBy": {"username": "alice"},
+            "lm": "2022-01-01T11:00:00.000Z",
+            "ts": "2022-01-01T09:00:00.000Z",
+            "msgs": 1,
+        },
+    ]
+
+    class Rocket:
+        def call_api_get(self, method, offset=0, **kwargs):
+            calls.append(method)
+            response = requests.Response()
+            response.status_code = 200
+            response._content = json.dumps({"rooms": rooms, "total": 2}).encode()
+            return response
+
+    monkeypatch.setattr(Server, "get_rocket_client", lambda self: Rocket())
+    # many viewers, a single query
+    for viewer in range(3):
+        open_rooms = monitor.get_open_rooms(server)
+    assert calls == ["livechat/rooms"]
+    assert [room["_id"] for room in open_rooms] == ["ROOM2", "ROOM1"]
+    version = monitor.get_version(server.id)
+
+    # messages and closed sessions are patched in place
+    monitor.apply_event(
+        server,
+        {
+            "_id": "ROOM1",
+            "type": "Message",
+            "messages": [{"msg": "hi", "ts": "2022-01-01T12:00:00.000Z"}],
+        },
+    )
+    monitor.apply_event(server, {"_id": "ROOM2", "type": "LivechatSession"})
+    open_rooms = monitor.get_open_rooms(server)
+    assert calls == ["livechat/rooms"]
+    assert [(room["_id"], room["msgs"]) for room in open_rooms] == [("ROOM1", 2)]
+    assert open_rooms[0]["lastMessage"]["msg"] == "hi"
+    assert monitor.get_version(server.id) == version + 2
+
+    # other events mark the snapshot stale
+    monitor.apply_event(server, {"_id": "ROOM3", "type": "LivechatSessionTaken"})
+    assert monitor.needs_refresh(server)
+
+    # a webhook that cannot take the lock does not overwrite the snapshot
+    version = monitor.get_version(server.id)
+    cache.delete(monitor.stale_key(server.id))
+    cache.add(monitor.lock_key(server.id), True)
+    monitor.apply_event(server, {"_id": "ROOM1", "type": "LivechatSession"})
+    assert "ROOM1" in cache.get(monitor.snapshot_key(server.id))["rooms"]
+    assert monitor.get_version(server.id) == version
+    assert monitor.needs_refresh(server)
+
+
+def test_monitor_websocket(server, settings, monkeypatch):
+    cache.clear()
+    settings.MONITOR_POLL_INTERVAL = 0.01
+    rooms = {"ROOM1": {"_id": "ROOM1", "fname": "visitor one", "msgs": 1}}
+    monkeypatch.setattr(
+        monitor, "build_snapshot", lambda server: {"rooms": rooms, "built": 1}
+    )
+
+    def run(watched_server, received):
+        sent = []
+        received = iter(received)
+
+        async def receive():
+            event = next(received, None)
+            if event is None:
+                # wait for the next poll
+                await asyncio.sleep(1)
+            return event
+
+        async def send(message):
+            sent.append(message)
+
+        monkeypatch.setattr(
+            websocket, "get_monitor_server", lambda scope, server_id: watched_server
+        )
+        scope = {"path": "/ws/server/TOKEN/monitor/", "query_string": b""}
+        asyncio.run(websocket.websocket_application(scope, receive, send))
+        return sent
+
+    # not an owner of the server
+    sent = run(None, [{"type": "websocket.connect"}])
+    assert sent == [{"type": "websocket.close", "code": 4403}]
+
+    sent = run(
+        server,
+        [{"type": "websocket.connect"}, None, {"type": "websocket.disconnect"}],
+    )
+    assert sent[0] == {"type": "websocket.accept"}
+    # the rooms are pushed once, until the snapshot changes
+    assert len(sent) == 2
+    assert "visitor one" in sent[1]["text"]
+
+
+def test_alert_last_message_open_chat_digest(server, monkeypatch):
+    cache.clear()
+    posted = []
+    dm_created = []
+    rooms = [
+        {
+            "_id": f"ROOM{i}",
+            "fname": f"visitor {i}",
+            "servedBy": {"username": "agent"},
+            "lastMessage": {"ts": "2022-01-01T10:00:00.000Z", "msg": "hello"},
+            "lm": "2022-01-01T10:00:00.000Z",
+            "ts": "2022-01-01T09:00:00.000Z",
+        }
+        for i in range(3)
+    ]
+    pages = {0: rooms[:2], 2: rooms[2:]}
+
+    def ok(content):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps(content).encode()
+        return response
+
+    class Rocket:
+        def livechat_rooms(self, offset=0, **kwargs):
+            return ok({"rooms": pages[offset], "total": 3})
+
+        def im_create(self, username):
+            dm_created.append(username)
+            return ok({"room": {"rid": f"DM-{username}"}})
+
+        def chat_post_message(self, text, room_id=None, channel=None):
+            posted.append((room_id or channel, text))
+            return ok({"success": True})
+
+    monkeypatch.setattr(Server, "get_rocket_client", lambda self: Rocket())
+    kwargs = {
+        "server_token": server.external_token,
+        "seconds_last_message": 30,
+        "notification_target": "#general,{{room.servedBy.username}}",
+        "notification_template": "open {{room.fname}}",
+    }
+    response = tasks.alert_last_message_open_chat(**kwargs)
+    # every page, one message per room and target, a single dm lookup
+    assert response["alerted_rooms"] == ["ROOM0", "ROOM1", "ROOM2"]
+    assert len(posted) == 6
+    assert dm_created == ["agent"]
+
+    posted.clear()
+    response = tasks.alert_last_message_open_chat(digest=True, **kwargs)
+    assert response["rendered_targets"] == ["#general", "agent"]
+    assert [target for target, text in posted] == ["general", "DM-agent"]
+    assert "open visitor 2" in posted[0][1]
+    assert dm_created == ["agent"]
+
+
+def test_split_digest():
+    assert tasks.split_digest(["a" * 3, "b" * 3, "c" * 3], max_length=8) == [
+        "aaa\n\nbbb",
+        "ccc",
+    ]
@@ -2,34 +2,34 @@ import datetime
 import json
 import uuid
 
-import pytz
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.db.models import Count, Max, Q
-from django.db.models.functions import TruncDay
 from django.http import HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render, reverse
+from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
-from envelope.models import LiveChatRoom
+from envelope import redelivery, rooms, stats
+from instance import monitor, ratelimit, registry
 from instance.forms import NewConnectorForm, NewServerForm
 from instance.models import Connector, Server
 
+# undelivered messages shown at a time, at the connector analyze
+UNDELIVERED_PAGE_SIZE = 100
+
 
 @csrf_exempt
 def connector_endpoint(request, connector_id):
-    connector = get_object_or_404(
-        Connector, external_token=connector_id, enabled=True, server__enabled=True
-    )
+    connector = registry.get_connector_or_404(connector_id)
+    if connector.config.get("async_intake"):
+        return connector.intake_async(request)
     return_response = connector.intake(request)
     return return_response
 
 
 @csrf_exempt
 def connector_inbound_endpoint(request, connector_id):
-    connector = get_object_or_404(
-        Connector, external_token=connector_id, enabled=True, server__enabled=True
-    )
+    connector = registry.get_connector_or_404(connector_id)
     return_response = connector.inbound_intake(request)
     if not return_response:
         return HttpResponse("No inbound return.", status=404)
@@ -57,7 +57,7 @@ def must_be_yours(func):
 
 @csrf_exempt
 def server_endpoint(request, server_id):
-    server = get_object_or_404(Server, external_token=server_id, enabled=True)
+    server = registry.get_server_or_404(server_id)
     # unauthorized access
     # if no server.secret_token, allow unprotected access
     if (
@@ -92,17 +92,18 @@ def server_endpoint(request, server_id):
                     "Unauthorized. No X-Rocketchat-Livechat-Token provided.", status=401
                 )
         else:
+            # keep the live monitor up to date
+            monitor.apply_event(server, raw_message)
             # process ingoing message
-            try:
-                room = LiveChatRoom.objects.get(room_id=raw_message["_id"])
-            except LiveChatRoom.DoesNotExist:
+            room = rooms.get_room(raw_message["_id"])
+            if not room:
                 # todo: Alert Admin that there was an attempt to message a non existing room
                 # todo: register this message somehow. RCHAT will try to deliver it a few times
                 # do not answer 404 as rocketchat will keep trying do deliver
                 return HttpResponse("Room Not Found", status=200)
-            except LiveChatRoom.MultipleObjectsReturned:
-                # this situation hangs RocketChat forever
-                room = LiveChatRoom.objects.filter(room_id=raw_message["_id"]).first()
+            cached_connector = registry.get_connector_by_id(room.connector_id)
+            if cached_connector:
+                room.connector = cached_connector
 
             # now, with a room, or at least one of them, let's keep it going
             Connector = room.connector.get_connector_class()
@@ -138,24 +139,13 @@ def server_detail_view(request, server_id):
             server.connectors,
             external_token=request.GET.get("force_connector_delivery"),
         )
-        # TODO: do as task
-        undelivered_messages = connector.messages.filter(delivered=False)
-        for message in undelivered_messages:
-            message.force_delivery()
-            if message.delivered:
-                messages.success(
-                    request,
-                    "Sucess! Message #{} was delivered at connector {}".format(
-                        message.id, message.connector.name
-                    ),
-                )
-            else:
-                messages.error(
-                    request,
-                    "Error! Could not deliver Message #{} at connector {}".format(
-                        message.id, message.connector.name
-                    ),
-                )
+        progress = connector.force_delivery()
+        messages.info(
+            request,
+            "Redelivering {} messages at connector {}. {} already handled".format(
+                progress["total"], connector.name, progress["handled"]
+            ),
+        )
 
         return redirect(reverse("instance:server_detail", args=[server.external_token]))
 
@@ -175,25 +165,14 @@ def server_detail_view(request, server_id):
 
         return redirect(reverse("instance:server_detail", args=[server.external_token]))
 
-    connectors = (
-        server.connectors.distinct()
-        .annotate(
-            undelivered_messages=Count(
-                "messages__id",
-                Q(messages__delivered=False) | Q(messages__delivered=None),
-                distinct=True,
-            ),
-            # total_messages=Count("messages__id", distinct=True),
-            # open_rooms=Count("rooms__id", Q(rooms__open=True), distinct=True),
-            # total_rooms=Count("rooms__id", distinct=True),
-            last_message=Max("messages__created"),
-            # total_visitors=Count("rooms__token", distinct=True),
-        )
-        .order_by("-id")
-    )
+    # the stats are counted only once, then kept up to date
+    for connector in server.connectors.filter(stats__isnull=True):
+        stats.rebuild(connector.id)
+    connectors = server.connectors.select_related("stats").order_by("-id")
     uri = request.build_absolute_uri()
     base_uri = uri.replace(request.get_full_path(), "")
     tasks = server.tasks.order_by("-enabled")
+    dead_intake_events = server.get_dead_intake_events()
     context = {
         "base_uri": base_uri,
         "server": server,
@@ -201,6 +180,8 @@ def server_detail_view(request, server_id):
         "status": status,
         "room_sync": room_sync,
         "tasks": tasks,
+        "dead_intake_events": dead_intake_events[:20],
+        "dead_intake_events_total": dead_intake_events.count(),
     }
     return render(request, "instance/server_detail_view.html", context)
 
@@ -218,6 +199,7 @@ def connector_analyze(request, server_id, connector_id):
     connector_action_response = {}
     connector_action_response["status_session"] = connector.status_session()
     undelivered_messages = None
+    next_after = None
     date = None
     room_sync = None
 
@@ -234,16 +216,29 @@ def connector_analyze(request, server_id, connector_id):
     if request.GET.get("date") or request.GET.get("action") or request.GET.get("id"):
         # select messages to action
         if request.GET.get("date"):
-            date = datetime.datetime.strptime(request.GET.get("date"), "%Y-%m-%d")
-            undelivered_messages = connector.messages.filter(
-                created__date=date, delivered=False
-            )
+            date = datetime.datetime.strptime(
+                request.GET.get("date"), "%Y-%m-%d"
+            ).date()
+            undelivered_messages = stats.get_undelivered_messages(connector.id, date)
         if request.GET.get("id"):
             undelivered_messages = connector.messages.filter(
                 id=request.GET.get("id"), delivered=False
             )
         # act on messages
-        if request.GET.get("action") == "force_delivery":
+        if (
+            request.GET.get("action") == "force_delivery"
+            and date
+            and not request.GET.get("id")
+        ):
+            # a whole day goes to the workers
+            progress = connector.force_delivery(date=date)
+            messages.info(
+                request,
+                "Redelivering {} messages of {:%Y-%m-%d}. {} already handled".format(
+                    progress["total"], date, progress["handled"]
+                ),
+            )
+        elif request.GET.get("action") == "force_delivery":
             for message in undelivered_messages:
                 delivery_happened = message.force_delivery()
                 if delivery_happened:
@@ -261,13 +256,26 @@ def connector_analyze(request, server_id, connector_id):
                         ),
                     )
         if request.GET.get("action") == "mark_as_delivered":
-            undelivered_messages.update(delivered=True)
-            for um in undelivered_messages:
-                messages.success(request, f"Message #{um.id} marked as delivered")
+            first_message = undelivered_messages.first()
+            marked = undelivered_messages.update(delivered=True)
+            # the update skips the signals
+            stats.add(connector.id, undelivered_messages=-marked)
+            if first_message:
+                stats.count_undelivered_day(
+                    connector.id, date or timezone.localdate(first_message.created)
+                )
+            messages.success(request, f"{marked} messages marked as delivered")
         if request.GET.get("action") == "show":
-            # we want to show the messages, so just pass
-            # as the other actions will redirect
-            pass
+            # we want to show the messages, a page at a time
+            after = int(request.GET.get("after") or 0)
+            undelivered_messages = list(
+                undelivered_messages.filter(id__gt=after)
+                .select_related("room", "connector__server")
+                .order_by("id")[: UNDELIVERED_PAGE_SIZE + 1]
+            )
+            if len(undelivered_messages) > UNDELIVERED_PAGE_SIZE:
+                undelivered_messages = undelivered_messages[:UNDELIVERED_PAGE_SIZE]
+                next_after = undelivered_messages[-1].id
         else:
             return redirect(
                 reverse(
@@ -283,14 +291,7 @@ def connector_analyze(request, server_id, connector_id):
             messages.success(request, "Sync Executed!")
             room_sync = connector.room_sync()
 
-    messages_undelivered_by_date = (
-        connector.messages.filter(delivered=False)
-        .annotate(date=TruncDay("created"))
-        .values("date")
-        .annotate(created_count=Count("id"))
-        .annotate(room_count=Count("room__room_id", distinct=True))
-        .order_by("-date")
-    )
+    messages_undelivered_by_date = stats.refresh_undelivered_days(connector.id)
 
     # get form
     config_form = connector.get_connector_config_form()
@@ -309,8 +310,11 @@ def connector_analyze(request, server_id, connector_id):
         "connector": connector,
         "messages_undelivered_by_date": messages_undelivered_by_date,
         "undelivered_messages": undelivered_messages,
+        "next_after": next_after,
         "date": date,
         "room_sync": room_sync,
+        "outbound": ratelimit.get_queue_depth(connector.id),
+        "redelivery": redelivery.get_progress(connector.id),
         "connector_action_response": connector_action_response,
         "config_form": config_form,
         "base_uri": base_uri,
@@ -401,17 +405,7 @@ def new_server(request):
 def server_monitor_view(request, server_id):
     server = get_object_or_404(Server.objects, external_token=server_id)
     order = request.GET.get("order", "agent")
-    if order == "agent":
-        open_rooms = server.get_open_rooms(sort='{"servedBy.username": 1, "lm": 1}')
-    else:
-        open_rooms = server.get_open_rooms(sort='{"department.name": 1, "lm": 1}')
-    # enhance open_rooms dates
-    if open_rooms:
-        open_rooms = open_rooms["rooms"]
-        for idx, room in enumerate(open_rooms):
-            lm = datetime.datetime.strptime(room["lm"], "%Y-%m-%dT%H:%M:%S.%fZ")
-            ts = datetime.datetime.strptime(room["ts"], "%Y-%m-%dT%H:%M:%S.%fZ")
-            open_rooms[idx]["lm_datetime"] = pytz.utc.localize(lm)
-            open_rooms[idx]["ts_datetime"] = pytz.utc.localize(ts)
+    # the shared snapshot, kept up to date by the webhooks
+    open_rooms = monitor.get_open_rooms(server, order)
     context = {"server": server, "open_rooms": open_rooms, "order": order}
     return render(request, "instance/server_monitor.html", context)
@@ -5,7 +5,6 @@ import mimetypes
 import random
 import string
 import tempfile
-import time
 from io import BytesIO
 
 import qrcode
@@ -13,14 +12,48 @@ import requests
 import zbarlight
 from django import forms
 from django.conf import settings
-from django.db import IntegrityError
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
 from django.http import JsonResponse
 from django.template import Context, Template
-from envelope.models import LiveChatRoom
+from envelope import media, rooms
+from envelope.models import DeliveryAttempt, LiveChatRoom, Message, ProviderMessage
+from instance import ratelimit
+from instance.clients import session_manager
 from PIL import Image
+from requests_toolbelt import MultipartEncoder
 
 from emojipy import emojipy
 
+# files are relayed in chunks of this size
+STREAM_CHUNK_SIZE = 64 * 1024
+# files without a known size are kept in memory up to this size
+STREAM_SPOOL_SIZE = 5 * 1024 * 1024
+# pending ack receipts, and the task that applies them, last this long
+ACK_RECEIPT_TIMEOUT = 60 * 60 * 24
+
+
+class StreamedFile:
+    """
+    file-like wrapper of a streamed download with a known size,
+    so the multipart encoder can read it in chunks
+    """
+
+    def __init__(self, raw, size):
+        self.raw = raw
+        self.len = size
+
+    def read(self, size=-1):
+        chunk = self.raw.read(size if size and size > 0 else None)
+        if not chunk:
+            # the download ended before the announced size
+            self.len = 0
+        self.len = max(self.len - len(chunk), 0)
+        return chunk
+
+    def close(self):
+        self.raw.close()
+
 
 class Connector:
     def __init__(self, connector, message, type, request=None):
@@ -41,6 +74,8 @@ class Connector:
         self.message_object = None
         self.rocket = None
         self.room = None
+        # set by the worker that delivers the deferred messages of a room
+        self.outbound_slot_taken = False
         self.logger = logging.getLogger("teste")
 
     def status_session(self):
@@ -71,6 +106,29 @@ class Connector:
             }
         )
 
+    def must_intake_inline(self):
+        """
+        this method tells if the incoming event must be processed
+        while the webhook request waits, even if the asynchronous intake is active.
+        verification challenges (GET requests) and empty payloads are always inline
+        """
+        if self.request and self.request.method != "POST":
+            return True
+        return not self.message
+
+    def get_intake_lane(self):
+        """
+        the intake lane of the incoming event, for the asynchronous intake.
+        events of the same lane are processed one at a time, in arrival order.
+        events without a visitor have no lane
+        """
+        try:
+            if self.get_visitor_id() in ["", "None"]:
+                return None
+            return self.get_visitor_token()
+        except Exception:
+            return None
+
     def outcome_qrbase64(self, qrbase64):
         """
         this method will send the qrbase64 image to the connector managers at RocketChat
@@ -130,77 +188,123 @@ class Connector:
                     )
 
     def outcome_file(self, base64_data, room_id, mime, filename=None, description=None):
+        """
+        upload a base64 encoded file to the room
+        """
+        filedata = base64.b64decode(base64_data)
+        return self.outcome_file_stream(
+            BytesIO(filedata), room_id, mime, filename=filename, description=description
+        )
+
+    def outcome_media(self, body, room_id, mime, filename=None, description=None):
+        """
+        upload a file received with a message to the room. the body
+        may be base64 encoded or a reference to the media store
+        """
+        if not media.is_reference(body):
+            return self.outcome_file(
+                body, room_id, mime, filename=filename, description=description
+            )
+        with media.open_media(body) as stream:
+            return self.outcome_file_stream(
+                stream, room_id, mime, filename=filename, description=description
+            )
+
+    def outcome_file_from_url(
+        self, url, room_id, mime=None, filename=None, description=None, session=None
+    ):
+        """
+        relay a file from the provider straight to the room, streaming
+        the download into the upload with bounded memory
+        """
+        if not session:
+            session = requests
+        download = session.get(url, stream=True, timeout=(10, 60))
+        download.raise_for_status()
+        if not mime:
+            mime = download.headers.get("Content-Type")
+        size = download.headers.get("Content-Length")
+        encoding = download.headers.get("Content-Encoding", "identity")
+        if size and encoding == "identity":
+            stream = StreamedFile(download.raw, int(size))
+        else:
+            # unknown size, spool it: memory for small files, disk for large ones
+            stream = tempfile.SpooledTemporaryFile(max_size=STREAM_SPOOL_SIZE)
+            for chunk in download.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                stream.write(chunk)
+            stream.seek(0)
+        try:
+            return self.outcome_file_stream(
+                stream, room_id, mime, filename=filename, description=description
+            )
+        finally:
+            download.close()
+            stream.close()
+
+    def outcome_file_stream(
+        self, stream, room_id, mime, filename=None, description=None
+    ):
+        """
+        upload a file-like object to the room, as a streamed multipart request
+        """
         if settings.DEBUG:
             print("OUTCOMING FILE TO ROCKETCHAT")
-        # prepare payload
-        filedata = base64.b64decode(base64_data)
-        extension = mimetypes.guess_extension(mime)
         if not filename:
             # random filename
             filename = "".join(
                 random.choices(string.ascii_letters + string.digits, k=16)
             )
-        # write file to temp file
-        # TODO: maybe dont touch the hard drive, keep it buffer
-        with tempfile.NamedTemporaryFile(suffix=extension) as tmp:
-            tmp.write(filedata)
-            headers = {"x-visitor-token": self.get_visitor_token()}
-            # TODO: open an issue to be able to change the ID of the uploaded file like a message allows
-            files = {"file": (filename, open(tmp.name, "rb"), mime)}
-            data = {}
+            if mime:
+                filename = filename + (mimetypes.guess_extension(mime) or "")
+        headers = {"x-visitor-token": self.get_visitor_token()}
+        # TODO: open an issue to be able to change the ID of the uploaded file like a message allows
+        fields = {"file": (filename, stream, mime)}
+        if description:
+            fields["description"] = description
+        multipart = MultipartEncoder(fields=fields)
+        headers["Content-Type"] = multipart.content_type
+        url = "{}/api/v1/livechat/upload/{}".format(self.connector.server.url, room_id)
+        deliver = requests.post(url, headers=headers, data=multipart)
+        self.logger_info(f"RESPONSE OF FILE OUTCOME: {deliver.json()}")
+        if settings.DEBUG and deliver.ok:
+            print("teste, ", deliver)
+            print("OUTCOME FILE RESPONSE: ", deliver.json())
+        # failed uploads are registered too
+        self.register_delivery_attempt(
+            "outcome", {"data": "sent attached file to rocketchat"}, deliver
+        )
+
+        if self.connector.config.get(
+            "outcome_attachment_description_as_new_message", True
+        ):
             if description:
-                data["description"] = description
-            url = "{}/api/v1/livechat/upload/{}".format(
-                self.connector.server.url, room_id
-            )
-            deliver = requests.post(url, headers=headers, files=files, data=data)
-            self.logger_info(f"RESPONSE OF FILE OUTCOME: {deliver.json()}")
-            timestamp = int(time.time())
-            if self.message_object:
-                self.message_object.payload[timestamp] = {
-                    "data": "sent attached file to rocketchat"
-                }
-            if deliver.ok:
-                if settings.DEBUG and deliver.ok:
-                    print("teste, ", deliver)
-                    print("OUTCOME FILE RESPONSE: ", deliver.json())
-                self.message_object.response[timestamp] = deliver.json()
-                self.message_object.delivered = deliver.ok
-                self.message_object.save()
-
-            if self.connector.config.get(
-                "outcome_attachment_description_as_new_message", True
-            ):
-                if description:
-                    description_message_id = self.get_message_id() + "_description"
-                    self.outcome_text(
-                        room_id, description, message_id=description_message_id
-                    )
+                description_message_id = self.get_message_id() + "_description"
+                self.outcome_text(
+                    room_id,
+                    description,
+                    message_id=description_message_id,
+                    primary=False,
+                )
 
-            return deliver
+        return deliver
 
-    def outcome_text(self, room_id, text, message_id=None):
+    def outcome_text(self, room_id, text, message_id=None, primary=True):
         deliver = self.room_send_text(room_id, text, message_id)
-        timestamp = int(time.time())
-        if self.message_object:
-            self.message_object.payload[timestamp] = json.loads(deliver.request.body)
-            self.message_object.response[timestamp] = deliver.json()
+        payload = json.loads(deliver.request.body)
         if settings.DEBUG:
             self.logger_info(f"DELIVERING... {deliver.request.body}")
             self.logger_info(f"RESPONSE... {deliver.json()}")
         if deliver.ok:
             if settings.DEBUG:
                 self.logger_info(f"MESSAGE DELIVERED... {deliver.request.body}")
-            if self.message_object:
-                self.message_object.delivered = True
-                self.message_object.room = self.room
-                self.message_object.save()
+            self.register_delivery_attempt(
+                "outcome", payload, deliver, primary=primary, room=self.room
+            )
             return deliver
         else:
             self.logger_info("MESSAGE *NOT* DELIVERED...")
-            # save payload and save message object
-            if self.message_object:
-                self.message_object.save()
+            # register the failed attempt
+            self.register_delivery_attempt("outcome", payload, deliver, primary=primary)
             # room can be closed on RC and open here
             r = deliver.json()
             # TODO: when sending a message already sent, rocket doesnt return a identifiable message
@@ -388,7 +492,6 @@ class Connector:
         check_if_open=False,
         force_transfer=None,
     ):
-        open_rooms = None
         room = None
         room_created = False
         connector_token = self.get_visitor_token()
@@ -400,15 +503,11 @@ class Connector:
                 return room
 
         try:
-            room = LiveChatRoom.objects.get(
-                connector=self.connector, token=connector_token, open=True
-            )
+            room = rooms.get_open_room(self.connector, connector_token)
             self.logger_info(f"get_room, got {room}")
             if check_if_open:
                 self.logger_info("checking if room is open")
-                open_rooms = self.rocket.livechat_rooms(open="true").json()
-                open_rooms_id = [r["_id"] for r in open_rooms["rooms"]]
-                if room.room_id not in open_rooms_id:
+                if not self.is_room_open_in_rocketchat(room.room_id):
                     self.logger_info(
                         "room was open in Rocket.Connect, but not in Rocket.Chat"
                     )
@@ -449,13 +548,22 @@ class Connector:
                         if settings.DEBUG:
                             print("REGISTERING ROOM, ", rc_room_response)
                         if rc_room_response["success"]:
-                            room = LiveChatRoom.objects.create(
-                                connector=self.connector,
-                                token=connector_token,
-                                room_id=rc_room_response["room"]["_id"],
-                                open=True,
-                            )
-                            room_created = True
+                            try:
+                                with transaction.atomic():
+                                    room = LiveChatRoom.objects.create(
+                                        connector=self.connector,
+                                        token=connector_token,
+                                        room_id=rc_room_response["room"]["_id"],
+                                        open=True,
+                                    )
+                                room_created = True
+                            except IntegrityError:
+                                # a concurrent message already registered the open room
+                                room = LiveChatRoom.objects.get(
+                                    connector=self.connector,
+                                    token=connector_token,
+                                    open=True,
+                                )
                         else:
                             if rc_room_response["errorType"] == "no-agent-online":
                                 self.logger_info("NO AGENTS ONLINE")
@@ -553,6 +661,7 @@ class Connector:
                                 self.config.get("welcome_vcard")
                             ),
                             message_id=self.get_message_id() + "VCARD",
+                            primary=False,
                         )
         # save message obj
         if self.message_object:
@@ -561,6 +670,25 @@ class Connector:
 
         return room
 
+    def handle_livechat_session_closed(self):
+        """
+        the room was closed in Rocket.Chat
+        """
+        room_id = self.message.get("_id")
+        rooms.close_rooms(self.connector.rooms.filter(room_id=room_id))
+        rooms.set_room_state(room_id, False)
+
+    def is_room_open_in_rocketchat(self, room_id):
+        """
+        check the room state in Rocket.Chat, cached for a few seconds
+        """
+        state = self.connector.server.get_room_state(room_id)
+        if state is None:
+            # do not close the room when Rocket.Chat can not tell
+            self.logger_error(f"COULD NOT GET ROOM STATE: {room_id}")
+            return True
+        return state
+
     def room_close_and_reintake(self, room):
         if settings.DEBUG:
             print("ROOM IS CLOSED. CLOSING AND REINTAKING")
@@ -594,6 +722,7 @@ class Connector:
             self.message_object, created = self.connector.messages.get_or_create(
                 envelope_id=self.get_message_id(), type=type
             )
+            self.extract_media(self.message)
             self.message_object.raw_message = self.message
             if not self.message_object.room:
                 self.message_object.room = self.room
@@ -611,6 +740,146 @@ class Connector:
             )
             return "", False
 
+    def extract_media(self, message):
+        """
+        move the files embedded in the message to the media store,
+        leaving a reference in their place. return True if any was moved
+        """
+        return False
+
+    def register_delivery_attempt(
+        self,
+        direction,
+        payload=None,
+        sent=None,
+        delivered=None,
+        primary=True,
+        **changes,
+    ):
+        """
+        append a delivery attempt of the message being processed.
+        the message row is only updated with its final state: the
+        delivered flag and the given changes (eg. room). Only the
+        primary attempts, not the follow ups (eg. the description of a
+        file, an alert to the agent), mark the message as delivered,
+        and a delivered message is never marked back as undelivered
+        """
+        if not self.message_object:
+            return None
+        status_code = None
+        response = sent
+        if isinstance(sent, requests.Response):
+            status_code = sent.status_code
+            if delivered is None:
+                delivered = sent.ok
+            try:
+                response = sent.json()
+            except ValueError:
+                response = {"content": sent.text}
+        attempt = DeliveryAttempt.objects.create(
+            message=self.message_object,
+            direction=direction,
+            delivered=bool(delivered),
+            status_code=status_code,
+            payload=DeliveryAttempt.summarize(payload),
+            response=DeliveryAttempt.summarize(response),
+        )
+        if self.message_object.type == "incoming" and direction == "outgo":
+            # the automated answers to an incoming message
+            primary = False
+        if primary and delivered and not self.message_object.delivered:
+            changes["delivered"] = True
+        if changes:
+            for field, value in changes.items():
+                setattr(self.message_object, field, value)
+            self.message_object.save(update_fields=[*changes, "updated"])
+        return attempt
+
+    def register_provider_message_id(self, provider_message_id):
+        """
+        keep the id the provider gave to the message sent out,
+        so ack receipts can find it
+        """
+        if self.message_object and provider_message_id:
+            ProviderMessage.objects.get_or_create(
+                connector=self.connector,
+                provider_message_id=provider_message_id,
+                defaults={
+                    "message": self.message_object,
+                    "room": self.message_object.room or self.room,
+                },
+            )
+
+    def get_messages_by_provider_message_id(self, provider_message_id):
+        """
+        the messages sent out with this provider id
+        """
+        return Message.objects.filter(
+            provider_messages__connector=self.connector,
+            provider_messages__provider_message_id=provider_message_id,
+        ).select_related("room")
+
+    def register_ack_receipt(self, message, level):
+        """
+        keep the ack level (1 sent, 2 received, 3 read, 4 played) of a message sent out,
+        and schedule a single update at Rocket.Chat for the whole burst of acks
+        """
+        from instance import tasks
+
+        if not level or level < 1:
+            return False
+        window = self.config.get("ack_receipt_window")
+        if window is None:
+            window = 3
+        # the level waits as long as the task may wait in a busy queue
+        cache.set(
+            f"ack_receipt:{message.id}:{level}", True, timeout=ACK_RECEIPT_TIMEOUT
+        )
+        if not window:
+            return self.apply_ack_receipt(message)
+        if cache.add(f"ack_receipt_scheduled:{message.id}", True, timeout=window):
+            # queued once the request commits, so the worker reads what it wrote
+            transaction.on_commit(
+                lambda: tasks.apply_ack_receipt.apply_async(
+                    args=[message.id], countdown=window, expires=ACK_RECEIPT_TIMEOUT
+                )
+            )
+        return True
+
+    def apply_ack_receipt(self, message):
+        """
+        mark the message at Rocket.Chat with the highest ack level received
+        """
+        levels = cache.get_many([f"ack_receipt:{message.id}:{i}" for i in [1, 2, 3, 4]])
+        if not levels:
+            return False
+        level = max(int(key.split(":")[-1]) for key in levels.keys())
+        applied_key = f"ack_receipt_applied:{message.id}"
+        if level <= (cache.get(applied_key) or 0):
+            return False
+        body = message.get_outgoing_text()
+        self.get_rocket_client()
+        if body is None:
+            original_message = self.rocket.chat_get_message(msg_id=message.envelope_id)
+            body = original_message.json()["message"]["msg"]
+            # remove previous markers
+            body = body.replace(":ballot_box_with_check:", "")
+            body = body.replace(":white_check_mark:", "")
+        if level == 1:
+            mark = ":ballot_box_with_check:"
+        else:
+            mark = ":white_check_mark:"
+        update_response = self.rocket.chat_update(
+            room_id=message.room.room_id,
+            msg_id=message.envelope_id,
+            text=f"{mark} {body.strip()}",
+        )
+        self.logger_info(f"ACK RECEIPT UPDATE RESPONSE {update_response}")
+        cache.set(applied_key, level, timeout=ACK_RECEIPT_TIMEOUT)
+        message.ack = True
+        message.save(update_fields=["ack"])
+        return update_response.ok
+
     def get_message_id(self):
         if self.type == "incoming":
             return self.get_incoming_message_id()
@@ -658,6 +927,43 @@ class Connector:
                 self.rocket = False
         return self.rocket
 
+    def validate_numbers(self, numbers):
+        """
+        tell which numbers can receive active messages, by number.
+        None when it could not be checked
+        """
+        return {number: True for number in numbers}
+
+    def send_active_message(self, number, text, department=None, message_id=None):
+        """
+        open a room with the number and send the text to it.
+        return a dict with success, message and the room
+        """
+        return {"success": False, "message": "ACTIVE MESSAGES NOT SUPPORTED"}
+
+    def get_request_headers(self):
+        """
+        headers sent with every request to the provider
+        """
+        return {"content-type": "application/json"}
+
+    def refresh_request_token(self):
+        """
+        renew the provider token after a 401, returning the new headers,
+        or None if it can not be renewed
+        """
+        return None
+
+    def get_request_session(self):
+        """
+        a session over the pooled connections to the provider
+        """
+        return session_manager.get_session(
+            self.connector.id,
+            headers=self.get_request_headers(),
+            refresh_token=self.refresh_request_token,
+        )
+
     def outgo_message_from_rocketchat(self, payload):
         self.get_rocket_client(bot=True, force=True)
         return self.rocket.chat_send_message(payload)
@@ -671,26 +977,31 @@ class Connector:
 
     # API METHODS
     def decrypt_media(self, message_id=None):
+        """
+        download a media file, decrypted. The API answers with the file as a
+        base64 data url inside a JSON, which is decoded while it is received,
+        so the whole file is never in memory. return the file, or None
+        """
         if not message_id:
             message_id = self.get_message_id()
         url_decrypt = "{}/decryptMedia".format(self.config["endpoint"])
         payload = {"args": {"message": message_id}}
         s = self.get_request_session()
-        decrypted_data_request = s.post(url_decrypt, json=payload)
-        # get decrypted data
-        data = None
-        if decrypted_data_request.ok:
-            response = decrypted_data_request.json().get("response", None)
-            if settings.DEBUG:
-                print("DECRYPTED DATA: ", response)
-            if response:
-                data = response.split(",")[1]
-        return data
+        decrypted_data_request = s.post(url_decrypt, json=payload, stream=True)
+        try:
+            if not decrypted_data_request.ok:
+                return None
+            return media.decode_data_url(
+                decrypted_data_request.iter_content(chunk_size=STREAM_CHUNK_SIZE),
+                spool_size=STREAM_SPOOL_SIZE,
+            )
+        finally:
+            decrypted_data_request.close()
 
     def close_room(self):
         if self.room:
             # close all room from connector with same room_id
-            self.connector.rooms.filter(room_id=self.room.room_id).update(open=False)
+            rooms.close_rooms(self.connector.rooms.filter(room_id=self.room.room_id))
             self.post_close_room()
 
     def post_close_room(self):
@@ -718,6 +1029,14 @@ class Connector:
             # if the Chat Close Hook is On
             if settings.DEBUG:
                 print("LivechatSession")
+            self.handle_livechat_session_closed()
+        if self.message.get("type") in [
+            "LivechatSessionTaken",
+            "LivechatSessionForwarded",
+            "LivechatSessionQueued",
+        ]:
+            # the room is open in Rocket.Chat
+            rooms.set_room_state(self.message.get("_id"), True)
         if self.message.get("type") == "LivechatSessionTaken":
             #
             # This message is sent when the message if taken
@@ -741,6 +1060,10 @@ class Connector:
                 "ignore_token_force_close_message", ""
             ).split(",")
             if not message.delivered:
+                # respect the connector outbound rate
+                if not self.outbound_slot_taken and not self.acquire_outgoing_slot():
+                    self.defer_ingoing()
+                    return
                 # prepare message to be sent to client
                 for message in self.message.get("messages", []):
                     agent_name = self.get_agent_name(message)
@@ -775,6 +1098,62 @@ class Connector:
             else:
                 self.logger_info("MESSAGE ALREADY SENT. IGNORING.")
 
+    def get_outgoing_room_id(self):
+        if self.room:
+            return self.room.room_id
+        # the ingoing webhooks are sent with the room id
+        return self.message.get("_id")
+
+    def acquire_outgoing_slot(self, wait=False):
+        """
+        take a slot of the connector outbound rate, if configured.
+        closing messages and the bot messages (eg. campaigns) are bulk sends.
+        The webhooks do not wait, and a room with deferred messages has no
+        slot until they are sent. Only the workers wait for it
+        """
+        rate = self.config.get("outbound_messages_per_second")
+        if not rate:
+            return True
+        messages = self.message.get("messages", [])
+        bulk = any(
+            m.get("closingMessage")
+            or m.get("u", {}).get("username") == self.connector.server.bot_user
+            for m in messages
+        )
+        room_id = self.get_outgoing_room_id()
+        if wait:
+            return ratelimit.acquire(
+                self.connector.id,
+                rate,
+                room_id=room_id,
+                bulk=bulk,
+                timeout=settings.OUTBOUND_MAX_WAIT,
+            )
+        if ratelimit.has_deferred(self.connector.id, room_id):
+            return False
+        return ratelimit.try_acquire(
+            self.connector.id, rate, room_id=room_id, bulk=bulk
+        )
+
+    def defer_ingoing(self):
+        """
+        leave the message to the workers, to be sent when there is a slot
+        """
+        from instance import tasks
+
+        self.logger_info("OUTBOUND RATE REACHED. DEFERRING MESSAGE")
+        if ratelimit.defer(
+            self.connector.id, self.get_outgoing_room_id(), self.message_object.id
+        ):
+            # the first deferred message of the room starts its delivery,
+            # once the request commits, so the worker can read the message
+            message_id = self.message_object.id
+            transaction.on_commit(
+                lambda: tasks.deliver_message.apply_async(
+                    args=[message_id], countdown=1
+                )
+            )
+
     def get_agent_name(self, message):
         agent_name = message.get("u", {}).get("name", {})
         agent_username = message.get("u", {}).get("username", {})
@@ -842,6 +1221,7 @@ class Connector:
                 self.outcome_text(
                     self.room.room_id,
                     text=self.config.get("convert_incoming_audio_to_text"),
+                    primary=False,
                 )
 
     def handle_livechat_session_queued(self):
@@ -875,10 +1255,10 @@ class Connector:
                     }
             self.get_rocket_client()
             # enrich context with department data
-            department = self.rocket.call_api_get(
-                "livechat/department/{}".format(self.message.get("departmentId"))
-            ).json()
-            self.message["department"] = department["department"]
+            self.message["department"] = (
+                self.connector.server.get_department(self.message.get("departmentId"))
+                or {}
+            )
             template = Template(self.config.get("session_taken_alert_template"))
             context = Context(self.message)
             message = template.render(context)
@@ -892,6 +1272,7 @@ class Connector:
                     self.room.room_id,
                     f"MESSAGE SENT: {message}",
                     message_id=self.get_message_id() + "SESSION_TAKEN",
+                    primary=False,
                 )
             outgo_text_obj = self.outgo_text_message(message_payload)
             self.logger_info(f"HANDLING LIVECHATSESSION TAKEN {outgo_text_obj}")
@@ -919,10 +1300,14 @@ class BaseConnectorConfigForm(forms.Form):
 
     def save(self):
         for field in self.cleaned_data.keys():
-            if self.cleaned_data[field]:
-                self.connector.config[field] = self.cleaned_data[field]
+            value = self.cleaned_data[field]
+            # 0 is a setting of its own for the integer fields
+            if value or (
+                value == 0 and isinstance(self.fields[field], forms.IntegerField)
+            ):
+                self.connector.config[field] = value
             else:
-                if self.connector.config.get(field):
+                if field in self.connector.config:
                     # if is a boolean field, mark as false
                     # else, delete
                     if type(self.fields[field]) == forms.fields.BooleanField:
@@ -964,6 +1349,33 @@ class BaseConnectorConfigForm(forms.Form):
         required=False,
         help_text="do not overwrite visitor name with connector visitor name",
     )
+    async_intake = forms.BooleanField(
+        required=False,
+        help_text="Persist the incoming payload and answer right away, "
+        + "leaving the processing to the intake workers",
+    )
+    outbound_messages_per_second = forms.IntegerField(
+        required=False,
+        min_value=1,
+        help_text="Max messages sent to the provider per second, shared by all workers. "
+        + "Empty for no limit",
+    )
+    campaign_concurrency = forms.IntegerField(
+        required=False,
+        min_value=1,
+        help_text="Campaign messages sent at the same time. Default: 3",
+    )
+    campaign_messages_per_minute = forms.IntegerField(
+        required=False,
+        min_value=1,
+        help_text="Campaign messages sent per minute. Default: 20",
+    )
+    ack_receipt_window = forms.IntegerField(
+        required=False,
+        min_value=0,
+        help_text="Seconds to wait for more ack receipts of a message "
+        + "before updating it at Rocket.Chat. Default: 3. 0 to update on each ack",
+    )
     include_connector_status = forms.BooleanField(
         required=False,
         help_text="Includes connector status in the status payload. Disable for better performance",
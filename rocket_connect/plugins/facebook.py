@@ -1,6 +1,4 @@
-import base64
 import json
-import time
 
 import requests
 from django import forms
@@ -85,10 +83,7 @@ class Connector(ConnectorBase):
                             deliver = self.outcome_text(room.room_id, text)
                         else:
                             url = attachment["payload"]["url"]
-                            r = requests.get(url)
-                            base = base64.b64encode(r.content)
-                            mime = r.headers["Content-Type"]
-                            self.outcome_file(base, room.room_id, mime)
+                            self.outcome_file_from_url(url, room.room_id)
                     if webhook_event["message"].get("text"):
                         deliver = self.outcome_text(
                             room.room_id, webhook_event["message"].get("text")
@@ -179,12 +174,7 @@ class Connector(ConnectorBase):
         payload = {"recipient": {"id": visitor_id}, "message": {"text": content}}
         sent = requests.post(url=url, json=payload)
         # register outcome
-        timestamp = int(time.time())
-        if sent.ok and self.message_object:
-            self.message_object.delivered = True
-        self.message_object.payload[timestamp] = payload
-        self.message_object.response[timestamp] = sent.json()
-        self.message_object.save()
+        self.register_delivery_attempt("outgo", payload, sent)
 
     def outgo_file_message(self, message, agent_name):
         visitor_id = self.get_visitor_id()
@@ -230,11 +220,8 @@ class Connector(ConnectorBase):
         payload["filedata"] = "FILE ATTACHED"
         if settings.DEBUG:
             print("PAYLOAD OUTGING FILE: ", payload)
-        timestamp = int(time.time())
-        self.message_object.payload[timestamp] = payload
+        self.register_delivery_attempt("outgo", payload, sent)
         if sent.ok:
-            self.message_object.delivered = True
-            self.message_object.response[timestamp] = sent.json()
             if message["attachments"][0].get("description"):
                 formatted_message = {
                     "u": {"name": message["u"]["name"]},
@@ -242,7 +229,6 @@ class Connector(ConnectorBase):
                 }
                 agent_name = self.get_agent_name(message)
                 self.outgo_text_message(formatted_message, agent_name)
-        self.message_object.save()
 
     def change_agent_name(self, agent_name):
         """
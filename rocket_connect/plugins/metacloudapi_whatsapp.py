@@ -1,11 +1,7 @@
-import base64
 import json
-import time
 import urllib.parse as urlparse
 
-import requests
 from django import forms
-from django.db import models
 from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 
 from .base import BaseConnectorConfigForm
@@ -13,6 +9,8 @@ from .base import Connector as ConnectorBase
 
 
 class Connector(ConnectorBase):
+    # status receipts to ack levels
+    ACK_LEVELS = {"sent": 1, "delivered": 2, "read": 3}
 
     # main incoming hub
     def incoming(self):
@@ -57,41 +55,31 @@ class Connector(ConnectorBase):
                             "enable_ack_receipt", True
                         ):
                             # handle read receipt
-                            # get the message id and body
+                            # get the message id
                             for status in change["value"]["statuses"]:
                                 self.logger_info(f"ACK RECEIPT {status}")
                                 msg_id = status["id"]
                                 status = status["status"]
-                                messages_to_search = self.connector.messages.filter(
-                                    models.Q(response__id__contains=msg_id)
-                                    | models.Q(
-                                        response__messages__contains=[{"id": msg_id}]
-                                    )
+                                messages_to_search = (
+                                    self.get_messages_by_provider_message_id(msg_id)
                                 )
-                                print("FOUND: ", messages_to_search)
                                 for message in messages_to_search:
-                                    original_message = self.rocket.chat_get_message(
-                                        msg_id=message.envelope_id
-                                    )
-                                    body = original_message.json()["message"]["msg"]
-                                    body = body.replace(":ballot_box_with_check:", "")
-                                    body = body.replace(":white_check_mark:", "")
-                                    if status == "sent":
-                                        mark = ":ballot_box_with_check:"
-                                    else:
-                                        mark = ":white_check_mark:"
-                                    payload = {
-                                        "room_id": message.room.room_id,
-                                        "msg_id": message.envelope_id,
-                                        "text": f"{mark} {body}",
-                                    }
-                                    update_response = self.rocket.chat_update(**payload)
-                                    self.logger_info(
-                                        f"ACK RECEIPT UPDATE RESPONSE {update_response}"
+                                    self.register_ack_receipt(
+                                        message, self.ACK_LEVELS.get(status)
                                     )
 
         return JsonResponse({})
 
+    def get_intake_lane(self):
+        # messages and statuses are wrapped inside the entries
+        for entry in self.message.get("entry", []):
+            for change in entry.get("changes", []):
+                for message in change["value"].get("messages", []):
+                    return "whatsapp:" + message["from"] + "@c.us"
+                for status in change["value"].get("statuses", []):
+                    return "whatsapp:" + status["recipient_id"] + "@c.us"
+        return None
+
     def handle_challenge(self):
         self.logger_info(
             "VERIFYING META CLOUD ENDPOINT against with path: "
@@ -190,10 +178,11 @@ class Connector(ConnectorBase):
         if self.message.get("image", {}).get("caption"):
             description = self.message.get("image", {}).get("caption")
 
-        # get media base64
+        # relay the media straight to the room
         media_url = media_info.json().get("url")
-        base64_data = base64.b64encode(session.get(media_url).content)
-        self.outcome_file(base64_data, room.room_id, mime, description)
+        self.outcome_file_from_url(
+            media_url, room.room_id, mime, description=description, session=session
+        )
 
     def get_incoming_message_id(self):
         return self.message.get("id")
@@ -207,13 +196,12 @@ class Connector(ConnectorBase):
     def get_visitor_token(self):
         return "whatsapp:" + self.message["from"] + "@c.us"
 
-    def get_request_session(self):
-        s = requests.Session()
-        s.headers = {"content-type": "application/json"}
+    def get_request_headers(self):
+        headers = {"content-type": "application/json"}
         token = self.connector.config.get("bearer_token")
         if token:
-            s.headers.update({"Authorization": f"Bearer {token}"})
-        return s
+            headers.update({"Authorization": f"Bearer {token}"})
+        return headers
 
     def get_graphql_endpoint(self, method=""):
         return "{}/{}/{}".format(
@@ -255,27 +243,13 @@ class Connector(ConnectorBase):
                 # retry with different number
                 sent = session.post(url, json=payload)
         # we got the message sent!
+        self.register_delivery_attempt("outgo", payload, sent)
         if sent.ok:
-            timestamp = int(time.time())
-            if self.message_object:
-                self.message_object.delivered = sent.ok
-                self.message_object.response[timestamp] = sent.json()
-                if sent.ok:
-                    if not self.message_object.response.get("id"):
-                        self.message_object.response["id"] = [
-                            sent.json()["messages"][0]["id"]
-                        ]
-                    else:
-                        self.message_object.response["id"].append(
-                            sent.json()["messages"][0]["id"]
-                        )
-            self.message_object.save()
+            self.register_provider_message_id(sent.json()["messages"][0]["id"])
             # message not sent
         else:
             self.logger_info(f"ERROR SENDING MESSAGE {sent.json()}")
-            if self.message_object:
-                self.message_object.delivered = False
-                self.logger_info(f"CONNECTOR DOWN: {self.connector}")
+            self.logger_info(f"CONNECTOR DOWN: {self.connector}")
 
         return sent
 
@@ -325,12 +299,10 @@ class Connector(ConnectorBase):
         self.logger_info(
             f"OUTGO file {send_file.json()} with payload {json.dumps(payload)} and mimetype {mime}"
         )
+        self.register_delivery_attempt("outgo", payload, send_file)
         if send_file.ok:
-            timestamp = int(time.time())
-            self.message_object.payload[timestamp] = payload
-            self.message_object.delivered = True
-            self.message_object.response = send_file.json()
-            self.message_object.save()
+            for sent_message in send_file.json().get("messages", []):
+                self.register_provider_message_id(sent_message.get("id"))
             # self.send_seen()
 
     def status_session(self):
@@ -1,5 +1,4 @@
 import json
-import time
 
 import requests
 from django.conf import settings
@@ -25,12 +24,11 @@ class Connector(ConnectorBase):
         self.rocket = None
         self.room = None
 
-    def get_request_session(self):
-        s = requests.Session()
-        s.headers = {"content-type": "application/json"}
+    def get_request_headers(self):
+        headers = {"content-type": "application/json"}
         if self.connector.config.get("api_key"):
-            s.headers.update({"api_key": self.connector.config["api_key"]})
-        return s
+            headers.update({"api_key": self.connector.config["api_key"]})
+        return headers
 
     def incoming(self):
         """
@@ -86,19 +84,13 @@ class Connector(ConnectorBase):
             print("outgo url", url)
         # TODO: self.full_simulate_typing()
         session = self.get_request_session()
-        timestamp = int(time.time())
         try:
             sent = session.post(url, json=payload)
-            self.message_object.delivered = True
-            self.message_object.response[timestamp] = sent.json()
+            self.register_delivery_attempt("outgo", payload, sent, delivered=True)
             if settings.DEBUG:
-                print("SAVING RESPONSE: ", self.message_object.response)
+                print("SAVING RESPONSE: ", sent.json())
             # self.send_seen()
         except requests.ConnectionError:
-            self.message_object.delivered = False
+            self.register_delivery_attempt("outgo", payload, delivered=False)
             if settings.DEBUG:
                 print("CONNECTOR DOWN: ", self.connector)
-        # save message object
-        if self.message_object:
-            self.message_object.payload[timestamp] = payload
-            self.message_object.save()
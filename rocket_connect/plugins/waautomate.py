@@ -72,14 +72,15 @@ class Connector(ConnectorBase):
                         #
                         # if caption, send it too
                         if data:
-                            file_sent = self.outcome_file(
-                                data,
-                                room.room_id,
-                                mime,
-                                description=self.message.get("data", {}).get(
-                                    "caption", None
-                                ),
-                            )
+                            with data:
+                                file_sent = self.outcome_file_stream(
+                                    data,
+                                    room.room_id,
+                                    mime,
+                                    description=self.message.get("data", {}).get(
+                                        "caption", None
+                                    ),
+                                )
                             if file_sent.ok:
                                 self.message_object.delivered = True
                                 self.message_object.save()
@@ -127,7 +128,10 @@ class Connector(ConnectorBase):
                             data = self.decrypt_media()
                             # we  got data
                             if data:
-                                file_sent = self.outcome_file(data, room.room_id, mime)
+                                with data:
+                                    file_sent = self.outcome_file_stream(
+                                        data, room.room_id, mime
+                                    )
                             else:
                                 file_sent = False
                             # if file was sent
@@ -192,9 +196,10 @@ class Connector(ConnectorBase):
                                 # HERE we send the media file
                                 #
                                 if data:
-                                    file_sent = self.outcome_file(
-                                        data, room.room_id, quoted_mime
-                                    )
+                                    with data:
+                                        file_sent = self.outcome_file_stream(
+                                            data, room.room_id, quoted_mime
+                                        )
                                 else:
                                     file_sent = False
                         else:
@@ -329,12 +334,11 @@ class Connector(ConnectorBase):
 
         return JsonResponse({})
 
-    def get_request_session(self):
-        s = requests.Session()
-        s.headers = {"content-type": "application/json"}
+    def get_request_headers(self):
+        headers = {"content-type": "application/json"}
         if self.connector.config.get("api_key"):
-            s.headers.update({"api_key": self.connector.config["api_key"]})
-        return s
+            headers.update({"api_key": self.connector.config["api_key"]})
+        return headers
 
     def send_seen(self, visitor_id=None):
         if not visitor_id:
@@ -401,9 +405,19 @@ class Connector(ConnectorBase):
                 # define the message id.
                 # if its ingoing (from RC to WA), the correct ID will be at the response
                 if quoted_message.type == "ingoing":
-                    quoted_message_id = quoted_message.response[
-                        next(iter(quoted_message.response))
-                    ]["response"]
+                    attempt = quoted_message.delivery_attempts.filter(
+                        direction="outgo", delivered=True
+                    ).first()
+                    if attempt:
+                        quoted_message_id = attempt.response["response"]
+                    elif quoted_message.response:
+                        # stored before the delivery attempts
+                        quoted_message_id = quoted_message.response[
+                            next(iter(quoted_message.response))
+                        ]["response"]
+                    else:
+                        # never sent, the quote is dropped
+                        quoted_message = None
                 else:
                     # otherwise, its the envelope_id
                     quoted_message_id = message_id
@@ -440,20 +454,14 @@ class Connector(ConnectorBase):
         session = self.get_request_session()
 
         self.full_simulate_typing()
-        timestamp = int(time.time())
         try:
             sent = session.post(url, json=payload)
-            self.message_object.delivered = True
-            self.message_object.response[timestamp] = sent.json()
+            self.register_delivery_attempt("outgo", payload, sent, delivered=True)
             self.send_seen()
         except requests.ConnectionError:
-            self.message_object.delivered = False
+            self.register_delivery_attempt("outgo", payload, delivered=False)
             if settings.DEBUG:
                 print("CONNECTOR DOWN: ", self.connector)
-        # save message object
-        if self.message_object:
-            self.message_object.payload[timestamp] = payload
-            self.message_object.save()
 
     def outgo_file_message(self, message, agent_name=None):
         # if its audio, treat different
@@ -491,13 +499,9 @@ class Connector(ConnectorBase):
         self.full_simulate_typing()
         sent = session.post(url, json=payload)
         if sent.ok:
-            timestamp = int(time.time())
             if settings.DEBUG:
                 print("RESPONSE OUTGOING FILE: ", sent.json())
-            self.message_object.payload[timestamp] = payload
-            self.message_object.delivered = True
-            self.message_object.response[timestamp] = sent.json()
-            self.message_object.save()
+            self.register_delivery_attempt("outgo", payload, sent)
             self.send_seen()
 
     def post_close_room(self, visitor_id=None):
@@ -530,10 +534,7 @@ class Connector(ConnectorBase):
                 print("RESPONSE: ", sent.json())
 
             if self.message_object:
-                timestamp = int(time.time())
-                self.message_object.payload[timestamp] = payload
-                self.message_object.response[timestamp] = sent.json()
-                self.message_object.save()
+                self.register_delivery_attempt("outgo", payload, sent, primary=False)
             return sent
 
     def change_agent_name(self, agent_name):
@@ -1,20 +1,29 @@
 import base64
 import datetime
 import json
-import time
 import urllib.parse as urlparse
+from concurrent.futures import ThreadPoolExecutor
 
 import pytz
 import requests
 from django import forms
+from django.apps import apps
 from django.conf import settings
 from django.core import validators
+from django.core.cache import cache
 from django.http import HttpResponse, JsonResponse
 from django.utils import timezone
+from envelope import media
 from instance import tasks
+from instance.clients import session_manager
+from requests_toolbelt import MultipartEncoder
 
-from .base import BaseConnectorConfigForm
+from .base import STREAM_CHUNK_SIZE, BaseConnectorConfigForm
 from .base import Connector as ConnectorBase
+from .base import StreamedFile
+
+# files sent by the agents over this size, in MB, are linked instead
+OUTGO_FILE_MAX_SIZE = 16
 
 
 class Connector(ConnectorBase):
@@ -43,7 +52,8 @@ class Connector(ConnectorBase):
             self.config.get("instance_name"),
             self.config.get("secret_key"),
         )
-        token = requests.post(endpoint)
+        session = session_manager.get_session(self.connector.id)
+        token = session.post(endpoint)
         if token.ok:
             token = token.json()
             self.connector.config["token"] = token
@@ -85,13 +95,11 @@ class Connector(ConnectorBase):
             self.config.get("endpoint"),
             self.config.get("instance_name"),
         )
-        token = self.config.get("token", {}).get("token")
-        if not token:
+        if not self.config.get("token", {}).get("token"):
             self.generate_token()
-            token = self.config.get("token", {}).get("token")
 
-        headers = {"Authorization": "Bearer " + token}
-        status_req = requests.post(endpoint, headers=headers)
+        session = self.get_request_session()
+        status_req = session.post(endpoint)
         if status_req.ok:
             status = status_req.json()
             return status
@@ -204,44 +212,203 @@ class Connector(ConnectorBase):
                     )
         return {"success": True, "message": "\n".join(messages)}
 
-    def check_number_status(self, number):
+    def get_number_cache_key(self, lookup, number):
+        # +55 (31) 9999-9999 and 5531999999999 are the same number
+        normalized = "".join(c for c in str(number).split("@")[0] if c.isdigit())
+        return f"number_{lookup}:{self.connector.id}:{normalized}"
+
+    def cache_number_lookup(self, key, lookup, found):
+        """
+        keep a number lookup for a day if the number was found,
+        and for an hour if not
+        """
+        if found:
+            timeout = settings.NUMBER_CACHE_TIMEOUT
+        else:
+            timeout = settings.NUMBER_CACHE_NEGATIVE_TIMEOUT
+        cache.set(key, lookup, timeout=timeout)
+
+    def check_number_status(self, number, refresh=False):
+        key = self.get_number_cache_key("status", number)
+        if not refresh:
+            status = cache.get(key)
+            if status:
+                return status
+
         endpoint = "{}/api/{}/check-number-status/{}".format(
             self.config.get("endpoint"), self.config.get("instance_name"), number
         )
 
-        token = self.config.get("token", {}).get("token")
-
-        if not token:
+        if not self.config.get("token", {}).get("token"):
             self.generate_token()
-            token = self.config.get("token", {}).get("token")
 
-        headers = {"Authorization": "Bearer " + token}
         data = {"webhook": self.config.get("webhook")}
         try:
-            start_session_req = requests.get(endpoint, headers=headers, json=data)
-            self.logger.info(f"CHECKING NUMBER: {number}: {start_session_req.json()}")
-            return start_session_req.json()
+            session = self.get_request_session()
+            start_session_req = session.get(endpoint, json=data)
+            status = start_session_req.json()
+            self.logger.info(f"CHECKING NUMBER: {number}: {status}")
         except requests.ConnectionError:
             return {"success": False, "message": "Could not connect to wppconnect"}
+        # errors are not cached
+        if start_session_req.ok and isinstance(status.get("response"), dict):
+            self.cache_number_lookup(
+                key, status, status["response"].get("numberExists")
+            )
+        return status
 
-    def check_number_info(self, number, augment_message=False):
+    def check_numbers_status(self, numbers, max_workers=None):
         """
-        this method will get infos from the contact api and insert
-        into self message
+        check many numbers at once, only asking the gateway
+        for the ones not cached yet. return the status by number
         """
-        endpoint = "{}/api/{}/contact/{}".format(
-            self.config.get("endpoint"), self.config.get("instance_name"), number
+        keys = {
+            self.get_number_cache_key("status", number): number for number in numbers
+        }
+        cached = cache.get_many(list(keys.keys()))
+        statuses = {keys[key]: status for key, status in cached.items()}
+        missing = [number for number in numbers if number not in statuses]
+        if missing:
+            if not self.config.get("token", {}).get("token"):
+                self.generate_token()
+            with ThreadPoolExecutor(
+                max_workers=max_workers or settings.CONNECTOR_SESSION_POOL_SIZE
+            ) as executor:
+                statuses.update(
+                    zip(missing, executor.map(self.check_number_status, missing))
+                )
+        return statuses
+
+    def can_receive_message(self, status):
+        """
+        the number exists, and can receive messages, as the active chat checks it
+        """
+        response = status.get("response") or {}
+        if not isinstance(response, dict):
+            return False
+        return bool(response.get("numberExists") and response.get("canReceiveMessage"))
+
+    def validate_numbers(self, numbers):
+        statuses = self.check_numbers_status(numbers)
+        return {
+            # the lookup failed, the number is not known to be invalid
+            number: self.can_receive_message(status)
+            if isinstance(status.get("response"), dict)
+            else None
+            for number, status in statuses.items()
+        }
+
+    def find_department(self, department):
+        """
+        the department for an active message, found as the active chat finds
+        it: a partial search by name. return the department and an error
+        """
+        departments = self.connector.server.search_departments(department)
+        if not departments:
+            return None, "DEPARTMENT NOT FOUND"
+        if len(departments) > 1:
+            return None, "MULTIPLE DEPARTMENTS FOUND"
+        return departments[0], None
+
+    def send_active_message(self, number, text, department=None, message_id=None):
+        """
+        open a room with the number, at the department,
+        and send the text to it, as the bot
+        """
+        department_id = None
+        if department:
+            found, error = self.find_department(department)
+            if error:
+                return {"success": False, "message": error}
+            department = found["name"]
+            department_id = found["_id"]
+        check_number = self.check_number_status(number)
+        if not self.can_receive_message(check_number):
+            return {"success": False, "message": "INVALID NUMBER"}
+        serialized_id = check_number["response"]["id"]["_serialized"]
+        self.type = "incoming"
+        self.message = {
+            "from": serialized_id,
+            "chatId": serialized_id,
+            "id": message_id,
+            "visitor": {"token": "whatsapp:" + serialized_id},
+        }
+        self.check_number_info(
+            check_number["response"]["id"]["user"], augment_message=True
+        )
+        self.get_rocket_client()
+        room = self.get_room(
+            department,
+            allow_welcome_message=False,
+            check_if_open=True,
+            force_transfer=department_id,
+        )
+        if not room:
+            return {"success": False, "message": "COULD NOT CREATE ROOM"}
+        rocket = self.connector.server.get_rocket_client(bot=True)
+        post_message = rocket.chat_post_message(text=text, room_id=room.room_id)
+        if not post_message.ok:
+            return {"success": False, "message": "COULD NOT SEND MESSAGE", "room": room}
+        return {"success": True, "message": "MESSAGE SENT", "room": room}
+
+    def start_campaign(self, numbers, department, text):
+        """
+        send the active chat text to many numbers, as a campaign
+        """
+        Campaign = apps.get_model(app_label="envelope", model_name="Campaign")
+        numbers = list(dict.fromkeys(n.strip() for n in numbers if n.strip()))
+        if department:
+            found, error = self.find_department(department)
+            if error:
+                self.get_rocket_client()
+                self.rocket.chat_update(
+                    room_id=self.message.get("channel_id"),
+                    msg_id=self.message.get("message_id"),
+                    text=self.message.get("text")
+                    + f"\n:warning: {error}: {department}",
+                )
+                return {"success": False, "message": error}
+            department = found["name"]
+        campaign = Campaign.objects.create(
+            connector=self.connector,
+            name=f"{self.message.get('user_name', '')} {timezone.now():%Y-%m-%d %H:%M}",
+            template=text,
+            department=department or None,
+            origin_room_id=self.message.get("channel_id"),
+            origin_message_id=self.message.get("message_id"),
+            origin_text=self.message.get("text"),
+        )
+        campaign.recipients.bulk_create(
+            [campaign.recipients.model(campaign=campaign, number=n) for n in numbers]
         )
+        campaign.report_progress()
+        campaign.dispatch()
+        return {
+            "success": True,
+            "message": f"CAMPAIGN CREATED FOR {len(numbers)} NUMBERS",
+            "campaign": campaign.id,
+        }
 
-        token = self.config.get("token", {}).get("token")
+    def check_number_info(self, number, augment_message=False, refresh=False):
+        """
+        this method will get infos from the contact api and insert
+        into self message
+        """
+        key = self.get_number_cache_key("info", number)
+        number_info = None if refresh else cache.get(key)
+        if not number_info:
+            endpoint = "{}/api/{}/contact/{}".format(
+                self.config.get("endpoint"), self.config.get("instance_name"), number
+            )
 
-        if not token:
-            self.generate_token()
-            token = self.config.get("token", {}).get("token")
+            if not self.config.get("token", {}).get("token"):
+                self.generate_token()
 
-        headers = {"Authorization": "Bearer " + token}
-        number_info_req = requests.get(endpoint, headers=headers)
-        number_info = number_info_req.json()
+            session = self.get_request_session()
+            number_info_req = session.get(endpoint)
+            number_info = number_info_req.json()
+            if number_info_req.ok:
+                self.cache_number_lookup(key, number_info, number_info.get("response"))
         self.logger.info(f"CHECKING CONTACT INFO FOR  NUMBER {number}: {number_info}")
         if augment_message:
             if not self.message.get("sender"):
@@ -256,7 +423,7 @@ class Connector(ConnectorBase):
                             "response", {}
                         ).get(order)
 
-        return number_info_req.json()
+        return number_info
 
     def active_chat(self):
         """
@@ -268,6 +435,7 @@ class Connector(ConnectorBase):
         reference can be:
             +5531111111@Department - opens a new chat at the selected department
             +5531111111@ Opens a new chat at the configured connector default department or None
+            +5531111111,+5532222222@Department - sends to all the numbers, as a campaign
         """
         # set the message type
         self.type = "active_chat"
@@ -284,6 +452,11 @@ class Connector(ConnectorBase):
         msg_id = self.message.get("message_id")
         # get the number, or all
         number = reference.split("@")[0]
+        # many numbers, separated by commas, are sent as a campaign
+        if "," in number:
+            department = reference.split("@")[1] if "@" in reference else None
+            text = " ".join(self.message.get("text").split(" ")[2:])
+            return self.start_campaign(number.split(","), department, text)
         # register number to get_visitor_id
         # emulating a regular ingoing message
         self.message["visitor"] = {"token": "whatsapp:" + number}
@@ -326,13 +499,8 @@ class Connector(ConnectorBase):
                     department = None
                 # check if department is valid
                 if department:
-                    department_check = self.rocket.call_api_get(
-                        "livechat/department",
-                        text=department,
-                        onlyMyDepartments="false",
-                    )
                     # departments found
-                    departments = department_check.json().get("departments")
+                    departments = self.connector.server.search_departments(department)
 
                     if not departments:
                         # maybe department is an online agent. let's check if
@@ -536,15 +704,12 @@ class Connector(ConnectorBase):
             self.config.get("instance_name"),
         )
 
-        token = self.config.get("token", {}).get("token")
-
-        if not token:
+        if not self.config.get("token", {}).get("token"):
             self.generate_token()
-            token = self.config.get("token", {}).get("token")
 
-        headers = {"Authorization": "Bearer " + token}
         data = {"webhook": self.config.get("webhook")}
-        start_session_req = requests.post(endpoint, headers=headers, json=data)
+        session = self.get_request_session()
+        start_session_req = session.post(endpoint, json=data)
         if start_session_req.ok:
             start_session = start_session_req.json()
             return start_session
@@ -564,6 +729,16 @@ class Connector(ConnectorBase):
         # start session
         return self.start_session()
 
+    def must_intake_inline(self):
+        # session management actions and the active chat integration
+        # answer the caller with the result
+        if self.message.get("action"):
+            return True
+        token = self.config.get("active_chat_webhook_integration_token")
+        if token and self.message.get("token") == token:
+            return True
+        return super().must_intake_inline()
+
     def incoming(self):
         """
         this method will process the incoming messages
@@ -656,13 +831,11 @@ class Connector(ConnectorBase):
                         if not room:
                             # get departments and buttons
                             buttons = []
-                            departments = self.rocket.call_api_get(
-                                "livechat/department"
-                            ).json()
+                            departments = self.connector.server.get_departments()
                             department_triage_to_ignore = self.config.get(
                                 "department_triage_to_ignore", ""
                             ).split(",")
-                            for department in departments.get("departments"):
+                            for department in departments:
                                 if department.get("enabled"):
                                     if (
                                         department.get("_id")
@@ -678,10 +851,11 @@ class Connector(ConnectorBase):
                             if self.message.get("type") == "template_button_reply":
                                 # the department text is body
                                 choosen_department = self.message.get("body")
-                                department_map = {}
-                                for b in buttons:
-                                    department_map[b["text"]] = b["buttonId"]
-                                department = department_map[choosen_department]
+                                department = (
+                                    self.connector.server.get_department_map().get(
+                                        choosen_department
+                                    )
+                                )
                             else:
                                 # add destination phone
                                 payload = self.config.get("department_triage_payload")
@@ -779,7 +953,7 @@ class Connector(ConnectorBase):
                                 except self.connector.messages.model.DoesNotExist:
                                     file_to_send = None
                                 if file_to_send:
-                                    file_sent = self.outcome_file(
+                                    file_sent = self.outcome_media(
                                         file_to_send,
                                         room.room_id,
                                         mime,
@@ -817,7 +991,7 @@ class Connector(ConnectorBase):
                             self.handle_ptt()
                         # media type
                         mime = self.message.get("mimetype")
-                        file_sent = self.outcome_file(
+                        file_sent = self.outcome_media(
                             self.message.get("body"),
                             room.room_id,
                             mime,
@@ -886,6 +1060,23 @@ class Connector(ConnectorBase):
 
         return False
 
+    def extract_media(self, message):
+        """
+        the media files come base64 encoded in the body
+        """
+        extracted = False
+        for media_message in [message, message.get("quotedMsg") or {}]:
+            body = media_message.get("body")
+            if not media_message.get("mimetype") or not body:
+                continue
+            if media.is_reference(body):
+                continue
+            reference = media.store_base64(body)
+            if reference:
+                media_message["body"] = reference
+                extracted = True
+        return extracted
+
     def get_incoming_message_id(self):
         # unread messages has a different structure
         if self.message.get("event") == "unreadmessages":
@@ -943,13 +1134,16 @@ class Connector(ConnectorBase):
     def get_message_body(self):
         return self.message.get("body")
 
-    def get_request_session(self):
-        s = requests.Session()
-        s.headers = {"content-type": "application/json"}
+    def get_request_headers(self):
+        headers = {"content-type": "application/json"}
         token = self.connector.config.get("token", {}).get("token")
         if token:
-            s.headers.update({"Authorization": f"Bearer {token}"})
-        return s
+            headers.update({"Authorization": f"Bearer {token}"})
+        return headers
+
+    def refresh_request_token(self):
+        if self.generate_token():
+            return self.get_request_headers()
 
     def outgo_text_message(self, message, agent_name=None):
         sent = False
@@ -992,21 +1186,12 @@ class Connector(ConnectorBase):
         # TODO: Simulate typing
         # See: https://github.com/wppconnect-team/wppconnect-server/issues/59
 
-        timestamp = int(time.time())
         try:
             self.logger_info(f"OUTGOING TEXT MESSAGE: URL and PAYLOAD {url} {payload}")
             sent = session.post(url, json=payload)
+            self.register_delivery_attempt("outgo", payload, sent)
             if self.message_object and sent.ok:
-                self.message_object.delivered = sent.ok
-                self.message_object.response[timestamp] = sent.json()
-                if not self.message_object.response.get("id"):
-                    self.message_object.response["id"] = [
-                        sent.json()["response"][0]["id"]
-                    ]
-                else:
-                    self.message_object.response["id"].append(
-                        sent.json()["response"][0]["id"]
-                    )
+                self.register_provider_message_id(sent.json()["response"][0]["id"])
 
             if sent.ok:
                 self.logger_info(f"OUTGOING TEXT MESSAGE SUCCESS: {sent.json()}")
@@ -1014,13 +1199,8 @@ class Connector(ConnectorBase):
                 self.logger_info(f"OUTGOING TEXT MESSAGE ERROR: {sent.json()}")
 
         except requests.ConnectionError:
-            if self.message_object:
-                self.message_object.delivered = False
-                self.logger_info(f"CONNECTOR DOWN: {self.connector}")
-        # save message object
-        if self.message_object:
-            self.message_object.payload[timestamp] = payload
-            self.message_object.save()
+            self.logger_info(f"CONNECTOR DOWN: {self.connector}")
+            self.register_delivery_attempt("outgo", payload, delivered=False)
         return sent
 
     def outgo_file_message(self, message, agent_name=None):
@@ -1040,8 +1220,56 @@ class Connector(ConnectorBase):
             + "?"
             + urlparse.urlparse(message["fileUpload"]["publicFilePath"]).query
         )
-        content = base64.b64encode(requests.get(file_url).content).decode("utf-8")
         mime = self.message["messages"][0]["fileUpload"]["type"]
+        filename = message.get("file", {}).get("name")
+        # files over the max size are not sent, but linked
+        max_size = self.config.get("outgo_file_max_size")
+        if max_size is None:
+            max_size = OUTGO_FILE_MAX_SIZE
+        max_size = int(max_size) * 1024 * 1024
+        size = message["fileUpload"].get("size")
+        if max_size and size and int(size) > max_size:
+            self.logger_info(f"OUTGOING FILE TOO LARGE: {size} bytes")
+            return self.outgo_file_fallback(message, agent_name)
+
+        mode = self.config.get("outgo_file_mode") or "base64"
+        if mode == "url":
+            payload, sent = self.outgo_file_url(file_url, filename)
+        elif mode == "multipart":
+            payload, sent = self.outgo_file_multipart(
+                file_url, mime, filename, max_size
+            )
+        else:
+            payload, sent = self.outgo_file_base64(file_url, mime, max_size)
+        if sent is None:
+            self.logger_info(f"OUTGOING FILE TOO LARGE: {file_url}")
+            return self.outgo_file_fallback(message, agent_name)
+        if sent.ok:
+            if settings.DEBUG:
+                self.logger.info(f"RESPONSE OUTGOING FILE: {sent.json()}")
+            self.register_delivery_attempt("outgo", payload, sent)
+            for sent_message in sent.json().get("response") or []:
+                if isinstance(sent_message, dict):
+                    self.register_provider_message_id(sent_message.get("id"))
+            # self.send_seen()
+        elif self.config.get("outgo_file_fallback_link", True):
+            self.logger_info(f"OUTGOING FILE ERROR: {sent.content}")
+            return self.outgo_file_fallback(message, agent_name)
+        return sent
+
+    def outgo_file_base64(self, file_url, mime, max_size=None):
+        """
+        send the file inlined as base64. the file is held in memory,
+        so the download is aborted once it passes the max size
+        """
+        download = requests.get(file_url, stream=True)
+        content = bytearray()
+        for chunk in download.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            content.extend(chunk)
+            if max_size and len(content) > max_size:
+                download.close()
+                return None, None
+        content = base64.b64encode(bytes(content)).decode("utf-8")
         payload = {
             "phone": self.get_visitor_id(),
             "base64": f"data:{mime};base64,{content}",
@@ -1054,15 +1282,81 @@ class Connector(ConnectorBase):
             self.connector.config["instance_name"]
         )
         sent = session.post(url, json=payload)
-        if sent.ok:
-            timestamp = int(time.time())
-            if settings.DEBUG:
-                self.logger.info(f"RESPONSE OUTGOING FILE: {sent.json()}")
-            self.message_object.payload[timestamp] = payload
-            self.message_object.delivered = True
-            self.message_object.response[timestamp] = sent.json()
-            self.message_object.save()
-            # self.send_seen()
+        # do not keep the file in the message payload
+        payload["base64"] = f"data:{mime};base64,..."
+        return payload, sent
+
+    def outgo_file_url(self, file_url, filename=None):
+        """
+        hand the file url over to WPPConnect, that will download it.
+        the file must be reachable from WPPConnect
+        """
+        payload = {
+            "phone": self.get_visitor_id(),
+            "path": file_url,
+            "filename": filename,
+            "isGroup": False,
+        }
+        self.logger_info(f"OUTGOING FILE URL: {payload}")
+        session = self.get_request_session()
+        url = self.connector.config["endpoint"] + "/api/{}/send-file".format(
+            self.connector.config["instance_name"]
+        )
+        sent = session.post(url, json=payload)
+        return payload, sent
+
+    def outgo_file_multipart(self, file_url, mime, filename=None, max_size=None):
+        """
+        stream the file from Rocket.Chat into a multipart upload to WPPConnect
+        """
+        download = requests.get(file_url, stream=True)
+        size = download.headers.get("Content-Length")
+        if (
+            not size
+            or download.headers.get("Content-Encoding", "identity") != "identity"
+        ):
+            # the size is needed to stream the upload
+            download.close()
+            return self.outgo_file_base64(file_url, mime, max_size)
+        if max_size and int(size) > max_size:
+            download.close()
+            return None, None
+        payload = {
+            "phone": self.get_visitor_id(),
+            "filename": filename or "file",
+            "isGroup": "false",
+        }
+        fields = dict(payload)
+        fields["file"] = (
+            payload["filename"],
+            StreamedFile(download.raw, int(size)),
+            mime,
+        )
+        multipart = MultipartEncoder(fields=fields)
+        self.logger_info(f"OUTGOING FILE MULTIPART: {payload}")
+        session = self.get_request_session()
+        url = self.connector.config["endpoint"] + "/api/{}/send-file".format(
+            self.connector.config["instance_name"]
+        )
+        try:
+            sent = session.post(
+                url, data=multipart, headers={"content-type": multipart.content_type}
+            )
+        finally:
+            download.close()
+        return payload, sent
+
+    def outgo_file_fallback(self, message, agent_name=None):
+        """
+        send a link to the file instead of the file
+        """
+        if not self.config.get("outgo_file_fallback_link", True):
+            return None
+        title = message["attachments"][0].get("title") or message.get("file", {}).get(
+            "name", ""
+        )
+        link = message["fileUpload"]["publicFilePath"]
+        return self.outgo_text_message(f"{title}\n{link}".strip(), agent_name)
 
     def outgo_vcard(self, payload):
         session = self.get_request_session()
@@ -1070,20 +1364,14 @@ class Connector(ConnectorBase):
             self.connector.config["instance_name"]
         )
         self.logger_info(f"OUTGOING VCARD. URL: {url}. PAYLOAD {payload}")
-        timestamp = int(time.time())
         try:
             # replace destination phone
             payload["phone"] = self.get_visitor_phone()
             sent = session.post(url, json=payload)
-            self.message_object.delivered = sent.ok
-            self.message_object.response[timestamp] = sent.json()
+            self.register_delivery_attempt("outgo", payload, sent)
         except requests.ConnectionError:
-            self.message_object.delivered = False
             self.logger_info(f"CONNECTOR DOWN: {self.connector}")
-        # save message object
-        if self.message_object:
-            self.message_object.payload[timestamp] = payload
-            self.message_object.save()
+            self.register_delivery_attempt("outgo", payload, delivered=False)
 
     def handle_inbound(self, request):
         if request.GET.get("phone"):
@@ -1165,6 +1453,9 @@ class Connector(ConnectorBase):
         if request.GET.get("check-phone"):
             return self.check_number_status(request.GET.get("check-phone"))
 
+        if request.GET.get("check-phones"):
+            return self.check_numbers_status(request.GET.get("check-phones").split(","))
+
     def handle_ack_fromme_message(self):
         # activate this if default_fromme_ack_department is set
         if self.config.get("default_fromme_ack_department") and self.config.get(
@@ -1193,32 +1484,10 @@ class Connector(ConnectorBase):
         # ack receipt
         if self.config.get("enable_ack_receipt"):
             # get the sent message
-            self.get_rocket_client()
             message_id = self.message.get("id", {}).get("_serialized")
             self.logger_info(f"enable_ack_receipt for {message_id}")
-            for message in self.connector.messages.filter(
-                response__id__contains=message_id
-            ):
-                # or add only the white check
-                original_message = self.rocket.chat_get_message(
-                    msg_id=message.envelope_id
-                )
-                body = original_message.json()["message"]["msg"]
-                # remove previous markers
-                body = body.replace(":ballot_box_with_check:", "")
-                body = body.replace(":white_check_mark:", "")
-                if self.message["ack"] == 1:
-                    mark = ":ballot_box_with_check:"
-                else:
-                    mark = ":white_check_mark:"
-
-                self.rocket.chat_update(
-                    room_id=message.room.room_id,
-                    msg_id=message.envelope_id,
-                    text=f"{mark} {body}",
-                )
-                message.ack = True
-                message.save()
+            for message in self.get_messages_by_provider_message_id(message_id):
+                self.register_ack_receipt(message, self.message.get("ack"))
 
 
 class ConnectorConfigForm(BaseConnectorConfigForm):
@@ -1296,6 +1565,31 @@ class ConnectorConfigForm(BaseConnectorConfigForm):
         help_text="This is the deparment that will be opened inbound active messages to by default",
     )
 
+    outgo_file_mode = forms.ChoiceField(
+        required=False,
+        initial="base64",
+        choices=(
+            ("base64", "Base64: the file is sent inlined as base64"),
+            ("url", "URL: WPPConnect downloads the file from Rocket.Chat"),
+            ("multipart", "Multipart: the file is streamed to WPPConnect"),
+        ),
+        help_text="How files sent by the agents are delivered to WPPConnect",
+    )
+
+    outgo_file_max_size = forms.IntegerField(
+        required=False,
+        initial=OUTGO_FILE_MAX_SIZE,
+        min_value=0,
+        help_text="Max size, in MB, of a file sent by the agents. "
+        + f"Default: {OUTGO_FILE_MAX_SIZE}. 0 for no limit",
+    )
+
+    outgo_file_fallback_link = forms.BooleanField(
+        required=False,
+        initial=True,
+        help_text="Send a link to the file when it is too large or could not be sent",
+    )
+
     field_order = [
         "webhook",
         "endpoint",